@@ -22,7 +22,7 @@ Update the existing stack like::
  To Deploy TTTDiazo we need:
 
 - ELB: to own the ASG and HTTPS certificate
-- ASG: min=2, max=2
+- ASG: min=2, max=4, scaled on what the ELB sees
 - EC2: under ASG
 - SG: ssh, ELB http, https, EC2 app from ELB only
 - CodeDeploy; Deployment Group and IAM Policy
@@ -77,6 +77,8 @@ from troposphere import (
     # sqs,
 )
 
+SCALING_POLICIES = ('cpu', 'latency', 'surge', 'requests')
+
 
 class Infra:
 
@@ -231,7 +233,7 @@ class Infra:
             ))
 
     ###########################################################################
-    # ASG with LaunchConfig and ELB: no scale policies nor alarms yet
+    # ASG with LaunchConfig and ELB, scaling policies and their alarms
 
     def add_launchconfig_prod(self):
         """Create ASG Launchconfig without elb_sg attached, for prod."""
@@ -422,8 +424,6 @@ class Infra:
                 # Doesn't support: Tags=Tags(**tags),
             ))
 
-    # TODO: implement these
-
     def add_scale_down_policy(self):
         name, tags = self._name_tags('scale_down_policy')
         self.scale_down_policy = self.t.add_resource(
@@ -445,7 +445,7 @@ class Infra:
                 AlarmDescription=('CPU high or missing due to dead instance'),
                 ComparisonOperator='GreaterThanThreshold',
                 Dimensions=[cw.MetricDimension(Name='AutoScalingGroupName',
-                                               Value=self.asg.name)],
+                                               Value=Ref(self.asg.name))],
                 EvaluationPeriods=3,
                 MetricName='CPUUtilization',
                 Period='60',
@@ -501,6 +501,145 @@ class Infra:
                 # Doesn't support: Tags=Tags(**tags),
             ))
 
+    ###########################################################################
+    # Scaling on what the ELB sees, prod only. The XSLT work saturates a box
+    # well before its CPU average says so, and then requests queue in the ELB.
+    # Pick policies with 'scaling.policies' in the .ini:
+    #
+    # - cpu: the CPU alarms above, ChangeInCapacity +1/-1
+    # - latency: target tracking on the ELB's average Latency, out and in
+    # - surge: step scaling out on the ELB's SurgeQueueLength; lets latency
+    #   or cpu scale back in
+    # - requests: step scaling to the exact capacity the ELB's RequestCount
+    #   needs at 'scale_requests.per_instance' requests a minute per instance.
+    #   It sets the capacity every minute, so use it alone.
+
+    def _elb_dimensions(self, dimension=cw.MetricDimension):
+        return [dimension(Name='LoadBalancerName', Value=Ref(self.elb.name))]
+
+    def _step_adjustments(self, steps):
+        """Return StepAdjustments from [(lower bound, adjustment)], lowest first.
+
+        Bounds are relative to the alarm's threshold; each step runs up to the
+        next one's lower bound and the last has no upper bound.
+        """
+        adjustments = []
+        for i, (lower, adjustment) in enumerate(steps):
+            step = autoscaling.StepAdjustments(
+                MetricIntervalLowerBound=lower,
+                ScalingAdjustment=adjustment,
+            )
+            if i + 1 < len(steps):
+                step.MetricIntervalUpperBound = steps[i + 1][0]
+            adjustments.append(step)
+        return adjustments
+
+    def add_scale_latency_policy(self):
+        name, tags = self._name_tags('scale_latency')
+        self.scale_latency = self.t.add_resource(
+            autoscaling.ScalingPolicy(
+                name,
+                AutoScalingGroupName=Ref(self.asg.name),
+                DependsOn=self.asg.name,
+                EstimatedInstanceWarmup=self.aws['scaling.warmup'],
+                PolicyType='TargetTrackingScaling',
+                TargetTrackingConfiguration=autoscaling.TargetTrackingConfiguration(
+                    CustomizedMetricSpecification=autoscaling.CustomizedMetricSpecification(
+                        Dimensions=self._elb_dimensions(autoscaling.MetricDimension),
+                        MetricName='Latency',
+                        Namespace='AWS/ELB',
+                        Statistic='Average',
+                        Unit='Seconds',
+                    ),
+                    TargetValue=float(self.aws['scale_latency.target']),
+                ),
+                # Doesn't support: Tags=Tags(**tags),
+            ))
+
+    def add_scale_surge_policy(self):
+        """Add instances when requests queue in the ELB, more for longer queues.
+
+        'scale_surge.steps' is like '0:1, 100:2': add 1 instance once the
+        queue reaches the alarm threshold, 2 once it's 100 longer than that.
+        """
+        name, tags = self._name_tags('scale_surge')
+        steps = []
+        for step in self.aws['scale_surge.steps'].split(','):
+            lower, adjustment = step.split(':')
+            steps.append((float(lower), int(adjustment)))
+        self.scale_surge = self.t.add_resource(
+            autoscaling.ScalingPolicy(
+                name,
+                AdjustmentType='ChangeInCapacity',
+                AutoScalingGroupName=Ref(self.asg.name),
+                DependsOn=self.asg.name,
+                EstimatedInstanceWarmup=self.aws['scaling.warmup'],
+                MetricAggregationType='Maximum',
+                PolicyType='StepScaling',
+                StepAdjustments=self._step_adjustments(steps),
+                # Doesn't support: Tags=Tags(**tags),
+            ))
+        name, _ = self._name_tags('alarm_surge')
+        self.alarm_surge = self.t.add_resource(
+            cw.Alarm(
+                name,
+                AlarmDescription='Requests queueing in the ELB',
+                ComparisonOperator='GreaterThanOrEqualToThreshold',
+                Dimensions=self._elb_dimensions(),
+                EvaluationPeriods=1,
+                MetricName='SurgeQueueLength',
+                Period='60',
+                Namespace='AWS/ELB',
+                Statistic='Maximum',
+                Threshold=self.aws['alarm_surge.threshold'],
+                AlarmActions=[Ref(self.scale_surge.name)],
+                # Doesn't support: Tags=Tags(**tags),
+            ))
+
+    def add_scale_requests_policy(self):
+        """Keep ceil(requests a minute / per_instance) instances in service.
+
+        The classic ELB has no per instance RequestCount, so the steps split
+        its Sum at each multiple of 'scale_requests.per_instance' between
+        'asg.scale_min' and 'asg.scale_max' instances. The alarm is in ALARM
+        whenever there is traffic, so the policy runs every minute.
+        """
+        name, tags = self._name_tags('scale_requests')
+        per_instance = int(self.aws['scale_requests.per_instance'])
+        scale_min = int(self.aws['asg.scale_min'])
+        scale_max = int(self.aws['asg.scale_max'])
+        steps = [(0, scale_min)]
+        for capacity in range(scale_min + 1, scale_max + 1):
+            steps.append(((capacity - 1) * per_instance, capacity))
+        self.scale_requests = self.t.add_resource(
+            autoscaling.ScalingPolicy(
+                name,
+                AdjustmentType='ExactCapacity',
+                AutoScalingGroupName=Ref(self.asg.name),
+                DependsOn=self.asg.name,
+                EstimatedInstanceWarmup=self.aws['scaling.warmup'],
+                MetricAggregationType='Average',
+                PolicyType='StepScaling',
+                StepAdjustments=self._step_adjustments(steps),
+                # Doesn't support: Tags=Tags(**tags),
+            ))
+        name, _ = self._name_tags('alarm_requests')
+        self.alarm_requests = self.t.add_resource(
+            cw.Alarm(
+                name,
+                AlarmDescription='ELB requests a minute, to size the ASG',
+                ComparisonOperator='GreaterThanOrEqualToThreshold',
+                Dimensions=self._elb_dimensions(),
+                EvaluationPeriods=1,
+                MetricName='RequestCount',
+                Period='60',
+                Namespace='AWS/ELB',
+                Statistic='Sum',
+                Threshold='0',
+                AlarmActions=[Ref(self.scale_requests.name)],
+                # Doesn't support: Tags=Tags(**tags),
+            ))
+
     ###########################################################################
     # DNS
 
@@ -700,10 +839,26 @@ def main():
         infra.add_launchconfig()
         infra.add_asg()
 
-    infra.add_scale_down_policy()
-    infra.add_scale_up_policy()
-    infra.add_alarm_high()
-    infra.add_alarm_low()
+    policies = [p.strip() for p in config['config:aws']['scaling.policies'].split(',')]
+    unknown = set(policies) - set(SCALING_POLICIES)
+    if unknown:
+        parser.error('unknown scaling.policies: {}'.format(', '.join(sorted(unknown))))
+    if env != 'prod' and set(policies) - {'cpu'}:
+        parser.error('only prod has an ELB to scale on; use scaling.policies = cpu')
+    if 'requests' in policies and len(policies) > 1:
+        parser.error('scaling.policies: requests sets the exact capacity, use it alone')
+
+    if 'cpu' in policies:
+        infra.add_scale_down_policy()
+        infra.add_scale_up_policy()
+        infra.add_alarm_high()
+        infra.add_alarm_low()
+    if 'latency' in policies:
+        infra.add_scale_latency_policy()
+    if 'surge' in policies:
+        infra.add_scale_surge_policy()
+    if 'requests' in policies:
+        infra.add_scale_requests_policy()
     # Only provision DNS Records for Prod env
     if env == 'prod':
         infra.add_alarm_elb_empty()
@@ -7,4 +7,5 @@
 
 echo "$0 (stop_server) is running from PWD=`pwd`"
 pkill nginx  || echo "Could not pkill nginx"
+pkill -f tttdiazo-metrics || echo "Could not pkill tttdiazo-metrics"
 exit 0
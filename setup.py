@@ -5,7 +5,6 @@ Copyright (c) 2016 V! Studios.
 """
 import os
 
-from pip.req import parse_requirements
 from setuptools import find_packages, setup
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -14,9 +13,17 @@ with open(os.path.join(here, 'README.rst')) as f:
 with open(os.path.join(here, 'VERSION.txt')) as f:
     VERSION = f.read().strip()
 
-# use pip to parse the requirements.txt files into lists.
-reqs = [str(i.req) for i in parse_requirements('requirements.txt',
-                                               session=False)]
+# What the package itself imports; requirements.txt also pins the
+# development and deploy tools (tox, selenium, troposphere, buildout), which
+# buildout's `develop = .` shouldn't install as our dependencies.
+reqs = [
+    'diazo',
+    'lxml',
+    'Paste',
+    'repoze.xmliter==0.6',
+    'requests==2.9.1',
+    'WebOb==1.5.1',
+]
 
 setup(name='tttdiazo',
       version=VERSION,
@@ -36,4 +43,27 @@ setup(name='tttdiazo',
       zip_safe=False,
       install_requires=reqs,
       test_suite='tttdiazo',
+      entry_points="""\
+      [paste.app_factory]
+      metrics = tttdiazo.metrics:app_factory
+      origin = tttdiazo.origin:app_factory
+      rum = tttdiazo.rum:app_factory
+      [paste.filter_app_factory]
+      theme = tttdiazo.themecache:filter_factory
+      [paste.server_runner]
+      prefork = tttdiazo.prefork:server_runner
+      [zc.buildout]
+      template = tttdiazo.nginxconf:TemplateRecipe
+      [console_scripts]
+      tttdiazo-compile = tttdiazo.xslstore:main
+      tttdiazo-logstats = tttdiazo.logstats:main
+      tttdiazo-metrics = tttdiazo.metrics:main
+      tttdiazo-optimize = tttdiazo.optimizer:main
+      tttdiazo-nginx-template = tttdiazo.nginxconf:main
+      tttdiazo-origin-record = tttdiazo.origin:record_main
+      tttdiazo-prerender = tttdiazo.prerender:main
+      tttdiazo-profile = tttdiazo.profiler:main
+      tttdiazo-regress = tttdiazo.regression:main
+      tttdiazo-rum = tttdiazo.rum:main
+      """,
       )
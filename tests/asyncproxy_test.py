@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+import asyncio
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from tttdiazo.asyncproxy import OriginPool, iter_body, make_proxy, read_head
+
+from themecache_test import CONTENT, RULES, THEME
+
+CONFIG = """[filter:theme]
+use = egg:tttdiazo#theme
+rules = %(here)s/rules.xml
+prefix = /static
+server_timing = true
+
+[app:content]
+use = egg:Paste#proxy
+address = http://127.0.0.1:{}
+
+[app:static]
+use = egg:Paste#static
+document_root = %(here)s/theme
+"""
+
+GIF = b'GIF89a' + b'\x00' * 200
+
+
+class Origin(object):
+    """A keep-alive HTTP/1.1 origin that counts the connections it gets."""
+
+    def __init__(self):
+        self.connections = 0
+        self.accept_encoding = []
+
+    def answer(self, target, headers):
+        if target == '/image.gif':
+            return [('Content-Type', 'image/gif')], [GIF[:100], GIF[100:]]
+        content_type = [('Content-Type', 'text/html; charset=utf-8')]
+        encoding = [v for k, v in headers if k.lower() == 'accept-encoding']
+        self.accept_encoding.append(encoding)
+        if target == '/gzipped':
+            body = gzip.compress(CONTENT)
+            return content_type + [('Content-Encoding', 'gzip'),
+                                   ('Content-Length', str(len(body)))], [body]
+        return content_type + [('Content-Length', str(len(CONTENT)))], [CONTENT]
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        while True:
+            head = await read_head(reader)
+            if head is None:
+                break
+            method, target, _ = head[0].split()
+            headers, chunks = self.answer(target, head[1])
+            writer.write(b'HTTP/1.1 200 OK\r\n')
+            for name, value in headers:
+                writer.write('{}: {}\r\n'.format(name, value).encode('latin-1'))
+            if not any(k == 'Content-Length' for k, v in headers):
+                writer.write(b'Transfer-Encoding: chunked\r\n\r\n')
+                for chunk in chunks:
+                    writer.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+                    await writer.drain()
+                writer.write(b'0\r\n\r\n')
+            else:
+                writer.write(b'\r\n' + b''.join(chunks))
+            await writer.drain()
+        writer.close()
+
+
+class TestAsyncProxy(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        os.mkdir(os.path.join(self.dir, 'theme'))
+        with open(os.path.join(self.dir, 'rules.xml'), 'w') as f:
+            f.write(RULES.replace('theme.html', 'theme/theme.html'))
+        with open(os.path.join(self.dir, 'theme', 'theme.html'), 'w') as f:
+            f.write(THEME.format('Async'))
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.origin = Origin()
+        origin_server = self.wait(asyncio.start_server(self.origin.handle, '127.0.0.1', 0))
+        self.addCleanup(self.close_server, origin_server)
+        config = os.path.join(self.dir, 'local.ini')
+        with open(config, 'w') as f:
+            f.write(CONFIG.format(origin_server.sockets[0].getsockname()[1]))
+        self.proxy = make_proxy(config, pool_size=2, workers=2)
+        self.addCleanup(self.proxy.executor.shutdown)
+        server = self.wait(asyncio.start_server(self.proxy.handle, '127.0.0.1', 0))
+        self.addCleanup(self.close_server, server)
+        self.client = OriginPool('http://127.0.0.1:{}'.format(server.sockets[0].getsockname()[1]))
+        self.addCleanup(self.client.close)
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def close_server(self, server):
+        self.proxy.pool.close()
+        server.close()
+        self.wait(server.wait_closed())
+
+    def get(self, path, *headers):
+        async def get():
+            response = await self.client.request('GET', path, list(headers))
+            return response, await response.read()
+        return self.wait(get())
+
+    def testThemesOverPooledConnections(self):
+        for _ in range(3):
+            response, body = self.get('/')
+            self.assertEqual(response.status, 200)
+            self.assertIn(b'<title>Async</title>', body)
+            self.assertIn(b'origin', body)
+        self.assertEqual(self.origin.connections, 1)
+        self.assertEqual(self.proxy.pool.reused, 2)
+        timing = dict(response.headers)['Server-Timing']
+        self.assertTrue(timing.startswith('origin;dur='), timing)
+
+    def testStreamsAssets(self):
+        response, body = self.get('/image.gif', ('Accept-Encoding', 'gzip'))
+        self.assertEqual(body, GIF)
+        self.assertEqual(dict(response.headers)['Transfer-Encoding'], 'chunked')
+
+    def testDecompressesPagesToTheme(self):
+        response, body = self.get('/gzipped', ('Accept-Encoding', 'gzip'))
+        self.assertEqual(self.origin.accept_encoding, [['gzip']])
+        self.assertIn(b'<title>Async</title>', body)
+        self.assertNotIn('Content-Encoding', dict(response.headers))
+
+    def testServesStatic(self):
+        response, body = self.get('/static/theme.html')
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'<div id="main">theme</div>', body)
+        self.assertEqual(self.origin.connections, 0)
+
+    def testChunkedBody(self):
+        async def read(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return [chunk async for chunk in iter_body(reader, [('Transfer-Encoding', 'chunked')])]
+        self.assertEqual(self.wait(read(b'3\r\nabc\r\n2;x=y\r\nde\r\n0\r\nT: 1\r\n\r\n')),
+                         [b'abc', b'de'])
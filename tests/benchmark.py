@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 V! Studios.
+"""
+Benchmark each way we serve the theme, against the stand-in origin.
+
+We serve on five paths: paster with the diazo filter (`make run`), the same
+pipeline pre-forked (`make run_prefork`) or under the asyncio proxy
+(`make run_async`), nginx with the XSLT module (port 8888 of
+`make fullstack_run`), and the `tttdiazo_cache` front server in front of it
+(port 5000), reaching it over its unix socket or, as `cache-tcp`, over
+TCP. For each mode this starts the
+stand-in origin from origin.ini and the server, runs the integration tests'
+load driver over integration_tests_urls.txt, and records requests/sec,
+latency percentiles and the resident memory of the server's processes.
+
+Results are compared to a stored baseline; a mode that loses more than
+--tolerance of its throughput or p95 latency is a regression and we exit 1.
+Save a baseline on the box you compare on::
+
+  make fullstack
+  .venv2/bin/python tests/benchmark.py --save
+  .venv2/bin/python tests/benchmark.py
+
+With --workers 1,2,4 this instead runs nginx's XSLT once per worker count,
+rewriting the bench config's worker directives to each (nginxworkers.resize),
+and prints how throughput scales with the workers, one per core::
+
+  .venv2/bin/python tests/benchmark.py --workers 1,2,4 -c 16
+
+Every request to the front end is re-proxied to the tttdiazo server. With
+--hops this measures what that hop costs: themed pages straight from the
+tttdiazo server, through the front end over TCP (`cache-tcp`) and through
+it over the unix socket (`cache`), with a member's cookie so the microcache
+never answers. The report is each one's latency over the direct request,
+and what the socket saves::
+
+  .venv2/bin/python tests/benchmark.py --hops
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from requests import RequestException, get
+
+from tttdiazo.nginxworkers import machine, resize, size
+
+from integration_tests import (PERCENTILES, ServerTimings, percentile, read_urls, report_load,
+                               run_load)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUILDOUT_DIR = os.path.dirname(HERE)
+DEFAULT_BASELINE = os.path.join(HERE, 'benchmark_baseline.json')
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DURATION = 20
+DEFAULT_TOLERANCE = 0.10
+ORIGIN_URL = 'http://127.0.0.1:9000'
+NGINX_CONF = os.path.join(BUILDOUT_DIR, 'etc', 'nginx-bench.conf')
+NGINX_TCP_CONF = os.path.join(BUILDOUT_DIR, 'etc', 'nginx-bench-tcp.conf')
+# With --hops: a microcache bypass cookie, so every request takes the hop.
+HOP_HEADERS = {'Cookie': 'tttdiazo_member=1'}
+HOP_MODES = ('nginx', 'cache-tcp', 'cache')
+
+# Each mode: the command that starts its server, how to stop it (None to
+# terminate the process we started), and the URL root to load.
+MODES = {
+    'paster': {
+        'start': ['bin/paster', 'serve', 'bench.ini'],
+        'stop': None,
+        'url': 'http://127.0.0.1:5000',
+    },
+    'prefork': {
+        'start': ['bin/paster', 'serve', 'bench.ini', '--server-name=prefork'],
+        'stop': None,
+        'url': 'http://127.0.0.1:5000',
+    },
+    'async': {
+        'start': ['.venv3/bin/python', '-m', 'tttdiazo.asyncproxy', '-c', 'bench.ini',
+                  '-l', '127.0.0.1:5000'],
+        'stop': None,
+        'url': 'http://127.0.0.1:5000',
+    },
+    'nginx': {
+        'start': ['bin/nginx', '-c', NGINX_CONF, '-g', 'daemon off;'],
+        'stop': ['bin/nginx', '-c', NGINX_CONF, '-s', 'stop'],
+        'url': 'http://127.0.0.1:8888',
+    },
+    'cache': {
+        'start': ['bin/nginx', '-c', NGINX_CONF, '-g', 'daemon off;'],
+        'stop': ['bin/nginx', '-c', NGINX_CONF, '-s', 'stop'],
+        'url': 'http://127.0.0.1:5000',
+    },
+    'cache-tcp': {
+        'start': ['bin/nginx', '-c', NGINX_TCP_CONF, '-g', 'daemon off;'],
+        'stop': ['bin/nginx', '-c', NGINX_TCP_CONF, '-s', 'stop'],
+        'url': 'http://127.0.0.1:5000',
+    },
+}
+
+# Start log.
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log = logging.getLogger(os.path.basename(__file__))
+log.setLevel(logging.INFO)
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark paster, nginx XSLT and the nginx cache front end."
+    )
+    parser.add_argument(
+        'modes', nargs='*', default=sorted(MODES),
+        help="Modes to run: {}. Default: all.".format(', '.join(sorted(MODES))),
+    )
+    parser.add_argument(
+        '-c', '--concurrency', default=DEFAULT_CONCURRENCY, type=int,
+        help="Client threads. Default: {}.".format(DEFAULT_CONCURRENCY),
+    )
+    parser.add_argument(
+        '-d', '--duration', default=DEFAULT_DURATION, type=float,
+        help="Seconds to load each mode. Default: {}.".format(DEFAULT_DURATION),
+    )
+    parser.add_argument(
+        '-b', '--baseline', default=DEFAULT_BASELINE,
+        help="Baseline results file. Default: {}.".format(DEFAULT_BASELINE),
+    )
+    parser.add_argument(
+        '-t', '--tolerance', default=DEFAULT_TOLERANCE, type=float,
+        help="Allowed fractional regression. Default: {}.".format(DEFAULT_TOLERANCE),
+    )
+    parser.add_argument(
+        '-w', '--workers', type=lambda s: [int(n) for n in s.split(',')],
+        help="Comma-separated nginx worker counts to compare, e.g. 1,2,4, instead of modes.",
+    )
+    parser.add_argument(
+        '--hops', action='store_true',
+        help="Compare the front end's hop to the tttdiazo server over TCP and "
+             "the unix socket, instead of modes.",
+    )
+    parser.add_argument(
+        '-s', '--save', action='store_true',
+        help="Save these results as the new baseline instead of comparing.",
+    )
+    return parser
+
+
+def wait_for(url, timeout=30):
+    """Wait until url answers at all; raise RuntimeError if it never does."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            get(url, timeout=1)
+            return
+        except RequestException:
+            time.sleep(0.2)
+    raise RuntimeError('{} did not come up in {}s'.format(url, timeout))
+
+
+def tree_rss(pid):
+    """Return the summed RSS in KB of pid and all its descendants.
+
+    Uses `ps` so it works on OS X as well as Linux; nginx's workers are
+    children of the master we started.
+    """
+    out = subprocess.check_output(['ps', '-A', '-o', 'pid=,ppid=,rss='])
+    procs = [[int(i) for i in line.split()] for line in out.decode().splitlines() if line.strip()]
+    pids = set([pid])
+    grew = True
+    while grew:
+        grew = False
+        for p, ppid, _ in procs:
+            if ppid in pids and p not in pids:
+                pids.add(p)
+                grew = True
+    return sum(rss for p, _, rss in procs if p in pids)
+
+
+def start(cmd):
+    """Start cmd from the buildout directory, returning the Popen."""
+    return subprocess.Popen(cmd, cwd=BUILDOUT_DIR)
+
+
+def stop(proc, cmd=None):
+    """Stop a server we started, politely if it has a stop command."""
+    if cmd:
+        subprocess.call(cmd, cwd=BUILDOUT_DIR)
+    else:
+        proc.terminate()
+    proc.wait()
+
+
+def core_modes(counts):
+    """Return {mode: config} running nginx's XSLT with each count of workers.
+
+    Writes etc/nginx-bench-w<count>.conf for each from the bench config.
+    """
+    with open(NGINX_CONF) as _f:
+        conf = _f.read()
+    cores, memory_gb = machine()
+    modes = {}
+    for count in counts:
+        path = os.path.join(BUILDOUT_DIR, 'etc', 'nginx-bench-w{}.conf'.format(count))
+        with open(path, 'w') as _f:
+            _f.write(resize(conf, size(cores, memory_gb, workers=count)))
+        modes['nginx-w{}'.format(count)] = {
+            'start': ['bin/nginx', '-c', path, '-g', 'daemon off;'],
+            'stop': ['bin/nginx', '-c', path, '-s', 'stop'],
+            'url': MODES['nginx']['url'],
+        }
+    return modes
+
+
+def report_scaling(counts, results):
+    """Print req/s per worker count against a single worker."""
+    single = results['nginx-w{}'.format(counts[0])]['rps'] / counts[0]
+    print('\n== Scaling ({} cores)'.format(machine()[0]))
+    print('{:>8} {:>10} {:>12} {:>8} {:>11}'.format(
+        'workers', 'req/s', 'req/s/worker', 'speedup', 'efficiency'))
+    for count in counts:
+        rps = results['nginx-w{}'.format(count)]['rps']
+        print('{:>8} {:>10.1f} {:>12.1f} {:>7.2f}x {:>10.0%}'.format(
+            count, rps, rps / count, rps / single, rps / (single * count)))
+
+
+def report_hops(results):
+    """Print the front end's latency over the tttdiazo server's, per hop."""
+    direct = results['nginx']
+    tcp = results['cache-tcp']
+    print('\n== Front end to tttdiazo server hop (ms over direct)')
+    print('{:>10} {:>10} {:>10}'.format('', 'p50', 'p95'))
+    for mode, label in (('cache-tcp', 'tcp'), ('cache', 'unix')):
+        print('{:>10} {:>10.2f} {:>10.2f}'.format(
+            label, results[mode]['p50_ms'] - direct['p50_ms'],
+            results[mode]['p95_ms'] - direct['p95_ms']))
+    saved = dict((p, tcp[p] - results['cache'][p]) for p in ('p50_ms', 'p95_ms'))
+    print('{:>10} {:>10.2f} {:>10.2f}'.format('saved', saved['p50_ms'], saved['p95_ms']))
+    print('unix socket: {:+.1%} req/s over tcp'.format(results['cache']['rps'] / tcp['rps'] - 1))
+
+
+def bench_mode(mode, urls, args, config=None, headers=None):
+    """Start the mode's server, load it, and return its result dict."""
+    config = config or MODES[mode]
+    server = start(config['start'])
+    try:
+        wait_for(config['url'] + '/')
+        # Warm up: compile/cache whatever the server compiles or caches lazily.
+        for url in urls:
+            get(config['url'] + url, headers=headers)
+        server_timings = ServerTimings()
+        timings, errors, elapsed = run_load(config['url'], urls, args.concurrency,
+                                            args.duration, args.duration, server_timings,
+                                            headers)
+        rss = tree_rss(server.pid)
+    finally:
+        stop(server, config['stop'])
+    print('\n== {} ({})'.format(mode, config['url']))
+    summary = report_load(timings, errors, elapsed)
+    merged = sorted(t for values in timings.values() for t in values)
+    result = {'rps': summary['rps'], 'errors': summary['errors'], 'rss_kb': rss}
+    for p in PERCENTILES:
+        result['p{}_ms'.format(p)] = percentile(merged, p) * 1000
+    print('\n'.join(server_timings.report()))
+    print('RSS: {} KB'.format(rss))
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Log each mode against the baseline; return the regressed modes."""
+    regressed = []
+    for mode, result in sorted(results.items()):
+        base = baseline.get(mode)
+        if not base:
+            log.warning('{}: no baseline to compare against'.format(mode))
+            continue
+        rps_change = result['rps'] / base['rps'] - 1
+        p95_change = result['p95_ms'] / base['p95_ms'] - 1
+        log.info('{}: {:+.1%} req/s, {:+.1%} p95, RSS {} -> {} KB'.format(
+            mode, rps_change, p95_change, base['rss_kb'], result['rss_kb']))
+        if rps_change < -tolerance or p95_change > tolerance or result['errors']:
+            regressed.append(mode)
+    return regressed
+
+
+def bench_modes(modes, args, headers=None):
+    """Start the stand-in origin and bench each of modes, {mode: config}."""
+    urls = read_urls()
+    origin = start(['bin/paster', 'serve', 'origin.ini'])
+    try:
+        wait_for(ORIGIN_URL + '/')
+        return dict((mode, bench_mode(mode, urls, args, config, headers))
+                    for mode, config in sorted(modes.items()))
+    finally:
+        stop(origin)
+
+
+def main_workers(args):
+    """Run nginx with each of args.workers and report the scaling."""
+    counts = sorted(set(args.workers))
+    results = bench_modes(core_modes(counts), args)
+    report_scaling(counts, results)
+    sys.exit(1 if any(result['errors'] for result in results.values()) else 0)
+
+
+def main_hops(args):
+    """Run the front end over TCP and the unix socket and report the hop."""
+    results = bench_modes(dict((mode, MODES[mode]) for mode in HOP_MODES), args, HOP_HEADERS)
+    report_hops(results)
+    sys.exit(1 if any(result['errors'] for result in results.values()) else 0)
+
+
+def main(args):
+    if args.workers:
+        main_workers(args)
+    if args.hops:
+        main_hops(args)
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        log.error('Unknown modes: {}'.format(', '.join(sorted(unknown))))
+        sys.exit(2)
+    results = bench_modes(dict((mode, MODES[mode]) for mode in args.modes), args)
+    if args.save:
+        with open(args.baseline, 'w') as _f:
+            json.dump(results, _f, indent=2, sort_keys=True)
+        log.info('Saved baseline to {}'.format(args.baseline))
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        log.warning('No baseline at {}; run with --save first.'.format(args.baseline))
+        sys.exit(0)
+    with open(args.baseline) as _f:
+        baseline = json.load(_f)
+    regressed = compare(results, baseline, args.tolerance)
+    if regressed:
+        log.error('Performance regression in: {}'.format(', '.join(regressed)))
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    # Parse args.
+    parser = init_parser()
+    args = parser.parse_args()
+    # Run.
+    main(args)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 V! Studios.
+"""
+Shared, long-lived browsers for tests/browser_tests.py.
+
+Launching Firefox is most of the cost of a browser test, and each test class
+used to launch one per test method. `BrowserPool` keeps up to N headless
+browsers for the whole run instead: a test borrows one, and when it's done
+the browser is reset (extra windows closed, cookies deleted, blank page) and
+handed to the next test. `run_sharded` runs the suite in N threads, one per
+pool member, so the tests are spread across the browsers in parallel.
+
+`load` also records how long each page took, both the WebDriver round trip
+and the browser's Navigation Timing (time to first byte, DOMContentLoaded,
+load), so a run doubles as a client-side timing sample of the themed pages.
+Tests wait for what they need with `wait_for`, which polls a condition
+rather than sleeping a fixed time, and records how long it actually took.
+"""
+import json
+import os
+import threading
+import time
+import unittest
+
+from selenium import webdriver
+from selenium.webdriver.support.ui import WebDriverWait
+
+try:
+    from queue import Empty, Queue
+except ImportError:     # Python 2
+    from Queue import Empty, Queue
+
+DEFAULT_WAIT = 10
+WAIT_POLL = 0.05
+
+NAVIGATION_TIMING = """
+var t = window.performance && window.performance.timing;
+return t ? {navigationStart: t.navigationStart, responseStart: t.responseStart,
+            domContentLoadedEventEnd: t.domContentLoadedEventEnd,
+            loadEventEnd: t.loadEventEnd} : null;
+"""
+
+
+def firefox():
+    """Start Firefox through geckodriver, headless unless BROWSER_HEADFUL is set.
+
+    Needs Firefox 56+ and geckodriver on the PATH.
+    """
+    options = webdriver.FirefoxOptions()
+    options.set_headless(not os.environ.get('BROWSER_HEADFUL'))
+    return webdriver.Firefox(options=options)
+
+
+def reset(browser):
+    """Return browser to a clean state: one window, no cookies, blank page."""
+    handles = browser.window_handles
+    for handle in handles[1:]:
+        browser.switch_to.window(handle)
+        browser.close()
+    browser.switch_to.window(handles[0])
+    browser.delete_all_cookies()
+    browser.get('about:blank')
+
+
+class BrowserPool(object):
+    """Up to `size` browsers, started on demand and quit by `close`."""
+
+    def __init__(self, size=1, factory=firefox):
+        self.size = size
+        self.factory = factory
+        self._idle = Queue()
+        self._browsers = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return an idle browser, starting one if the pool isn't full."""
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if len(self._browsers) < self.size:
+                browser = self.factory()
+                self._browsers.append(browser)
+                return browser
+        return self._idle.get()
+
+    def release(self, browser):
+        """Reset browser and make it available again; drop it if it's broken."""
+        try:
+            reset(browser)
+        except Exception:
+            with self._lock:
+                self._browsers.remove(browser)
+            try:
+                browser.quit()
+            except Exception:
+                pass
+            return
+        self._idle.put(browser)
+
+    def close(self):
+        with self._lock:
+            for browser in self._browsers:
+                browser.quit()
+            self._browsers = []
+
+
+def _median(values):
+    values = sorted(v for v in values if v is not None)
+    return values[len(values) // 2] if values else None
+
+
+class PageTimings(object):
+    """Thread-safe record of page load and wait times, in ms, per URL."""
+
+    def __init__(self):
+        self.pages = {}
+        self.waits = {}
+        self._lock = threading.Lock()
+
+    def add(self, url, metrics):
+        with self._lock:
+            self.pages.setdefault(url, []).append(metrics)
+
+    def add_wait(self, url, description, ms):
+        with self._lock:
+            self.waits.setdefault(url, {}).setdefault(description, []).append(ms)
+
+    def report(self):
+        """Return a line per URL with median timings, then per wait."""
+        lines = ['{:>6} {:>6} {:>6} {:>6}  {}'.format('get', 'ttfb', 'dcl', 'load', 'url')]
+        for url, samples in sorted(self.pages.items()):
+            row = [_median(s.get(k) for s in samples) for k in ('get', 'ttfb', 'dcl', 'load')]
+            lines.append('{:>6} {:>6} {:>6} {:>6}  {}'.format(
+                *(['-' if v is None else int(v) for v in row] + [url])))
+        if self.waits:
+            lines.extend(['', '{:>6} {:>6}  {}'.format('wait', 'max', 'url: condition')])
+        for url, waits in sorted(self.waits.items()):
+            for description, samples in sorted(waits.items()):
+                lines.append('{:>6} {:>6}  {}: {}'.format(
+                    int(_median(samples)), int(max(samples)), url, description))
+        return lines
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'pages': self.pages, 'waits': self.waits}, f,
+                      indent=2, sort_keys=True)
+
+
+def load(browser, url, timings=None):
+    """Load url in browser, recording its timings if given a `PageTimings`."""
+    start = time.time()
+    browser.get(url)
+    metrics = {'get': (time.time() - start) * 1000}
+    nav = browser.execute_script(NAVIGATION_TIMING)
+    if nav and nav.get('navigationStart'):
+        begin = nav['navigationStart']
+        for name, key in (('ttfb', 'responseStart'), ('dcl', 'domContentLoadedEventEnd'),
+                          ('load', 'loadEventEnd')):
+            metrics[name] = nav[key] - begin if nav.get(key) else None
+    if timings is not None:
+        timings.add(url, metrics)
+    return metrics
+
+
+def wait_for(browser, condition, description, timeout=DEFAULT_WAIT, timings=None):
+    """Poll until condition(browser) is truthy and return its value.
+
+    Raises selenium's TimeoutException, with description, after timeout
+    seconds. The time it took is recorded against the current URL if given
+    a `PageTimings`, so waits double as client-side timings of the page.
+    """
+    url = browser.current_url
+    start = time.time()
+    value = WebDriverWait(browser, timeout, WAIT_POLL).until(condition, description)
+    if timings is not None:
+        timings.add_wait(url, description, (time.time() - start) * 1000)
+    return value
+
+
+def flatten(suite):
+    """Yield the individual tests in a (nested) TestSuite."""
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in flatten(test):
+                yield t
+        else:
+            yield test
+
+
+def run_sharded(suite, workers, stream, verbosity=1):
+    """Run suite's tests in `workers` threads; return the merged TestResult.
+
+    Each thread keeps its own TestResult, since unittest's aren't made to be
+    shared, and they're merged and reported once all tests have run.
+    """
+    tests = Queue()
+    for test in flatten(suite):
+        tests.put(test)
+    results = []
+
+    def work():
+        result = unittest.TestResult()
+        results.append(result)
+        while True:
+            try:
+                test = tests.get_nowait()
+            except Empty:
+                return
+            test(result)
+            if verbosity > 1:
+                stream.write('{} done\n'.format(test.id()))
+
+    start = time.time()
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    merged = unittest.TextTestResult(unittest.runner._WritelnDecorator(stream), True, verbosity)
+    for result in results:
+        merged.testsRun += result.testsRun
+        merged.failures.extend(result.failures)
+        merged.errors.extend(result.errors)
+        merged.skipped.extend(result.skipped)
+        merged.expectedFailures.extend(result.expectedFailures)
+        merged.unexpectedSuccesses.extend(result.unexpectedSuccesses)
+    merged.printErrors()
+    stream.write('{}\nRan {} tests in {:.1f}s with {} browsers\n\n{}\n'.format(
+        unittest.TextTestResult.separator2, merged.testsRun, elapsed, workers,
+        'OK' if merged.wasSuccessful() else 'FAILED (failures={}, errors={})'.format(
+            len(merged.failures), len(merged.errors))))
+    return merged
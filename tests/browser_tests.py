@@ -1,18 +1,22 @@
 #!/usr/bin/env python
 
-from selenium import webdriver
 # from selenium.common.exceptions import WebDriverException
 # from selenium.webdriver.common.by import By
 # from selenium.common.exceptions import TimeoutException
-# from selenium.webdriver.support.ui import WebDriverWait
-# from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select
 
+import argparse
+import atexit
+import sys
 from os import environ
-from time import sleep
-from unittest import TestCase, main
+from unittest import TestCase, TestLoader
+
+from browser_pool import BrowserPool, PageTimings, load, run_sharded, wait_for
 
 BASE = 'http://CANONICAL.DNSNAME.v-studios.com'
+RESULTS_TITLE = u'Property Search - Results | Trade to Travel'
+DEFAULT_BROWSERS = 4
 
 # NOTE: we don't commit passwords to code, so for authenticated test to pass,
 # set your environment vars:
@@ -26,6 +30,37 @@ BASE = 'http://CANONICAL.DNSNAME.v-studios.com'
 # In many tests, we can't compare full text as the text is Windows chars using
 # \xa0 for space and similar \xe2 for dash
 
+# Browsers are shared by all tests; run as a script, the pool is sized to
+# the number of browsers the suite is sharded across.
+POOL = BrowserPool()
+TIMINGS = PageTimings()
+atexit.register(POOL.close)
+
+
+class BrowserTestCase(TestCase):
+    """TestCase that borrows a browser from POOL, reset after each test."""
+
+    def open(self, url):
+        """Borrow a browser as self.browser and load url, recording timings."""
+        self.browser = POOL.acquire()
+        self.addCleanup(POOL.release, self.browser)
+        load(self.browser, url, TIMINGS)
+
+    def wait(self, condition, description):
+        """Wait for condition(browser), recording how long it took."""
+        return wait_for(self.browser, condition, description, timings=TIMINGS)
+
+    def switch_to_new_window(self, old_handles):
+        """Wait for a window not in old_handles to open and switch to it."""
+        handles = self.wait(
+            lambda b: [h for h in b.window_handles if h not in old_handles],
+            'new window')
+        self.browser.switch_to.window(handles[0])
+
+    def wait_for_results(self):
+        """Wait for a search to land on the results page."""
+        self.wait(EC.title_is(RESULTS_TITLE), 'search results')
+
 
 ###############################################################################
 # Public/Anonymous pages
@@ -33,13 +68,11 @@ BASE = 'http://CANONICAL.DNSNAME.v-studios.com'
 
 # Home page
 
-class TestHome(TestCase):
+class TestHome(BrowserTestCase):
     def setUp(self):
         self.url = BASE + '/'
         self.title = 'Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
@@ -60,13 +93,11 @@ class TestHome(TestCase):
 
 # Who We Are
 
-class TestWhoWeAre_AboutUs(TestCase):
+class TestWhoWeAre_AboutUs(BrowserTestCase):
     def setUp(self):
         self.url = BASE + '/luxury-home-exchange.asp'
         self.title = 'Who We Are | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
@@ -93,40 +124,34 @@ class TestWhoWeAre_AboutUs(TestCase):
         self.assertIn('Washington, District of Columbia', self.browser.title)
 
 
-class TestWhoWeAre_OurStory(TestCase):
+class TestWhoWeAre_OurStory(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/trade-to-travel-story.asp'
         self.title = u'Our Story | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestWhoWeAre_Testimonials(TestCase):
+class TestWhoWeAre_Testimonials(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/testimonials-referrals.asp'
         self.title = u'Testimonials | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestWhoWeAre_News(TestCase):
+class TestWhoWeAre_News(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/trade-to-travel-newsletter.asp'
         self.title = u'Newsletter Archives | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
@@ -134,31 +159,17 @@ class TestWhoWeAre_News(TestCase):
 
 # How We Work
 
-class TestHowWeWork_MemberInfo(TestCase):
+class TestHowWeWork_MemberInfo(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/luxury-property-exchange.asp'
         self.title = u'How We Work | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
     def testFAQsRevealConceal(self):
-        # TODO: use expected_condition and maybe
-        # visibility_of_element_located_by to wait for reveal or
-        # conceal to finish before counting (in)visible answers.
-        #
-        # No invisibility check for selenium object;
-        # this only waits for the first (?) to become invisible
-        #  wait = WebDriverWait(self.browser, 10)
-        #  wait.until(EC.invisibility_of_element_located((By.CLASS_NAME, 'hidden')))
-        # We can pass the answer object here
-        #  wait = WebDriverWait(self.browser, 10)
-        #  wait.until(EC.visibility_of(answers[3]))
-        # See http://stackoverflow.com/questions/7781792/selenium-waitforelement
         # Should be more clever finding FAQ and Answer pairs.
         # Could also use: answer[0].get_attribute('style')
 
@@ -171,64 +182,54 @@ class TestHowWeWork_MemberInfo(TestCase):
         # Reveal
         for faq in faqs:
             faq.click()     # open
-        sleep(1)            # hack: make take a sec to reveal
-        displayed = [a for a in answers if a.is_displayed()]
-        self.assertEqual(len(displayed), 4)
+        # The reveal is animated, so wait for it to finish rather than count
+        # answers part way through; a timeout fails the test.
+        self.wait(lambda b: all(a.is_displayed() for a in answers), 'FAQ answers revealed')
         # Conceal again
         for faq in faqs:
             faq.click()     # close
-        sleep(1)                # hack: may take a sec to conceal
-        displayed = [a for a in answers if a.is_displayed()]
-        self.assertEqual(len(displayed), 0)
+        self.wait(lambda b: not any(a.is_displayed() for a in answers), 'FAQ answers concealed')
 
 
-class TestHowWeWork_MemberApplication(TestCase):
+class TestHowWeWork_MemberApplication(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/MembershipAppOnline.asp'
         self.title = u'Membership Application | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestHowWeWork_FreeTial(TestCase):
+class TestHowWeWork_FreeTial(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/membership-information.asp'
         self.title = u'Free Trial Membership | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestHowWeWork_ReferralReward(TestCase):
+class TestHowWeWork_ReferralReward(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/ReferReward.asp'
         self.title = u'Referral Rewards | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestHowWeWork_WhyTTT(TestCase):
+class TestHowWeWork_WhyTTT(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/luxury-travel-club.asp'
         self.title = u'Why Trade to Travel? | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
@@ -236,14 +237,12 @@ class TestHowWeWork_WhyTTT(TestCase):
 
 # Properties - Search
 
-class TestProperties_Search(TestCase):
+class TestProperties_Search(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/vacation-property-search.asp'
         self.title = u'Property Search | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
@@ -252,10 +251,9 @@ class TestProperties_Search(TestCase):
         # Can't yet find the search button as it has no link text, just img
         self.browser.find_element_by_id('txtPropCode').send_keys('T2731')
         self.browser.find_element_by_xpath('//table/tbody/tr/td/a').click()
+        self.wait_for_results()
         self.assertEqual(self.browser.find_element_by_id('page-title').text,
                          u'PROPERTY SEARCH RESULTS')
-        self.assertEqual(self.browser.title,
-                         u'Property Search - Results | Trade to Travel')
 
     def testSearchResultInfoRent(self):
         # Verify the "Click here for more info..." and "Rent This Property"
@@ -263,34 +261,28 @@ class TestProperties_Search(TestCase):
         # We do NOT fill in the Rent info request form!
         self.browser.find_element_by_id('txtPropCode').send_keys('T2731')
         self.browser.find_element_by_xpath('//table/tbody/tr/td/a').click()
+        self.wait_for_results()
         # This pops a new window, save ours before switching
         this_window = self.browser.current_window_handle
         self.browser.find_element_by_partial_link_text(
             'Click here for more information').click()
         # Why doesn't this work: self.browser.switch_to_window('_blank')
-        for w in self.browser.window_handles:
-            if w != self.browser.current_window_handle:
-                self.browser.switch_to_window(w)
-                break
+        self.switch_to_new_window([this_window])
+        self.wait(EC.title_contains('#T2731'), 'property window')
         self.assertIn('Barcelona', self.browser.title)
-        self.assertIn('#T2731', self.browser.title)
         self.browser.close()
         self.browser.switch_to.window(this_window)
         # Seems odd we don't need to be authenticated to do the request
         self.browser.find_element_by_link_text('RENT THIS PROPERTY').click()
-        for w in self.browser.window_handles:
-            if w != self.browser.current_window_handle:
-                self.browser.switch_to_window(w)
-                break
-        self.assertEqual(self.browser.title, 'Information Request')
+        self.switch_to_new_window([this_window])
+        self.wait(EC.title_is('Information Request'), 'information request window')
 
     def testSearchKeywords(self):
         self.browser.find_element_by_id('txtKeywords').send_keys('barcelona')
         self.browser.find_element_by_id('btnReport').click()
+        self.wait_for_results()
         self.assertEqual(self.browser.find_element_by_id('page-title').text,
                          u'PROPERTY SEARCH RESULTS')
-        self.assertEqual(self.browser.title,
-                         u'Property Search - Results | Trade to Travel')
 
     def testSearchPropType(self):
         proptypes = Select(self.browser.find_element_by_id('cboPropType'))
@@ -298,10 +290,9 @@ class TestProperties_Search(TestCase):
         proptypes.select_by_visible_text('Islands')
         proptypes.select_by_visible_text('Metropolitan')
         self.browser.find_element_by_id('btnReport').click()
+        self.wait_for_results()
         self.assertEqual(self.browser.find_element_by_id('page-title').text,
                          u'PROPERTY SEARCH RESULTS')
-        self.assertEqual(self.browser.title,
-                         u'Property Search - Results | Trade to Travel')
 
     def testSearchManySelections(self):
         # I should be testing search on individual fields:
@@ -325,72 +316,61 @@ class TestProperties_Search(TestCase):
         if not btn.is_selected():
             btn.click()
         self.browser.find_element_by_id('btnReport').click()
+        self.wait_for_results()
         self.assertEqual(self.browser.find_element_by_id('page-title').text,
                          u'PROPERTY SEARCH RESULTS')
-        self.assertEqual(self.browser.title,
-                         u'Property Search - Results | Trade to Travel')
 
 
-class TestProperties_SampleAvailabilities(TestCase):
+class TestProperties_SampleAvailabilities(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/vacation-properties-future.asp'
         self.title = u'Availabilities | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestProperties_HotelsResortsSpas(TestCase):
+class TestProperties_HotelsResortsSpas(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/hotel-exchange.asp'
         self.title = u'Hotels, Resorts & Spas | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestProperties_ForSale(TestCase):
+class TestProperties_ForSale(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/browse-properties-forsale.asp'
         self.title = u'Sale | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestProperties_ForCharities(TestCase):
+class TestProperties_ForCharities(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/charities.asp'
         self.title = u'For Charities | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestProperties_FractionalOwnership(TestCase):
+class TestProperties_FractionalOwnership(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/BrowseFractional.asp'
         self.title = u'Fractional Ownership| Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
@@ -399,41 +379,35 @@ class TestProperties_FractionalOwnership(TestCase):
 # TODO: No, this isn't how we test footer: we need to find links on the main
 # (or other) page and then click them and check the title.
 
-class TestFooter_SiteMap(TestCase):
+class TestFooter_SiteMap(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/site-map.asp'
         self.title = u'Sitemap | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestFooter_MoneyBackGuarantee(TestCase):
+class TestFooter_MoneyBackGuarantee(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/money-back-guarantee.asp'
         self.title = 'Money-Back Guarantee | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertEqual(self.browser.title, self.title)
 
 
-class TestPropertiesViewPretty(TestCase):
+class TestPropertiesViewPretty(BrowserTestCase):
     # Accessible from results of various searches.
     # Just try one for now.
     def setUp(self):
         self.url = BASE + '/propertiesViewPretty.asp?property_ID=2573'
         self.in_title = u'Barcelona'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def testPageTitle(self):
         self.assertIn(self.in_title, self.browser.title)
@@ -442,14 +416,12 @@ class TestPropertiesViewPretty(TestCase):
 ###############################################################################
 # Members: require authentication
 
-class TestMemberLogin(TestCase):
+class TestMemberLogin(BrowserTestCase):
 
     def setUp(self):
         self.url = BASE + '/member-login.asp'
         self.title = u'Login | Trade to Travel'
-        self.browser = webdriver.Firefox()
-        self.addCleanup(self.browser.quit)
-        self.browser.get(self.url)
+        self.open(self.url)
 
     def _login(self):
         # Helper function since we'll login for every page
@@ -515,11 +487,44 @@ class TestMemberLogin(TestCase):
 ###############################################################################
 # Main: convenience if run directly, e.g., from Makefile
 
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description="Run the browser tests, sharded across a pool of browsers."
+    )
+    parser.add_argument(
+        'tests', nargs='*',
+        help="Test classes or methods, e.g. TestHome.testPageTitle. Default: all.",
+    )
+    parser.add_argument(
+        '-n', '--browsers', default=DEFAULT_BROWSERS, type=int,
+        help="Browsers to run in parallel. Default: {}.".format(DEFAULT_BROWSERS),
+    )
+    parser.add_argument(
+        '-t', '--timings',
+        help="Save per-page load and wait timings to this JSON file.",
+    )
+    return parser
+
+
 if __name__ == '__main__':
     """You could run all tests by invoking this file.
 
     Or you can be selective like::
-      py.test tests/browser_tests.py::TestHowWeWork_MemberInfo
+      tests/browser_tests.py -n 1 TestHowWeWork_MemberInfo
       py.test tests/browser_tests.py::TestProperties_Search::testSearchManySelections
     """
-    main(verbosity=2)
+    args = init_parser().parse_args()
+    module = sys.modules[__name__]
+    loader = TestLoader()
+    if args.tests:
+        suite = loader.loadTestsFromNames(args.tests, module)
+    else:
+        suite = loader.loadTestsFromModule(module)
+    POOL.size = args.browsers
+    result = run_sharded(suite, args.browsers, sys.stderr)
+    print('\n'.join(TIMINGS.report()))
+    if args.timings:
+        TIMINGS.save(args.timings)
+    sys.exit(not result.wasSuccessful())
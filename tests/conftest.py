@@ -0,0 +1,6 @@
+import sys
+
+# The asyncio proxy is Python 3.6+; tox runs the rest of the suite on 2.7.
+collect_ignore = []
+if sys.version_info < (3, 6):
+    collect_ignore.append('asyncproxy_test.py')
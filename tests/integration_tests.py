@@ -5,17 +5,39 @@ Integration tests run by CircleCI after unit & functional tests are finished.
 
 Queries a Diazo server running on the host to ensure a set of target endpoints return 200's.
 Exits with status code 0 if all return 200's, else status code 1.
+
+With --load, instead hammers the same URLs from --concurrency threads for
+--duration seconds, each thread reusing a keep-alive connection, and reports
+throughput and p50/p95/p99 latency per URL. Use it to measure the nginx XSLT
+path under load before a deploy::
+
+  .venv2/bin/python tests/integration_tests.py --load -c 16 -d 60
+
+Both modes also collect the Server-Timing headers the paster filter and
+nginx send (origin, parse, xslt, tttdiazo, total, in ms, and the cache
+status) and report them, so a slow page can be pinned on the origin or on
+theming.
 """
 import argparse
 import logging
+import math
 import os
 import sys
+import threading
+from collections import defaultdict
+from time import sleep
+from timeit import default_timer
 
-from requests import get
+from requests import RequestException, Session, get
 
 URL_FILE_NAME = 'integration_tests_urls.txt'
 DEFAULT_PORT = 5000
 DEFAULT_HOST = 'localhost'
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DURATION = 30
+DEFAULT_INTERVAL = 5
+PERCENTILES = (50, 95, 99)
+SERVER_TIMING = 'Server-Timing'
 
 # Start log.
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -38,23 +60,221 @@ def init_parser():
         default=DEFAULT_PORT,
         help=("Diazo server's port. Default: {}.".format(DEFAULT_PORT)),
     )
+    parser.add_argument(
+        '-L', '--load',
+        action='store_true',
+        help="Run a load test instead of the 200-status checks.",
+    )
+    parser.add_argument(
+        '-c', '--concurrency',
+        default=DEFAULT_CONCURRENCY, type=int,
+        help=("Load test client threads. Default: {}.".format(DEFAULT_CONCURRENCY)),
+    )
+    parser.add_argument(
+        '-d', '--duration',
+        default=DEFAULT_DURATION, type=float,
+        help=("Load test seconds. Default: {}.".format(DEFAULT_DURATION)),
+    )
+    parser.add_argument(
+        '-i', '--interval',
+        default=DEFAULT_INTERVAL, type=float,
+        help=("Seconds between load test progress lines. Default: {}.".format(DEFAULT_INTERVAL)),
+    )
     return parser
 
 
+def read_urls():
+    """Return the URL paths listed in the URL file, skipping blank lines."""
+    tests_dir = os.path.dirname(__file__)
+    with open(os.path.join(tests_dir, URL_FILE_NAME), 'r') as _f:
+        return [i.strip() for i in _f.readlines() if i.strip()]
+
+
+def percentile(values, pct):
+    """Return the nearest-rank pct'th percentile of sorted values."""
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+def parse_server_timing(value):
+    """Return [(name, dur ms or None, desc or None)] from a Server-Timing value.
+
+    Several headers arrive joined by commas, which is also the separator
+    between metrics, so this reads either.
+    """
+    metrics = []
+    for metric in value.split(','):
+        params = [p.strip() for p in metric.split(';')]
+        if not params[0]:
+            continue
+        dur = desc = None
+        for param in params[1:]:
+            key, _, val = param.partition('=')
+            val = val.strip('"')
+            if key == 'dur':
+                try:
+                    dur = float(val)
+                except ValueError:
+                    pass
+            elif key == 'desc':
+                desc = val
+        metrics.append((params[0], dur, desc))
+    return metrics
+
+
+class ServerTimings(object):
+    """Thread-safe collection of Server-Timing durations and descriptions.
+
+    Durations are kept per metric, e.g. 'xslt', across all URLs; a metric
+    without a duration, like 'cache', has its descriptions counted.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def add(self, response):
+        value = response.headers.get(SERVER_TIMING)
+        if not value:
+            return
+        with self._lock:
+            for name, dur, desc in parse_server_timing(value):
+                if dur is not None:
+                    self.durations[name].append(dur)
+                elif desc:
+                    self.counts[name][desc] += 1
+
+    def report(self):
+        """Return report lines: percentiles per metric, then counts."""
+        if not self.durations and not self.counts:
+            return ['No Server-Timing headers']
+        lines = ['{:20s} {:>7s}'.format('server-timing', 'count') +
+                 ''.join(' {:>8s}'.format('p{}ms'.format(p)) for p in PERCENTILES)]
+        for name, values in sorted(self.durations.items()):
+            values = sorted(values)
+            lines.append('{:20s} {:7d}'.format(name, len(values)) +
+                         ''.join(' {:8.1f}'.format(percentile(values, p)) for p in PERCENTILES))
+        for name, counts in sorted(self.counts.items()):
+            lines.append('{:20s} {}'.format(name, ', '.join(
+                '{} {}'.format(desc, n) for desc, n in sorted(counts.items()))))
+        return lines
+
+
+def run_load(url_root, urls, concurrency, duration, interval=DEFAULT_INTERVAL,
+             server_timings=None, headers=None):
+    """Request urls round-robin from concurrent threads for duration seconds.
+
+    Each thread keeps its own Session so its connection stays alive between
+    requests, as a browser's would. Progress is logged every interval seconds.
+    Responses' Server-Timing headers are added to server_timings if given,
+    and headers, a dict, are sent with every request.
+
+    :returns: `tuple` (timings, errors, elapsed): per-URL lists of seconds,
+              per-URL counts of failures, and total wall-clock seconds.
+    """
+    if not urls:
+        log.error('No URLs to load.')
+        sys.exit(1)
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    start = default_timer()
+    deadline = start + duration
+
+    def worker(offset):
+        session = Session()
+        session.headers.update(headers or {})
+        i = offset
+        while default_timer() < deadline:
+            url = urls[i % len(urls)]
+            i += 1
+            began = default_timer()
+            try:
+                response = session.get(url_root + url)
+                ok = response.status_code == 200
+                if server_timings is not None:
+                    server_timings.add(response)
+            except RequestException:
+                ok = False
+            took = default_timer() - began
+            with lock:
+                timings[url].append(took)
+                if not ok:
+                    errors[url] += 1
+        session.close()
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    done = 0
+    while default_timer() < deadline:
+        sleep(min(interval, max(deadline - default_timer(), 0)))
+        with lock:
+            total = sum(len(v) for v in timings.values())
+        log.info('{:6.1f}s {:7d} requests {:8.1f} req/s'.format(
+            default_timer() - start, total, (total - done) / float(interval)))
+        done = total
+    for thread in threads:
+        thread.join()
+    return timings, errors, default_timer() - start
+
+
+def report_load(timings, errors, elapsed):
+    """Print throughput and latency percentiles; return them as a dict."""
+    total = sum(len(v) for v in timings.values())
+    summary = {'requests': total,
+               'errors': sum(errors.values()),
+               'seconds': elapsed,
+               'rps': total / elapsed if elapsed else 0,
+               'urls': {}}
+    header = '{:40s} {:>7s} {:>6s}'.format('url', 'count', 'errors')
+    header += ''.join(' {:>8s}'.format('p{}ms'.format(p)) for p in PERCENTILES)
+    print(header)
+    for url in sorted(timings):
+        values = sorted(timings[url])
+        stats = dict(('p{}'.format(p), percentile(values, p)) for p in PERCENTILES)
+        stats.update(count=len(values), errors=errors[url])
+        summary['urls'][url] = stats
+        line = '{:40s} {:7d} {:6d}'.format(url, len(values), errors[url])
+        line += ''.join(' {:8.1f}'.format(stats['p{}'.format(p)] * 1000) for p in PERCENTILES)
+        print(line)
+    print('{} requests, {} errors in {:.1f}s: {:.1f} req/s'.format(
+        total, summary['errors'], elapsed, summary['rps']))
+    return summary
+
+
+def main_load(args):
+    url_root = 'http://{}:{}'.format(args.hostname, args.port)
+    server_timings = ServerTimings()
+    timings, errors, elapsed = run_load(url_root, read_urls(), args.concurrency,
+                                        args.duration, args.interval, server_timings)
+    summary = report_load(timings, errors, elapsed)
+    print('\n'.join(server_timings.report()))
+    sys.exit(1 if summary['errors'] else 0)
+
+
 def main(args):
     url_root = 'http://{}:{}'.format(args.hostname, args.port)
     # Read URL's out of the config file.
-    tests_dir = os.path.dirname(__file__)
-    with open(os.path.join(tests_dir, URL_FILE_NAME), 'r') as _f:
-        urls = [i.strip('\n') for i in _f.readlines()]
+    urls = read_urls()
     # For each URL, make a GET request.
     #   If any response is not a 200, note that in the log and mark this run as a failure.
     all_200 = True
+    server_timings = ServerTimings()
     for url in urls:
-        status_code = get(url_root + url).status_code
+        response = get(url_root + url)
+        status_code = response.status_code
+        server_timings.add(response)
+        log.info('{} {} {}'.format(status_code, url, response.headers.get(SERVER_TIMING, '')))
         if status_code != 200:
             log.warn('Got non-200 status code {} from {}.'.format(status_code, url))
             all_200 = False
+    for line in server_timings.report():
+        log.info(line)
     # If any responses weren't 200's, exit with status 1.
     if all_200 == False:
         log.error("Not all responses were 200's.")
@@ -75,4 +295,7 @@ if __name__ == '__main__':
     parser = init_parser()
     args = parser.parse_args()
     # Run.
-    main(args)
+    if args.load:
+        main_load(args)
+    else:
+        main(args)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from tttdiazo.logstats import OTHER, Follower, Histogram, LogStats, log_files, read
+
+ACCESS = ('1.2.3.4 - - [17/Oct/2016:10:00:00 +0000] "GET /charities.asp HTTP/1.1" 200 5120 '
+          '"-" "curl/7.50" rt=0.120 urt="0.100" ucs=-')
+STATIC = ('- - - [17/Oct/2016:10:00:01 +0000] "GET /styles/main.css HTTP/1.1" 200 99 '
+          '"-" "curl/7.50" rt=0.000 urt="-" ucs=-')
+CACHE = ('***17/Oct/2016:10:00:00 +0000 {} Cache-Control: - Expires: - '
+         '"GET /charities.asp?x=1 HTTP/1.1" (200) "curl/7.50" rt=0.001 urt="-"')
+XSLT = ('2016/10/17 10:00:00 [error] 123#0: *5 xmlParseChunk() failed, client: 127.0.0.1, '
+        'server: tttdiazo, request: "GET /charities.asp HTTP/1.1", host: "localhost"')
+
+
+class TestLogStats(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, name, lines, opener=open):
+        with opener(os.path.join(self.dir, name), 'wt') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+    def testHistogramPercentile(self):
+        hist = Histogram()
+        for ms in range(1, 101):
+            hist.add(ms / 1000.0)
+        self.assertAlmostEqual(hist.percentile(50), 0.050, delta=0.005)
+        self.assertAlmostEqual(hist.percentile(95), 0.095, delta=0.010)
+
+    def testRoutes(self):
+        self.write('nginx-access.log', [ACCESS, STATIC])
+        self.write('cache.log.1.gz', [CACHE.format('MISS')], gzip.open)
+        self.write('cache.log', [CACHE.format('HIT'), CACHE.format('STALE')])
+        self.write('nginx-xslt.log', [XSLT])
+        stats = LogStats()
+        for path, _ in log_files([self.dir]):
+            read(stats, path)
+        page = stats.routes['/charities.asp']
+        self.assertEqual(page.cache_requests, 3)
+        self.assertAlmostEqual(page.hit_ratio, 2 / 3.0)
+        self.assertAlmostEqual(page.origin.total, 0.100)
+        self.assertAlmostEqual(page.theming.total, 0.020)
+        self.assertEqual(page.errors, 1)
+        self.assertEqual(stats.routes['/styles/main.css'].origin.count, 0)
+        self.assertEqual(stats.unparsed, 0)
+        self.assertIn('/charities.asp', stats.report()[1])
+
+    def testMaxRoutes(self):
+        stats = LogStats(max_routes=1)
+        stats.add_access(ACCESS)
+        stats.add_access(STATIC)
+        self.assertEqual(sorted(stats.routes), [OTHER, '/charities.asp'])
+
+    def testFollowAcrossRotation(self):
+        path = os.path.join(self.dir, 'nginx-access.log')
+        self.write('nginx-access.log', [ACCESS])
+        follower = Follower(path)
+        with open(path, 'a') as f:
+            f.write(STATIC + '\n')
+        os.rename(path, path + '.1')
+        self.write('nginx-access.log', [ACCESS])
+        self.assertEqual(list(follower.lines()), [STATIC, ACCESS])
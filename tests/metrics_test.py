@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from webob import Request
+
+from tttdiazo.logstats import Histogram
+from tttdiazo.metrics import LogMetrics, Metric, NginxRSS, app_factory, parse_stub_status, render
+from tttdiazo.themecache import ThemeCacheMiddleware
+
+from logstats_test import ACCESS, CACHE
+from themecache_test import RULES, THEME, content_app
+
+STUB_STATUS = """Active connections: 3
+server accepts handled requests
+ 10 10 42
+Reading: 0 Writing: 1 Waiting: 2
+"""
+
+
+def samples(metrics):
+    """Return {sample line name and labels: value} from rendered metrics."""
+    lines = render(metrics).splitlines()
+    return dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def testRender(self):
+        hist = Histogram()
+        for seconds in (0.001, 0.02, 3):
+            hist.add(seconds)
+        metric = Metric('t_seconds', 'histogram', 'Test.').add_histogram(hist, route='/a"b')
+        text = render([metric])
+        self.assertIn('# TYPE t_seconds histogram\n', text)
+        self.assertIn('t_seconds_bucket{le="0.005",route="/a\\"b"} 1.0\n', text)
+        self.assertIn('t_seconds_bucket{le="+Inf",route="/a\\"b"} 3.0\n', text)
+        self.assertIn('t_seconds_count{route="/a\\"b"} 3.0\n', text)
+
+    def testStubStatus(self):
+        self.assertEqual(parse_stub_status(STUB_STATUS),
+                         dict(active=3, accepts=10, handled=10, requests=42,
+                              reading=0, writing=1, waiting=2))
+        self.assertIsNone(parse_stub_status('<html>404</html>'))
+
+    def testLogsSinceStart(self):
+        access = os.path.join(self.dir, 'nginx-access.log')
+        with open(access, 'w') as f:
+            f.write(ACCESS + '\n')
+        collector = LogMetrics(self.dir)
+        self.assertEqual(samples(collector())['tttdiazo_microcache_hit_ratio'], '0.0')
+        with open(access, 'a') as f:
+            f.write(ACCESS + '\n')
+        with open(os.path.join(self.dir, 'cache.log'), 'w') as f:
+            f.write(CACHE.format('HIT') + '\n')
+        collector()     # cache.log appeared: followed from its end
+        with open(os.path.join(self.dir, 'cache.log'), 'a') as f:
+            f.write(CACHE.format('HIT') + '\n' + CACHE.format('MISS') + '\n')
+        found = samples(collector())
+        self.assertEqual(found['tttdiazo_requests_total{route="/charities.asp"}'], '1.0')
+        self.assertEqual(found['tttdiazo_origin_duration_seconds_bucket'
+                               '{le="0.1",route="/charities.asp"}'], '1.0')
+        self.assertEqual(found['tttdiazo_microcache_hits_total{route="/charities.asp"}'], '1.0')
+        self.assertEqual(found['tttdiazo_microcache_hit_ratio'], '0.5')
+
+    def testNginxRSS(self):
+        pid_file = os.path.join(self.dir, 'nginx.pid')
+        with open(pid_file, 'w') as f:
+            f.write('{}\n'.format(os.getpid()))
+        found = samples(NginxRSS(pid_file)())
+        key = 'nginx_rss_bytes{{pid="{}",process="master"}}'.format(os.getpid())
+        self.assertGreater(float(found[key]), 0)
+        self.assertEqual(samples(NginxRSS(os.path.join(self.dir, 'none'))()), {})
+
+    def testPasterFilterCounters(self):
+        rules = os.path.join(self.dir, 'rules.xml')
+        with open(rules, 'w') as f:
+            f.write(RULES)
+        with open(os.path.join(self.dir, 'theme.html'), 'w') as f:
+            f.write(THEME.format('Counted'))
+        theme = ThemeCacheMiddleware(content_app, {}, rules, output_cache=True)
+        Request.blank('/').get_response(theme)
+        Request.blank('/').get_response(theme)
+        text = Request.blank('/').get_response(app_factory({})).text
+        self.assertIn('tttdiazo_output_cache_hits_total 1.0\n', text)
+        self.assertIn('tttdiazo_theme_recompiles_total 1.0\n', text)
+        self.assertIn('process_resident_memory_bytes ', text)
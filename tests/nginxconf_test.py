@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import os
+import re
+import shutil
+import tempfile
+from unittest import TestCase
+
+from tttdiazo.nginxconf import (LOCATIONS, NOTHEME_MAP, TemplateRecipe, notheme_paths,
+                                path_regex, render_locations, render_map, render_template)
+from tttdiazo.nginxworkers import WORKERS, render_workers, size
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUILDOUT_DIR = os.path.dirname(HERE)
+
+
+class TestNginxConf(TestCase):
+    def assertMatches(self, token, matching, other):
+        regex = re.compile(path_regex(token))
+        for uri in matching:
+            self.assertTrue(regex.search(uri), '{} should match {}'.format(token, uri))
+        for uri in other:
+            self.assertFalse(regex.search(uri), '{} should not match {}'.format(token, uri))
+
+    def testPathRegexFollowsDiazo(self):
+        self.assertMatches('/news/', ['/news', '/news/'], ['/news/a', '/a/news'])
+        self.assertMatches('/news', ['/news', '/news/a'], ['/newsy', '/a/news'])
+        self.assertMatches('news/', ['/news', '/a/news/'], ['/news/a'])
+        self.assertMatches('news', ['/news', '/a/news/b'], ['/newsy', '/anews'])
+        self.assertMatches('/sitemap.xml', ['/sitemap.xml'], ['/sitemapxxml'])
+
+    def testRulesNotheme(self):
+        self.assertEqual(notheme_paths(os.path.join(BUILDOUT_DIR, 'rules.xml')),
+                         ['/sitemap.xml'])
+
+    def testTemplate(self):
+        with open(os.path.join(BUILDOUT_DIR, 'templates', 'nginx.conf.in')) as f:
+            template = f.read()
+        output = render_template(template, {
+            NOTHEME_MAP: render_map(['/sitemap.xml', '/news/']),
+            LOCATIONS: render_locations(['/', '/charities.asp']),
+            WORKERS: render_workers(size(2, 4))})
+        self.assertNotIn(LOCATIONS, output)
+        self.assertIn('worker_processes     2;\n', output)
+        self.assertIn('location = /charities.asp {', output)
+        self.assertIn('try_files /index.html @themed;', output)
+        self.assertIn(r'~^/sitemap\.xml(/|$)  1;', output)
+        self.assertIn('        /news  1;\n        /news/  1;\n', output)
+        self.assertIn('location @unthemed {', output)
+        self.assertEqual(output.count('{'), output.count('}'))
+
+    def testProxiesKeepConnections(self):
+        with open(os.path.join(BUILDOUT_DIR, 'templates', 'nginx.conf.in')) as f:
+            template = f.read()
+        output = render_template(template, {
+            NOTHEME_MAP: render_map([]),
+            LOCATIONS: render_locations(['/']),
+            WORKERS: render_workers(size(1, 1))})
+        passes = re.findall(r'proxy_pass (\S+);', output)
+        self.assertEqual(set(passes), set(['http://tttdiazo_origin', 'http://tttdiazo_theming']))
+        # Every proxied location clears Connection so its upstream may keep it open.
+        self.assertEqual(output.count('proxy_set_header Connection "";'), len(passes))
+        self.assertIn('proxy_http_version 1.1;', output)
+        # Upstream names aren't host names, so every hop rewrites redirects.
+        self.assertEqual(output.count('proxy_redirect '), len(passes))
+        self.assertIn('keepalive ${:origin_keepalive};', output)
+        # The front end reaches the tttdiazo server where buildout says, its
+        # unix socket by default.
+        self.assertIn('server ${:theming_server};', output)
+        self.assertIn('listen       unix:${:theming_socket};', output)
+
+    def testRecipeReadsInputWhenInstalled(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        options = {'port': '8888', 'input': os.path.join(tmp, 'parts', 'nginx.conf.in'),
+                   'output': os.path.join(tmp, 'etc', 'nginx.conf')}
+        buildout = {'buildout': {'directory': tmp}, 'nginx-conf': options}
+        # Created before the template part has written its input.
+        recipe = TemplateRecipe(buildout, 'nginx-conf', options)
+        os.mkdir(os.path.join(tmp, 'parts'))
+        with open(options['input'], 'w') as f:
+            f.write('listen ${:port};\nroot ${buildout:directory};\nset $x "$${:y}";\n')
+        self.assertEqual(recipe.install(), [options['output']])
+        with open(options['output']) as f:
+            self.assertEqual(f.read(), 'listen 8888;\nroot {};\nset $x "${{:y}}";\n'.format(tmp))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from tttdiazo.nginxworkers import (add_reuseport, affinity_masks, aws_instance_type, machine,
+                                   resize, size)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUILDOUT_DIR = os.path.dirname(HERE)
+
+CONF = """worker_processes  1;
+
+events {
+    worker_connections  1024;
+}
+
+http {
+    server {
+        listen       8888;
+        listen       unix:/tmp/tttdiazo.sock;
+        # listen 80;
+    }
+    server {
+        listen 443 default_server;
+        listen 5000 default_server reuseport;
+    }
+}
+"""
+
+
+class TestNginxWorkers(TestCase):
+    def testSizeByCoresAndMemory(self):
+        sizing = size(4, 7.5)
+        self.assertEqual(sizing['workers'], 4)
+        self.assertEqual(sizing['connections'], 1920)
+        self.assertEqual(sizing['affinity'], ['0001', '0010', '0100', '1000'])
+        self.assertTrue(sizing['reuseport'])
+        single = size(1, 1)
+        self.assertEqual((single['workers'], single['connections']), (1, 1024))
+        self.assertIsNone(single['affinity'])
+        self.assertFalse(single['reuseport'])
+
+    def testOverrides(self):
+        sizing = size(4, 64, workers='2', connections='4096', affinity='off', reuseport='on')
+        self.assertEqual((sizing['workers'], sizing['connections']), (2, 4096))
+        self.assertIsNone(sizing['affinity'])
+        self.assertTrue(sizing['reuseport'])
+        self.assertEqual(size(2, 1024)['connections'], 16384)
+        # More workers than cores wrap around them.
+        self.assertEqual(affinity_masks(3, 2), ['01', '10', '01'])
+
+    def testInstanceType(self):
+        self.assertEqual(machine('c4.2xlarge'), (8, 15))
+        self.assertEqual(aws_instance_type(os.path.join(BUILDOUT_DIR, 'prod.ini')), 't2.micro')
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.assertIsNone(aws_instance_type(os.path.join(tmp, 'none.ini')))
+
+    def testReuseport(self):
+        conf = add_reuseport(CONF)
+        self.assertIn('listen       8888 reuseport;', conf)
+        self.assertIn('# listen 80;', conf)
+        self.assertIn('listen       unix:/tmp/tttdiazo.sock;', conf)
+        self.assertIn('listen 443 default_server reuseport;', conf)
+        self.assertEqual(conf.count('reuseport'), 3)
+
+    def testResize(self):
+        conf = resize(CONF, size(2, 4))
+        self.assertTrue(conf.startswith('worker_processes     2;\nworker_cpu_affinity  01 10;\n'))
+        self.assertIn('worker_connections  2048;', conf)
+        self.assertEqual(conf.count('worker_processes'), 1)
+        self.assertIn('listen       8888 reuseport;', conf)
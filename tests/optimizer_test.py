@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from diazo.compiler import compile_theme
+from lxml import etree
+
+from tttdiazo.optimizer import KEY_NAME, check, optimize, rewrite
+from tttdiazo.xslstore import XSLStore
+
+RULES = """<?xml version="1.0" encoding="utf-8"?>
+<rules xmlns="http://namespaces.plone.org/diazo"
+       xmlns:css="http://namespaces.plone.org/diazo/css">
+  <theme href="theme.html" />
+  <replace css:theme-children="#main" css:content-children="#content" />
+  <replace css:theme="title" css:content="title" />
+</rules>
+"""
+
+THEME = """<html><head><title>theme</title></head>
+<body><div id="main">theme</div></body></html>
+"""
+
+PAGES = [('/a.asp', b'<html><head><title>A</title></head>'
+                    b'<body><div id="content">origin <b>a</b></div></body></html>'),
+         ('/b.asp', b'<html><body><p>no content div</p></body></html>')]
+
+
+class TestOptimizer(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.rules = os.path.join(self.dir, 'rules.xml')
+        with open(self.rules, 'w') as f:
+            f.write(RULES)
+        with open(os.path.join(self.dir, 'theme.html'), 'w') as f:
+            f.write(THEME)
+
+    def testRewrite(self):
+        self.assertEqual(rewrite("//*[@id = 'content']/node()"),
+                         "key('{}', 'content')/node()".format(KEY_NAME))
+        self.assertEqual(rewrite("//head/title"), "/html/head/title")
+        self.assertEqual(rewrite("div//*[@id='x']"), "div//*[@id='x']")
+        self.assertEqual(rewrite("//bodyguard"), "//bodyguard")
+
+    def testSameOutput(self):
+        original = compile_theme(self.rules)
+        optimized, changes = optimize(original)
+        self.assertTrue(any(KEY_NAME in change for change in changes))
+        self.assertEqual(check(original, optimized, PAGES), [])
+
+    def testCheckCatchesDifferences(self):
+        original = compile_theme(self.rules)
+        broken, _ = optimize(original)
+        for element in broken.iter():
+            if KEY_NAME in (element.get('select') or ''):
+                element.set('select', "key('{}', 'nothing')".format(KEY_NAME))
+        self.assertEqual([route for route, diff in check(original, broken, PAGES)],
+                         ['/a.asp'])
+
+    def testStoreKeepsOptimizedApart(self):
+        store = XSLStore(os.path.join(self.dir, 'store'))
+        plain, _ = store.compile(self.rules)
+        optimized, compiled = store.compile(self.rules, optimize=True)
+        self.assertTrue(compiled)
+        self.assertNotEqual(plain, optimized)
+        self.assertIn(KEY_NAME, etree.tostring(etree.parse(optimized)).decode())
+
+    def testKeepsNamedTemplates(self):
+        xsl = etree.fromstring("""<xsl:stylesheet version="1.0"
+            xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+          <xsl:template match="p"><p><xsl:apply-templates/></p></xsl:template>
+          <xsl:template match="b" name="bold"><strong/></xsl:template>
+          <xsl:template match="i"><em>first</em></xsl:template>
+          <xsl:template match="b"><xsl:call-template name="bold"/></xsl:template>
+          <xsl:template match="i"><em>second</em></xsl:template>
+        </xsl:stylesheet>""").getroottree()
+        optimized, changes = optimize(xsl)
+        self.assertEqual(len(changes), 1)
+        self.assertIn('match="i"', changes[0])
+        result = etree.XSLT(optimized)(etree.fromstring('<p><b/><i/></p>'))
+        self.assertEqual(etree.tostring(result), b'<p><strong/><em>second</em></p>')
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+from webob import Request
+
+from tttdiazo.origin import INDEX, OriginApp, pad, save_fixture
+
+
+class TestOrigin(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        index = {}
+        save_fixture(self.dir, index, '/charities.asp', 200,
+                     {'Content-Type': 'text/html; charset=utf-8', 'Set-Cookie': 'x=1'},
+                     b'<html><body><p>recorded</p></body></html>')
+        with open(self.dir + '/' + INDEX, 'w') as f:
+            json.dump(index, f)
+
+    def testReplaysFixture(self):
+        res = Request.blank('/charities.asp').get_response(OriginApp(fixtures=self.dir))
+        self.assertEqual(res.body, b'<html><body><p>recorded</p></body></html>')
+        self.assertNotIn('Set-Cookie', res.headers)
+
+    def testFallsBackToCanned(self):
+        res = Request.blank('/hotel-exchange.asp').get_response(OriginApp(fixtures=self.dir))
+        self.assertIn(b'Hotel Exchange | Trade to Travel', res.body)
+
+    def testSitemapIsXML(self):
+        res = Request.blank('/sitemap.xml').get_response(OriginApp())
+        self.assertEqual(res.headers['Content-Type'], 'text/xml')
+
+    def testPad(self):
+        body = pad(b'<html><body>x</body></html>', 1000)
+        self.assertTrue(len(body) >= 1000)
+        self.assertTrue(body.endswith(b'</body></html>'))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from webob import Request
+
+from tttdiazo.outputcache import LRUCache
+from tttdiazo.themecache import ThemeCacheMiddleware
+
+from themecache_test import CONTENT, RULES, THEME, content_app
+
+
+def cookie_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'),
+                              ('Set-Cookie', 'ASPSESSIONID=1')])
+    return [b'<html><body><div id="content">member</div></body></html>']
+
+
+class ExpiringApp(object):
+    """The same page each time, with a new Expires header."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] != '/':
+            return content_app(environ, start_response)
+        self.calls += 1
+        start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'),
+                                  ('Expires', str(self.calls))])
+        return [CONTENT]
+
+
+class TestLRUCache(TestCase):
+    def testEvictsLeastRecentlyUsed(self):
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.put('a', 'A', 4)
+        cache.put('b', 'B', 4)
+        cache.get('a')
+        cache.put('c', 'C', 4)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.bytes, 8)
+
+    def testExpires(self):
+        cache = LRUCache(max_bytes=10, ttl=-1)
+        cache.put('a', 'A', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.bytes, 0)
+
+
+class TestOutputCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.rules = os.path.join(self.dir, 'rules.xml')
+        with open(self.rules, 'w') as f:
+            f.write(RULES)
+        with open(os.path.join(self.dir, 'theme.html'), 'w') as f:
+            f.write(THEME.format('Cached'))
+
+    def testSecondRequestIsCached(self):
+        app = ThemeCacheMiddleware(content_app, {}, self.rules, output_cache=True)
+        first = Request.blank('/').get_response(app).text
+        second = Request.blank('/').get_response(app).text
+        self.assertIn('Cached', second)
+        self.assertEqual(first, second)
+        self.assertEqual(app.output_cache.hits, 1)
+
+    def testPathIsPartOfKey(self):
+        app = ThemeCacheMiddleware(content_app, {}, self.rules, output_cache=True)
+        Request.blank('/').get_response(app)
+        Request.blank('/?page=2').get_response(app)
+        self.assertEqual(app.output_cache.hits, 0)
+
+    def testHitHasCurrentHeaders(self):
+        app = ThemeCacheMiddleware(ExpiringApp(), {}, self.rules, output_cache=True)
+        first = Request.blank('/').get_response(app)
+        second = Request.blank('/').get_response(app)
+        self.assertEqual(app.output_cache.hits, 1)
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(second.content_type, first.content_type)
+        self.assertEqual(second.content_length, len(first.body))
+        self.assertEqual(second.headers['Expires'], '2')
+
+    def testSetCookieBypasses(self):
+        app = ThemeCacheMiddleware(cookie_app, {}, self.rules, output_cache=True)
+        Request.blank('/').get_response(app)
+        res = Request.blank('/').get_response(app)
+        self.assertEqual(len(app.output_cache), 0)
+        self.assertIn('member', res.text)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import requests
+
+from themecache_test import RULES, THEME
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A master with two workers whose pages say which process themed them.
+SERVER = """
+import os, sys, time
+from tttdiazo.prefork import server_runner
+from tttdiazo.themecache import ThemeCacheMiddleware
+
+def pid_app(environ, start_response):
+    if environ['PATH_INFO'] == '/slow':
+        time.sleep(1)
+    elif environ['PATH_INFO'] != '/':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'']
+    start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+    return ['<html><body><div id="content">{}</div></body></html>'.format(
+        os.getpid()).encode('utf-8')]
+
+server_runner(ThemeCacheMiddleware(pid_app, {}, sys.argv[1]), {}, host='127.0.0.1',
+              port=sys.argv[2], workers=2, reload_interval=0.2)
+"""
+PAGE_RE = re.compile(r'<title>(\w+)</title>.*<div id="main">(\d+)</div>', re.S)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestPrefork(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.rules = os.path.join(self.dir, 'rules.xml')
+        with open(self.rules, 'w') as f:
+            f.write(RULES)
+        self._write_theme('First')
+        self.url = 'http://127.0.0.1:{}/'.format(free_port())
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(HERE), HERE]))
+        self.master = subprocess.Popen([sys.executable, '-c', SERVER, self.rules,
+                                        self.url.split(':')[-1].strip('/')], env=env)
+        self.addCleanup(self._kill)
+
+    def _kill(self):
+        if self.master.poll() is None:
+            self.master.kill()
+            self.master.wait()
+
+    def _write_theme(self, title):
+        with open(os.path.join(self.dir, 'theme.html'), 'w') as f:
+            f.write(THEME.format(title))
+
+    def _pages(self, count=6):
+        """Return [(theme title, worker pid)] from count requests."""
+        pages = []
+        for _ in range(count):
+            title, pid = PAGE_RE.search(requests.get(self.url, timeout=5).text).groups()
+            pages.append((title, int(pid)))
+        return pages
+
+    def _wait_for(self, title, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                pages = self._pages(1)
+                if pages[0][0] == title:
+                    return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.1)
+        self.fail('No page themed with {} after {}s'.format(title, timeout))
+
+    def testWorkersReloadAndStop(self):
+        self._wait_for('First')
+        first = set(pid for title, pid in self._pages())
+        self.assertNotIn(self.master.pid, first)
+        self.assertLessEqual(len(first), 2)
+
+        self._write_theme('Reloaded')
+        self._wait_for('Reloaded')
+        # The old workers finish what they accepted before they stopped.
+        time.sleep(1)
+        pages = self._pages()
+        self.assertEqual(set(title for title, pid in pages), set(['Reloaded']))
+        self.assertFalse(first & set(pid for title, pid in pages))
+
+        self.master.send_signal(signal.SIGTERM)
+        self.assertEqual(self.master.wait(timeout=10), 0)
+
+    def testFinishesRequestsInProgress(self):
+        self._wait_for('First')
+        responses = []
+        slow = threading.Thread(
+            target=lambda: responses.append(requests.get(self.url + 'slow', timeout=10)))
+        slow.start()
+        time.sleep(0.5)
+        self.master.send_signal(signal.SIGTERM)
+        slow.join(10)
+        self.assertEqual([r.status_code for r in responses], [200])
+        self.assertEqual(self.master.wait(timeout=10), 0)
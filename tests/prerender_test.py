@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from wsgiref.simple_server import make_server
+
+from diazo.compiler import compile_theme
+
+from tttdiazo.metrics import QuietHandler
+from tttdiazo.origin import canned_page
+from tttdiazo.prerender import MANIFEST, prerender, read_routes, route_file
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RULES = os.path.join(os.path.dirname(HERE), 'rules.xml')
+LAST_MODIFIED = 'Mon, 02 Jan 2017 10:00:00 GMT'
+LAST_MODIFIED_TIME = 1483351200
+
+
+class Origin(object):
+    """An origin with ETags that answers conditional GETs with 304."""
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO']
+        self.requests.append((path, environ.get('HTTP_IF_NONE_MATCH')))
+        if path not in self.pages:
+            start_response('404 Not Found', [('Content-Type', 'text/html')])
+            return [b'']
+        content_type, body = self.pages[path]
+        etag = '"{}"'.format(len(body))
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', [('ETag', etag)])
+            return [b'']
+        start_response('200 OK', [('Content-Type', content_type), ('ETag', etag),
+                                  ('Last-Modified', LAST_MODIFIED)])
+        return [body]
+
+
+class TestPrerender(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.xsl = os.path.join(self.dir, 'theme.xsl')
+        compile_theme(RULES).write(self.xsl)
+        self.output = os.path.join(self.dir, 'static-ized')
+        self.origin = Origin()
+        for route in ('/', '/charities.asp'):
+            self.origin.pages[route] = ('text/html; charset=utf-8',
+                                        canned_page(route).encode('utf-8'))
+        server = make_server('127.0.0.1', 0, self.origin, handler_class=QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.backend = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def render(self, routes=('/', '/charities.asp')):
+        return prerender(self.backend, list(routes), self.xsl, self.output, processes=1)
+
+    def read(self, route):
+        with open(route_file(self.output, route), 'rb') as f:
+            return f.read()
+
+    def testRendersWithManifest(self):
+        self.assertEqual(self.render(), {'rendered': 2, 'unchanged': 0, 'removed': 0})
+        self.assertIn(b'Charities', self.read('/charities.asp'))
+        self.assertEqual(os.path.getmtime(route_file(self.output, '/')), LAST_MODIFIED_TIME)
+        with open(os.path.join(self.output, MANIFEST)) as f:
+            manifest = json.load(f)
+        entry = manifest['routes']['/charities.asp']
+        self.assertEqual(entry['last_modified'], LAST_MODIFIED)
+        self.assertTrue(entry['etag'] and entry['themed'])
+
+    def testReusesOnNotModified(self):
+        self.render()
+        del self.origin.requests[:]
+        self.assertEqual(self.render(), {'rendered': 0, 'unchanged': 2, 'removed': 0})
+        # The second run sent the stored ETags and got 304s.
+        self.assertTrue(all(etag for path, etag in self.origin.requests))
+
+    def testRerendersChangedOrigin(self):
+        self.render()
+        self.origin.pages['/'] = ('text/html; charset=utf-8',
+                                  canned_page('/').replace('Home', 'Welcome').encode('utf-8'))
+        self.assertEqual(self.render(), {'rendered': 1, 'unchanged': 1, 'removed': 0})
+
+    def testThemeChangeGetsNewMtime(self):
+        self.render()
+        with open(self.xsl) as f:
+            xsl = f.read()
+        with open(self.xsl, 'w') as f:
+            f.write(xsl.replace('</xsl:stylesheet>', '<!-- new --></xsl:stylesheet>'))
+        before = time.time()
+        self.assertEqual(self.render(), {'rendered': 2, 'unchanged': 0, 'removed': 0})
+        # Not the origin's old Last-Modified, which would answer 304s for
+        # pages themed the old way.
+        self.assertGreaterEqual(os.path.getmtime(route_file(self.output, '/')), int(before))
+        # Refetched without conditions, since the stored pages are stale.
+        self.assertFalse(any(etag for path, etag in self.origin.requests[-2:]))
+
+    def testRemovesDroppedAndNonHTML(self):
+        self.render()
+        self.origin.pages['/charities.asp'] = ('text/xml', b'<x/>')
+        self.assertEqual(self.render(['/charities.asp']),
+                         {'rendered': 0, 'unchanged': 0, 'removed': 2})
+        self.assertFalse(os.path.exists(route_file(self.output, '/')))
+        self.assertFalse(os.path.exists(route_file(self.output, '/charities.asp')))
+
+    def testReadRoutes(self):
+        path = os.path.join(self.dir, 'routes.txt')
+        with open(path, 'w') as f:
+            f.write('# comment\n/\n\n/charities.asp\n/search.asp?q=x\n')
+        self.assertEqual(read_routes(path), ['/', '/charities.asp'])
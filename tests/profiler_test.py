@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from lxml import etree
+
+from tttdiazo.corpus import load_corpus
+from tttdiazo.origin import canned_page
+from tttdiazo.profiler import Rule, is_scan, load_rules, owner, profile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RULES = os.path.join(os.path.dirname(HERE), 'rules.xml')
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        os.mkdir(os.path.join(self.dir, 'about'))
+        for route in ('/charities.asp.html', '/about/index.html'):
+            with open(self.dir + route, 'w') as f:
+                f.write(canned_page(route))
+
+    def testCorpus(self):
+        routes = [route for route, body in load_corpus(self.dir)]
+        self.assertEqual(routes, ['/charities.asp.html', '/about/index.html'])
+
+    def testRulesKeepSourceLines(self):
+        rules = load_rules(RULES)
+        replace = [r for r in rules.values() if r.label.startswith('<replace')][0]
+        self.assertEqual(replace.label, '<replace css:content-children="#logo">')
+        self.assertTrue(replace.line > 1)
+        self.assertTrue(all(is_scan(x) for x in replace.xpaths))
+
+    def testProfileAttributesTime(self):
+        rules, builtins, seconds = profile(RULES, load_corpus(self.dir))
+        replace = [r for r in rules.values() if r.label.startswith('<replace')][0]
+        self.assertTrue(replace.calls >= 2)
+        self.assertTrue(replace.xpath_seconds)
+        self.assertIn('@*|node()', builtins)
+        self.assertTrue(seconds > 0)
+
+    def testOwnerNeedsExactXPath(self):
+        rules = {'r1': Rule('r1', '<drop css:content="div">', 1, ['//div']),
+                 'r2': Rule('r2', '<drop css:content="#x">', 2, ['//div[@id="x"]'])}
+        template = etree.Element('template', match='//div[@id="x"]')
+        self.assertIs(owner(template, rules), rules['r2'])
+        del rules['r2']
+        self.assertIs(owner(template, rules), None)
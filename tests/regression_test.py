@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from diazo.compiler import compile_theme
+
+from tttdiazo.origin import canned_page
+from tttdiazo.regression import golden_file, regress
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RULES = os.path.join(os.path.dirname(HERE), 'rules.xml')
+PAGES = [(route, canned_page(route).encode('utf-8'))
+         for route in ('/', '/charities.asp', '/hotel-exchange.asp?id=3')]
+
+
+class TestRegression(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.xsl = os.path.join(self.dir, 'theme.xsl')
+        compile_theme(RULES).write(self.xsl)
+        self.golden = os.path.join(self.dir, 'golden')
+
+    def testUpdateThenSame(self):
+        counts, diffs = regress(self.xsl, PAGES, self.golden, update=True, processes=2)
+        self.assertEqual(counts['missing'], 3)
+        counts, diffs = regress(self.xsl, PAGES, self.golden, processes=2)
+        self.assertEqual(counts['same'], 3)
+        self.assertEqual(diffs, [])
+
+    def testReportsOnlyDiffs(self):
+        regress(self.xsl, PAGES, self.golden, update=True, processes=2)
+        path = golden_file(self.golden, '/charities.asp')
+        with open(path) as f:
+            text = f.read()
+        with open(path, 'w') as f:
+            f.write(text.replace('Charities', 'Charity'))
+        counts, diffs = regress(self.xsl, PAGES, self.golden, processes=2)
+        self.assertEqual(counts['differs'], 1)
+        self.assertEqual([route for route, diff in diffs], ['/charities.asp'])
+        self.assertIn('+<title>Charities', diffs[0][1])
+
+    def testIgnore(self):
+        regress(self.xsl, PAGES, self.golden, update=True, processes=2,
+                ignore=[r'Charities'])
+        path = golden_file(self.golden, '/charities.asp')
+        with open(path) as f:
+            self.assertIn('<ignored>', f.read())
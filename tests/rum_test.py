@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import json
+import os
+from unittest import TestCase
+
+from diazo.compiler import compile_theme
+from lxml import etree
+from webob import Request
+
+from tttdiazo.corpus import parse, transform_params
+from tttdiazo.origin import canned_page
+from tttdiazo.rum import OTHER, RUMCollector, RUMStats, parse_beacon
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RULES = os.path.join(os.path.dirname(HERE), 'rules.xml')
+LOGGED = '1476698400.123 "%2Fcharities.asp" 180 420 {}'
+
+
+class TestRUM(TestCase):
+    def testParseBeacon(self):
+        self.assertEqual(parse_beacon({'route': '/a.asp?id=3', 'ttfb': '12', 'dcl': '-5',
+                                       'load': 'x'}),
+                         ('/a.asp', {'ttfb': 12.0}))
+        self.assertIsNone(parse_beacon({'route': 'http://evil/', 'ttfb': '12'}))
+        self.assertIsNone(parse_beacon({'route': '/', 'ttfb': '99999999'}))
+
+    def testRollingPercentiles(self):
+        stats = RUMStats(window=60)
+        stats.add('/', {'load': 5000}, now=0)
+        for ms in range(1, 101):
+            stats.add('/', {'ttfb': ms, 'load': ms * 10}, now=100)
+        load = stats.snapshot(now=120)['/']['load']
+        self.assertEqual(load['count'], 100)
+        self.assertEqual((load['p50'], load['p95']), (500, 950))
+        self.assertEqual(stats.snapshot(now=200), {})
+
+    def testMaxRoutes(self):
+        stats = RUMStats(max_routes=1)
+        stats.add('/a.asp', {'load': 1})
+        stats.add('/b.asp', {'load': 2})
+        self.assertEqual(sorted(stats.routes), [OTHER, '/a.asp'])
+
+    def testNginxLog(self):
+        stats = RUMStats()
+        self.assertTrue(stats.add_log(LOGGED.format(900)))
+        self.assertTrue(stats.add_log(LOGGED.format('-')))
+        self.assertFalse(stats.add_log('garbage'))
+        load = stats.snapshot(now=1476698400)['/charities.asp']['load']
+        self.assertEqual((load['count'], load['p50']), (1, 900))
+        self.assertIn('/charities.asp', stats.report(now=1476698400)[1])
+
+    def testCollector(self):
+        app = RUMCollector(RUMStats())
+        response = Request.blank('/?route=%2F&ttfb=100&dcl=300&load=700').get_response(app)
+        self.assertEqual(response.status_int, 204)
+        self.assertEqual(response.cache_control.no_store, True)
+        response = Request.blank('/stats').get_response(app)
+        self.assertEqual(json.loads(response.body.decode('utf-8'))['/']['dcl']['p50'], 300)
+
+    def testRulesAddBeacon(self):
+        transform = etree.XSLT(compile_theme(RULES))
+        route = '/charities.asp'
+        output = str(transform(parse(canned_page(route).encode('utf-8')),
+                               **transform_params(route)))
+        self.assertIn("'/_rum?route='", output)
+        self.assertIn("'&ttfb='", output)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from webob import Request
+
+from tttdiazo.servertiming import ServerTiming
+from tttdiazo.themecache import ThemeCacheMiddleware, filter_factory
+
+from themecache_test import RULES, THEME, content_app
+
+
+def metrics(response):
+    return [part.strip().split(';')[0] for part in response.headers['Server-Timing'].split(',')]
+
+
+class TestServerTiming(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.rules = os.path.join(self.dir, 'rules.xml')
+        with open(self.rules, 'w') as f:
+            f.write(RULES)
+        with open(os.path.join(self.dir, 'theme.html'), 'w') as f:
+            f.write(THEME.format('Timed'))
+
+    def testHeader(self):
+        timing = ServerTiming()
+        timing.add('origin', 12.345)
+        timing.add('cache', desc='HIT')
+        self.assertEqual(timing.header(), 'origin;dur=12.3, cache;desc=HIT')
+
+    def testOffByDefault(self):
+        app = filter_factory(content_app, {}, rules=self.rules)
+        self.assertIsInstance(app, ThemeCacheMiddleware)
+        self.assertNotIn('Server-Timing', Request.blank('/').get_response(app).headers)
+
+    def testThemedResponse(self):
+        app = filter_factory(content_app, {}, rules=self.rules, server_timing='true')
+        response = Request.blank('/').get_response(app)
+        self.assertIn('Timed', response.text)
+        self.assertEqual(metrics(response), ['origin', 'parse', 'xslt', 'total'])
+
+    def testOutputCacheStatus(self):
+        app = filter_factory(content_app, {}, rules=self.rules, server_timing='true',
+                             output_cache='true')
+        first = Request.blank('/').get_response(app)
+        self.assertEqual(metrics(first), ['origin', 'parse', 'xslt', 'cache', 'total'])
+        self.assertIn('cache;desc=MISS', first.headers['Server-Timing'])
+        second = Request.blank('/').get_response(app)
+        self.assertEqual(metrics(second), ['origin', 'cache', 'total'])
+        self.assertIn('cache;desc=HIT', second.headers['Server-Timing'])
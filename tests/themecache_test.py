@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from webob import Request
+
+from tttdiazo.themecache import ThemeCacheMiddleware
+from tttdiazo.themefiles import theme_files
+
+RULES = """<?xml version="1.0" encoding="utf-8"?>
+<rules xmlns="http://namespaces.plone.org/diazo"
+       xmlns:css="http://namespaces.plone.org/diazo/css">
+  <theme href="theme.html" />
+  <replace css:theme-children="#main" css:content-children="#content" />
+</rules>
+"""
+
+THEME = """<html><head><title>{}</title></head>
+<body><div id="main">theme</div></body></html>
+"""
+
+CONTENT = b'<html><body><div id="content">origin</div></body></html>'
+
+
+def content_app(environ, start_response):
+    # Diazo asks the content app for the theme first; make it fall back to disk
+    if environ['PATH_INFO'] != '/':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'']
+    start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+    return [CONTENT]
+
+
+class TestThemeCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.rules = os.path.join(self.dir, 'rules.xml')
+        self.theme = os.path.join(self.dir, 'theme.html')
+        with open(self.rules, 'w') as f:
+            f.write(RULES)
+        self._write_theme('First')
+        self.app = ThemeCacheMiddleware(content_app, {}, self.rules)
+
+    def _write_theme(self, title):
+        with open(self.theme, 'w') as f:
+            f.write(THEME.format(title))
+
+    def _get(self):
+        return Request.blank('/').get_response(self.app).text
+
+    def testThemeFiles(self):
+        self.assertEqual(theme_files(self.rules), [self.rules, self.theme])
+
+    def testCompilesOnce(self):
+        self.assertIn('First', self._get())
+        self.assertIn('origin', self._get())
+        self.assertEqual(self.app.recompiles, 1)
+        self.assertEqual(self.app.hits, 1)
+
+    def testTouchDoesNotRecompile(self):
+        self._get()
+        os.utime(self.theme, (0, 0))
+        self._get()
+        self.assertEqual(self.app.recompiles, 1)
+
+    def testEditRecompiles(self):
+        self._get()
+        self._write_theme('Second edition')
+        os.utime(self.theme, (0, 0))
+        self.assertIn('Second edition', self._get())
+        self.assertEqual(self.app.recompiles, 2)
+
+    def testStoreSurvivesRestart(self):
+        store = os.path.join(self.dir, 'xsl-store')
+        first = ThemeCacheMiddleware(content_app, {}, self.rules, store=store)
+        Request.blank('/').get_response(first)
+        self.assertEqual(len(os.listdir(store)), 1)
+        second = ThemeCacheMiddleware(content_app, {}, self.rules, store=store)
+        self.assertIn('First', Request.blank('/').get_response(second).text)
+        self.assertEqual(len(os.listdir(store)), 1)
@@ -0,0 +1,4 @@
+"""TTTDiazo: tooling around the Diazo theme for the Trade To Travel site.
+
+Copyright (c) 2016 V! Studios.
+"""
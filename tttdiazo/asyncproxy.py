@@ -0,0 +1,506 @@
+"""Theme the origin from an asyncio server: the paster stack at full speed.
+
+local.ini proxies to the origin with ``egg:Paste#proxy``: a thread per
+request, a new origin connection for each, and no Accept-Encoding, so not
+even the images come compressed. This server takes the same local.ini and
+themes with the same rules.xml, ``prefix = /static`` and other
+``[filter:theme]`` settings, but:
+
+* clients and the origin are spoken to with HTTP/1.1 keep-alive from
+  coroutines, the origin from a pool of at most ``--pool-size``
+  connections;
+* responses that aren't themed (images, CSS, JS, redirects) stream through
+  as the origin sends them, still compressed if the origin compressed them;
+* pages to theme are read whole, decompressed and run through the
+  ``egg:tttdiazo#theme`` filter -- compile cache, XSL store, output cache
+  and Server-Timing included -- in a pool of ``--workers`` threads. lxml
+  lets go of the GIL while it parses and transforms, so they run in
+  parallel;
+* the filter's prefix is served from ``[app:static]``'s document_root.
+
+That's production-like throughput for front-end work without building the
+patched nginx::
+
+  make .venv3
+  .venv3/bin/python -m tttdiazo.asyncproxy -c local.ini
+
+It needs Python 3.6 or later, so unlike the rest of the package it runs
+from a Python 3 virtualenv of its own rather than buildout's bin/.
+"""
+import argparse
+import asyncio
+import configparser
+import logging
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+from paste.urlparser import StaticURLParser
+from webob import Request
+
+from tttdiazo.servertiming import FETCH_KEY
+from tttdiazo.themecache import filter_factory
+
+# Prefetched origin response, (status, headers, body), for `PrefetchedApp`.
+UPSTREAM_KEY = 'tttdiazo.prefetched'
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                        'proxy-authorization', 'te', 'trailer', 'trailers',
+                        'transfer-encoding', 'upgrade'])
+IDEMPOTENT = frozenset(['GET', 'HEAD', 'OPTIONS'])
+THEMED_TYPES = ('text/html', 'application/xhtml+xml')
+CHUNK_SIZE = 64 * 1024
+DEFAULT_POOL_SIZE = 20
+DEFAULT_TIMEOUT = 30
+DEFAULT_WORKERS = 4
+
+log = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    """The client sent something that isn't HTTP/1.x."""
+
+
+def get_header(headers, name, default=None):
+    """Return the last value of header name in [(name, value)], any case."""
+    name = name.lower()
+    for key, value in reversed(headers):
+        if key.lower() == name:
+            return value
+    return default
+
+
+def end_to_end(headers, *drop):
+    """Return headers less the hop-by-hop ones and those named in drop."""
+    dropped = HOP_BY_HOP.union(drop)
+    connection = get_header(headers, 'connection', '')
+    dropped = dropped.union(t.strip().lower() for t in connection.split(','))
+    return [(k, v) for k, v in headers if k.lower() not in dropped]
+
+
+async def read_head(reader):
+    """Return the (start line, [(name, value)]) of a message, or None at EOF."""
+    line = await reader.readline()
+    if not line:
+        return None
+    start = line.decode('latin-1').rstrip('\r\n')
+    headers = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('Closed in the headers')
+        if line in (b'\r\n', b'\n'):
+            return start, headers
+        name, colon, value = line.decode('latin-1').partition(':')
+        if not colon:
+            raise BadRequest('Bad header line {!r}'.format(line))
+        headers.append((name.strip(), value.strip()))
+
+
+async def iter_body(reader, headers, until_close=False):
+    """Yield a message body's chunks as they arrive.
+
+    The body is chunked, as long as Content-Length, or with until_close
+    everything up to EOF; otherwise there is none.
+    """
+    if 'chunked' in get_header(headers, 'transfer-encoding', '').lower():
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                while (await reader.readline()).strip():
+                    pass    # trailers
+                return
+            yield await reader.readexactly(size)
+            await reader.readexactly(2)
+    length = get_header(headers, 'content-length')
+    if length is not None:
+        remaining = int(length)
+        while remaining:
+            chunk = await reader.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ConnectionError('Closed in the body')
+            remaining -= len(chunk)
+            yield chunk
+    elif until_close:
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def decode(body, content_encoding):
+    """Return body decompressed from gzip or deflate."""
+    if content_encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    try:
+        return zlib.decompress(body)
+    except zlib.error:
+        # Some servers send raw deflate without the zlib header
+        return zlib.decompress(body, -zlib.MAX_WBITS)
+
+
+class OriginResponse(object):
+    """Status and headers of an origin response whose body is still to come.
+
+    Read the body with `chunks` or `read`; once it's all in, the connection
+    goes back to the pool. `close` gives up on it and the connection.
+    """
+
+    def __init__(self, pool, conn, status, reason, headers, has_body, reusable):
+        self.pool = pool
+        self.conn = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.has_body = has_body
+        self.reusable = reusable
+
+    async def chunks(self):
+        if self.has_body:
+            try:
+                async for chunk in iter_body(self.conn[0], self.headers, until_close=True):
+                    yield chunk
+            except BaseException:
+                self.close()
+                raise
+        self._release(self.reusable)
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.chunks()])
+
+    def _release(self, reusable):
+        if self.conn is not None:
+            self.pool.release(self.conn, reusable)
+            self.conn = None
+
+    def close(self):
+        self._release(False)
+
+
+class OriginPool(object):
+    """Keep-alive HTTP/1.1 connections to the origin at address.
+
+    At most size are open at once; requests wait for a free one. A pooled
+    connection the origin has closed meanwhile is retried on a new one if
+    the method is idempotent.
+    """
+
+    def __init__(self, address, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        url = urlsplit(address)
+        self.ssl = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port or (443 if self.ssl else 80)
+        self.netloc = url.netloc
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.opened = 0
+        self.reused = 0
+        self._slots = None
+
+    async def _connect(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                self.reused += 1
+                return (reader, writer), True
+            writer.close()
+        conn = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl or None), self.timeout)
+        self.opened += 1
+        return conn, False
+
+    def release(self, conn, reusable):
+        if reusable:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+        self._slots.release()
+
+    async def request(self, method, target, headers, body=b''):
+        """Send a request; return its `OriginResponse` once the headers are in."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        await self._slots.acquire()
+        head = ['{} {} HTTP/1.1'.format(method, target), 'Host: ' + self.netloc]
+        head.extend('{}: {}'.format(k, v) for k, v in headers)
+        if body or method not in IDEMPOTENT:
+            head.append('Content-Length: {}'.format(len(body)))
+        message = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+        while True:
+            try:
+                conn, reused = await self._connect()
+            except BaseException:
+                self._slots.release()
+                raise
+            try:
+                conn[1].write(message)
+                response = await asyncio.wait_for(read_head(conn[0]), self.timeout)
+                if response is None:
+                    raise ConnectionError('Origin closed the connection')
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if reused and method in IDEMPOTENT:
+                    conn[1].close()
+                    continue
+                self.release(conn, False)
+                raise
+            except BaseException:
+                self.release(conn, False)
+                raise
+        start, headers = response
+        version, status, reason = (start.split(None, 2) + [''])[:3]
+        status = int(status)
+        has_body = not (method == 'HEAD' or status in (204, 304) or 100 <= status < 200)
+        delimited = (not has_body or get_header(headers, 'content-length') is not None or
+                     'chunked' in get_header(headers, 'transfer-encoding', '').lower())
+        reusable = (delimited and version == 'HTTP/1.1' and
+                    get_header(headers, 'connection', '').lower() != 'close')
+        return OriginResponse(self, conn, status, reason, headers, has_body, reusable)
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+def should_theme(response):
+    """Return whether the theme filter may transform response, as diazo decides.
+
+    gzip and deflate are fine: we decompress before theming.
+    """
+    content_type = get_header(response.headers, 'content-type', '').lower()
+    encoding = get_header(response.headers, 'content-encoding', 'identity').lower()
+    return (content_type.startswith(THEMED_TYPES) and
+            encoding in ('identity', 'gzip', 'deflate') and
+            get_header(response.headers, 'x-theme-disabled', 'no').lower() in ('no', 'false', '0') and
+            not (300 <= response.status < 400 or response.status in (204, 401)) and
+            get_header(response.headers, 'content-length') != '0')
+
+
+class PrefetchedApp(object):
+    """Content app for the theme filter, answering with the fetched response.
+
+    Diazo's own subrequests, for the theme, get a 404 and fall back to disk.
+    """
+
+    def __call__(self, environ, start_response):
+        upstream = environ.get(UPSTREAM_KEY)
+        if upstream is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'']
+        environ.pop(UPSTREAM_KEY)
+        status, headers, body = upstream
+        start_response(status, headers)
+        return [body]
+
+
+class ThemingProxy(object):
+    """Serve clients: stream the origin through, theme its pages in workers."""
+
+    def __init__(self, pool, theme_filter, static_prefix=None, static_app=None,
+                 workers=DEFAULT_WORKERS):
+        self.pool = pool
+        self.theme_filter = theme_filter
+        self.static_prefix = static_prefix.rstrip('/') + '/' if static_prefix else None
+        self.static_app = static_app
+        self.executor = ThreadPoolExecutor(workers)
+
+    async def handle(self, reader, writer):
+        """Serve the requests on one client connection until either side closes."""
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                head = await read_head(reader)
+                if head is None:
+                    break
+                start, headers = head
+                try:
+                    method, target, version = start.split()
+                except ValueError:
+                    raise BadRequest('Bad request line {!r}'.format(start))
+                body = b''.join([chunk async for chunk in iter_body(reader, headers)])
+                keep_alive = (version == 'HTTP/1.1' and
+                              get_header(headers, 'connection', '').lower() != 'close')
+                keep_alive = await self.respond(writer, method, target, version, headers,
+                                                body, peer, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except BadRequest as err:
+            log.info('%s: %s', peer, err)
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n'
+                         b'Connection: close\r\n\r\n')
+        except (ConnectionError, asyncio.IncompleteReadError) as err:
+            log.debug('%s: %s', peer, err)
+        finally:
+            writer.close()
+
+    async def respond(self, writer, method, target, version, headers, body, peer, keep_alive):
+        """Answer one request; return whether the connection may be kept."""
+        loop = asyncio.get_event_loop()
+        path = target.split('?', 1)[0]
+        if self.static_prefix and path.startswith(self.static_prefix):
+            status, out_headers, out_body = await loop.run_in_executor(
+                self.executor, self.call_wsgi, self.static_app, method, target, headers, peer,
+                {'SCRIPT_NAME': self.static_prefix.rstrip('/'),
+                 'PATH_INFO': unquote(path[len(self.static_prefix) - 1:], 'latin-1')})
+            return self.write_whole(writer, method, status, out_headers, out_body, keep_alive)
+
+        forwarded = end_to_end(headers, 'host', 'content-length')
+        if peer:
+            forwarded.append(('X-Forwarded-For', peer[0]))
+        began = loop.time()
+        try:
+            response = await self.pool.request(method, target, forwarded, body)
+        except (ConnectionError, OSError, asyncio.TimeoutError) as err:
+            log.warning('%s %s: origin failed: %s', method, target, err)
+            return self.write_whole(writer, method, '502 Bad Gateway',
+                                    [('Content-Type', 'text/plain')], b'Bad Gateway\n',
+                                    keep_alive)
+        try:
+            if should_theme(response):
+                page = await response.read()
+                fetch_ms = (loop.time() - began) * 1000
+                encoding = get_header(response.headers, 'content-encoding')
+                if encoding and encoding.lower() != 'identity':
+                    page = decode(page, encoding.lower())
+                upstream = ('{} {}'.format(response.status, response.reason),
+                            end_to_end(response.headers, 'content-length', 'content-encoding'),
+                            page)
+                status, out_headers, out_body = await loop.run_in_executor(
+                    self.executor, self.call_wsgi, self.theme_filter, method, target, headers,
+                    peer, {UPSTREAM_KEY: upstream, FETCH_KEY: fetch_ms})
+                return self.write_whole(writer, method, status, out_headers, out_body,
+                                        keep_alive)
+            return await self.stream(writer, response, version, keep_alive)
+        finally:
+            response.close()
+
+    def call_wsgi(self, app, method, target, headers, peer, extra=None):
+        """Run a WSGI app on the request; return (status, headers, body)."""
+        request = Request.blank(target, method=method)
+        for name, value in end_to_end(headers, 'content-length'):
+            request.headers[name] = value
+        if peer:
+            request.environ['REMOTE_ADDR'] = peer[0]
+        request.environ.update(extra or {})
+        response = request.get_response(app)
+        return response.status, response.headerlist, response.body
+
+    def write_head(self, writer, status, headers, keep_alive):
+        head = ['HTTP/1.1 ' + status]
+        head.extend('{}: {}'.format(k, v) for k, v in headers)
+        if not keep_alive:
+            head.append('Connection: close')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+    def write_whole(self, writer, method, status, headers, body, keep_alive):
+        headers = end_to_end(headers, 'content-length')
+        headers.append(('Content-Length', str(len(body))))
+        self.write_head(writer, status, headers, keep_alive)
+        if method != 'HEAD':
+            writer.write(body)
+        return keep_alive
+
+    async def stream(self, writer, response, version, keep_alive):
+        """Pass response through as it arrives, chunked if it has no length."""
+        headers = end_to_end(response.headers)
+        length = get_header(response.headers, 'content-length')
+        chunked = response.has_body and length is None and version == 'HTTP/1.1'
+        if chunked:
+            headers.append(('Transfer-Encoding', 'chunked'))
+        elif response.has_body and length is None:
+            keep_alive = False      # HTTP/1.0 client: the end of the body is the close
+        status = '{} {}'.format(response.status, response.reason).strip()
+        self.write_head(writer, status, headers, keep_alive)
+        async for chunk in response.chunks():
+            if chunked:
+                writer.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+            else:
+                writer.write(chunk)
+            await writer.drain()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        return keep_alive
+
+
+def load_settings(config_file, theme='filter:theme', content='app:content',
+                  static='app:static'):
+    """Return (global conf, theme filter conf, origin address, static root)
+    from a paster .ini like local.ini. The static root is None without one.
+    """
+    here = os.path.dirname(os.path.abspath(config_file))
+    parser = configparser.ConfigParser(defaults={'here': here, '__file__': config_file})
+    with open(config_file) as f:
+        parser.read_file(f)
+    global_conf = parser.defaults()
+    theme_conf = dict((k, v) for k, v in parser.items(theme) if k not in global_conf)
+    theme_conf.pop('use', None)
+    address = parser.get(content, 'address')
+    static_root = None
+    if parser.has_option(static, 'document_root'):
+        static_root = parser.get(static, 'document_root')
+    return global_conf, theme_conf, address, static_root
+
+
+def make_proxy(config_file, pool_size=DEFAULT_POOL_SIZE, workers=DEFAULT_WORKERS,
+               timeout=DEFAULT_TIMEOUT):
+    """Return a `ThemingProxy` set up like the paster stack in config_file."""
+    global_conf, theme_conf, address, static_root = load_settings(config_file)
+    theme_filter = filter_factory(PrefetchedApp(), global_conf, **theme_conf)
+    static_app = StaticURLParser(static_root) if static_root else None
+    return ThemingProxy(OriginPool(address, pool_size, timeout), theme_filter,
+                        theme_conf.get('prefix') if static_app else None, static_app, workers)
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Serve the paster theming stack of a .ini from asyncio: pooled '
+                    'keep-alive origin connections, streamed assets, and XSLT in '
+                    'worker threads.')
+    parser.add_argument('-c', '--config', default='local.ini',
+                        help='paster .ini with [filter:theme], [app:content] and '
+                             '[app:static]. Default: local.ini.')
+    parser.add_argument('-l', '--listen', default='127.0.0.1:5000',
+                        help='host:port to serve on. Default: 127.0.0.1:5000.')
+    parser.add_argument('-p', '--pool-size', type=int, default=DEFAULT_POOL_SIZE,
+                        help='Most origin connections open at once. '
+                             'Default: {}.'.format(DEFAULT_POOL_SIZE))
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Theming threads. Default: {}.'.format(DEFAULT_WORKERS))
+    parser.add_argument('-t', '--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Seconds to wait for the origin to connect and answer. '
+                             'Default: {}.'.format(DEFAULT_TIMEOUT))
+    return parser
+
+
+def main():
+    """Entrypoint, run as `python -m tttdiazo.asyncproxy` from .venv3."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    args = init_parser().parse_args()
+    host, _, port = args.listen.rpartition(':')
+    proxy = make_proxy(args.config, args.pool_size, args.workers, args.timeout)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(
+        asyncio.start_server(proxy.handle, host or '127.0.0.1', int(port)))
+    log.info('Theming %s:%d on http://%s/ with %d workers',
+             proxy.pool.host, proxy.pool.port, args.listen, args.workers)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        proxy.pool.close()
+        proxy.executor.shutdown()
+        loop.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,74 @@
+"""Load a corpus of captured origin pages to run the theme over.
+
+A corpus is either a fixture directory written by `tttdiazo-origin-record`
+(an index.json of recorded responses; only 200 text/html pages are used) or
+any directory of .html files, where ``about/index.html`` stands for the
+route ``/about/index.html``.
+
+`transform_pool` themes pages in worker processes, for prerender and the
+regression runner.
+"""
+import multiprocessing
+import os
+
+from diazo.utils import quote_param
+from lxml import etree
+
+from tttdiazo.origin import INDEX, load_fixtures
+
+HTML_EXTENSIONS = ('.html', '.htm')
+
+# Set in each transform_pool worker: lxml XSLT objects can't be pickled, so
+# every worker parses the stylesheet once for itself.
+_transform = None
+
+
+def load_corpus(directory):
+    """Return a sorted list of (route, body bytes) for the pages in directory."""
+    if os.path.exists(os.path.join(directory, INDEX)):
+        pages = []
+        for route, (status, headers, body) in load_fixtures(directory).items():
+            content_type = dict((k.lower(), v) for k, v in headers.items()).get('content-type', '')
+            if status == 200 and content_type.startswith('text/html'):
+                pages.append((route, body))
+        return sorted(pages)
+    pages = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(HTML_EXTENSIONS):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    route = '/' + os.path.relpath(path, directory).replace(os.sep, '/')
+                    pages.append((route, f.read()))
+    return pages
+
+
+def parse(body):
+    """Parse a page the way the paster filter and nginx do: as broken HTML."""
+    return etree.fromstring(body, etree.HTMLParser()).getroottree()
+
+
+def transform_params(route):
+    """Return the XSL params the servers pass for route: diazo's `path`."""
+    return {'path': quote_param(route.split('?', 1)[0])}
+
+
+def _init_worker(xsl_path, initializer, initargs):
+    global _transform
+    _transform = etree.XSLT(etree.parse(xsl_path))
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def transform_pool(xsl_path, processes=None, initializer=None, initargs=()):
+    """Return a multiprocessing Pool whose workers can `transform` with xsl_path.
+
+    initializer(*initargs), if given, also runs in each worker.
+    """
+    return multiprocessing.Pool(processes, _init_worker, (xsl_path, initializer, initargs))
+
+
+def transform(body, route):
+    """Theme a page for route in a transform_pool worker; return the output bytes."""
+    return bytes(_transform(parse(body), **transform_params(route)))
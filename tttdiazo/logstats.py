@@ -0,0 +1,331 @@
+"""Report where request time goes, per route, from the nginx logs.
+
+Reads the tttdiazo server's nginx-access.log (`standard` format), the cache
+front end's cache.log (`cache` format) and the XSLT error log
+nginx-xslt.log, including logrotate's compressed generations, oldest first.
+For each route (path without query string) it reports:
+
+* requests and the microcache hit ratio, from cache.log;
+* origin latency, the tttdiazo server's upstream response time;
+* theming time, the tttdiazo server's request time less the origin's;
+* XSLT errors and warnings logged for it.
+
+Memory stays constant however much log we read: latencies go into fixed
+histograms rather than lists, and routes past --max-routes are counted
+together as "(other)". With --follow it then tails the live logs, across
+rotations, and prints the report every --interval seconds::
+
+  bin/tttdiazo-logstats var/log
+  bin/tttdiazo-logstats --follow --interval 60 /var/app/var/log
+"""
+import argparse
+import glob
+import gzip
+import io
+import logging
+import math
+import os
+import re
+import time
+
+ACCESS_LOG = 'nginx-access.log'
+CACHE_LOG = 'cache.log'
+XSLT_LOG = 'nginx-xslt.log'
+DEFAULT_MAX_ROUTES = 500
+DEFAULT_TOP = 30
+OTHER = '(other)'
+# Cache statuses where the microcache answered without the tttdiazo server.
+HIT_STATUSES = ('HIT', 'STALE', 'UPDATING', 'REVALIDATED')
+
+STANDARD_RE = re.compile(r'"(?P<method>[A-Z]+) (?P<uri>\S+)[^"]*" (?P<status>\d{3}) .*'
+                         r' rt=(?P<rt>[\d.]+) urt="(?P<urt>[^"]*)" ucs=(?P<ucs>\S+)$')
+CACHE_RE = re.compile(r'^\*\*\*\S+ [+-]\d{4} (?P<ucs>\S+) .*"(?P<method>[A-Z]+) (?P<uri>\S+)[^"]*"'
+                      r' \((?P<status>\d{3})\) .* rt=(?P<rt>[\d.]+) urt="(?P<urt>[^"]*)"$')
+ERROR_RE = re.compile(r'\[(?P<level>[a-z]+)\] .*request: "(?P<method>[A-Z]+) (?P<uri>\S+)')
+
+log = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """Latencies in geometric buckets, 10% wide, from 0.1ms to about a minute.
+
+    Percentiles are the upper bound of the bucket they fall in, so they're
+    within 10% of the true value.
+    """
+    BASE = 0.0001
+    RATIO = 1.1
+    SIZE = 140
+
+    def __init__(self):
+        self.buckets = [0] * self.SIZE
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        if seconds <= self.BASE:
+            i = 0
+        else:
+            i = min(int(math.log(seconds / self.BASE, self.RATIO)) + 1, self.SIZE - 1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, pct):
+        """Return the pct percentile in seconds, or None if empty."""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * pct / 100.0)))
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return self.BASE * self.RATIO ** i
+        return self.BASE * self.RATIO ** (self.SIZE - 1)
+
+    def cumulative(self, bounds):
+        """Return how many latencies were at most each of bounds (seconds).
+
+        A bucket counts towards a bound if it starts below it, so like
+        `percentile` this is within 10%.
+        """
+        counts = []
+        for bound in bounds:
+            last = int(math.ceil(math.log(bound / self.BASE, self.RATIO) - 1e-9))
+            counts.append(sum(self.buckets[:max(0, min(last, self.SIZE - 1)) + 1]))
+        return counts
+
+
+class RouteStats(object):
+    """Counters and latency histograms for one route."""
+
+    def __init__(self):
+        self.requests = 0
+        self.hits = 0
+        self.cache_requests = 0
+        self.request = Histogram()
+        self.origin = Histogram()
+        self.theming = Histogram()
+        self.errors = 0
+        self.warnings = 0
+
+    @property
+    def hit_ratio(self):
+        return float(self.hits) / self.cache_requests if self.cache_requests else None
+
+
+def upstream_seconds(value):
+    """Sum an $upstream_response_time like "0.010, 0.005"; None for "-"."""
+    times = [float(t) for t in re.split(r'[,:]\s*', value) if t.strip() not in ('', '-')]
+    return sum(times) if times else None
+
+
+class LogStats(object):
+    """Aggregate nginx log lines into per-route `RouteStats`.
+
+    :param int max_routes: routes tracked individually before "(other)"
+    """
+
+    def __init__(self, max_routes=DEFAULT_MAX_ROUTES):
+        self.max_routes = max_routes
+        self.routes = {}
+        self.unparsed = 0
+
+    def route(self, uri):
+        path = uri.split('?', 1)[0]
+        stats = self.routes.get(path)
+        if stats is None:
+            if len(self.routes) >= self.max_routes:
+                path = OTHER
+            stats = self.routes.setdefault(path, RouteStats())
+        return stats
+
+    def add_access(self, line):
+        """Count a tttdiazo server `standard` line: origin and theming time."""
+        match = STANDARD_RE.search(line)
+        if not match:
+            self.unparsed += 1
+            return
+        stats = self.route(match.group('uri'))
+        stats.requests += 1
+        stats.request.add(float(match.group('rt')))
+        origin = upstream_seconds(match.group('urt'))
+        if origin is None:
+            return  # static file or pre-rendered page: neither fetched nor themed
+        stats.origin.add(origin)
+        stats.theming.add(max(0.0, float(match.group('rt')) - origin))
+
+    def add_cache(self, line):
+        """Count a cache front end `cache` line: hit or not."""
+        match = CACHE_RE.search(line)
+        if not match:
+            self.unparsed += 1
+            return
+        stats = self.route(match.group('uri'))
+        stats.cache_requests += 1
+        if match.group('ucs') in HIT_STATUSES:
+            stats.hits += 1
+
+    def add_error(self, line):
+        """Count an XSLT error log line against its request's route."""
+        match = ERROR_RE.search(line)
+        if not match:
+            return
+        stats = self.route(match.group('uri'))
+        if match.group('level') in ('warn', 'notice', 'info'):
+            stats.warnings += 1
+        else:
+            stats.errors += 1
+
+    def adder(self, path):
+        """Return the add_* method for the log at path."""
+        name = os.path.basename(path)
+        if name.startswith(CACHE_LOG):
+            return self.add_cache
+        if name.startswith(XSLT_LOG):
+            return self.add_error
+        return self.add_access
+
+    def report(self, top=DEFAULT_TOP):
+        """Return report lines for the top routes by total request time."""
+        def ms(seconds):
+            return '-' if seconds is None else '{:.0f}'.format(seconds * 1000)
+
+        def weight(item):
+            stats = item[1]
+            return stats.origin.total + stats.theming.total, stats.requests
+
+        lines = ['{:<40} {:>7} {:>5} {:>7} {:>7} {:>7} {:>7} {:>5}'.format(
+            'route', 'reqs', 'hit%', 'orig50', 'orig95', 'xslt50', 'xslt95', 'errs')]
+        for path, stats in sorted(self.routes.items(), key=weight, reverse=True)[:top]:
+            ratio = stats.hit_ratio
+            lines.append('{:<40} {:>7} {:>5} {:>7} {:>7} {:>7} {:>7} {:>5}'.format(
+                path[:40], stats.requests + stats.cache_requests,
+                '-' if ratio is None else '{:.0f}'.format(ratio * 100),
+                ms(stats.origin.percentile(50)), ms(stats.origin.percentile(95)),
+                ms(stats.theming.percentile(50)), ms(stats.theming.percentile(95)),
+                stats.errors))
+        origin = sum(s.origin.total for s in self.routes.values())
+        theming = sum(s.theming.total for s in self.routes.values())
+        if origin + theming:
+            lines.append('Time in origin {:.0%}, theming {:.0%} (latencies in ms; '
+                         '{} lines unparsed)'.format(origin / (origin + theming),
+                                                     theming / (origin + theming),
+                                                     self.unparsed))
+        return lines
+
+
+def open_log(path):
+    """Open a log, gzipped or not, as text."""
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path), errors='replace')
+    return io.open(path, errors='replace')
+
+
+def generations(path):
+    """Return path's rotated generations, oldest first, then path itself."""
+    def number(name):
+        match = re.search(r'\.(\d+)(\.gz)?$', name)
+        return int(match.group(1)) if match else 0
+    rotated = [p for p in glob.glob(path + '.*') if number(p)]
+    return sorted(rotated, key=number, reverse=True) + [path]
+
+
+def log_files(paths):
+    """Expand directories into our three logs; return [(path, follow)]."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in (ACCESS_LOG, CACHE_LOG, XSLT_LOG):
+                current = os.path.join(path, name)
+                files.extend((p, p == current) for p in generations(current))
+        else:
+            files.append((path, True))
+    return [(p, follow) for p, follow in files if os.path.exists(p)]
+
+
+def read(stats, path):
+    """Feed every line of path to stats."""
+    add = stats.adder(path)
+    with open_log(path) as f:
+        for line in f:
+            add(line.rstrip('\n'))
+
+
+class Follower(object):
+    """Tail a log like `tail -F`, reopening it when logrotate moves it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = io.open(path, errors='replace')
+        self.file.seek(0, os.SEEK_END)
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.partial = ''
+
+    def lines(self):
+        """Yield the complete lines written since the last call."""
+        while True:
+            chunk = self.file.readline()
+            if not chunk:
+                break
+            if not chunk.endswith('\n'):
+                self.partial += chunk
+                continue
+            yield self.partial + chunk.rstrip('\n')
+            self.partial = ''
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return
+        if inode != self.inode:
+            self.file.close()
+            self.file = io.open(self.path, errors='replace')
+            self.inode = inode
+            for line in self.lines():
+                yield line
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Report hit ratio, origin latency and theming time per route '
+                    'from the nginx logs.')
+    parser.add_argument('paths', nargs='*', default=['var/log'],
+                        help='Log files, or directories holding {}, {} and {}. '
+                             'Default: var/log.'.format(ACCESS_LOG, CACHE_LOG, XSLT_LOG))
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='Keep tailing the current logs, reporting every --interval.')
+    parser.add_argument('-i', '--interval', type=float, default=60,
+                        help='Seconds between reports with --follow. Default: 60.')
+    parser.add_argument('-n', '--top', type=int, default=DEFAULT_TOP,
+                        help='Routes to report. Default: {}.'.format(DEFAULT_TOP))
+    parser.add_argument('-m', '--max-routes', type=int, default=DEFAULT_MAX_ROUTES,
+                        help='Routes to track before lumping the rest together. '
+                             'Default: {}.'.format(DEFAULT_MAX_ROUTES))
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-logstats console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    args = init_parser().parse_args()
+    stats = LogStats(args.max_routes)
+    files = log_files(args.paths)
+    if not files:
+        log.error('No logs found in %s', ', '.join(args.paths))
+        return 1
+    for path, _ in files:
+        read(stats, path)
+    print('\n'.join(stats.report(args.top)))
+    if not args.follow:
+        return 0
+    followers = [(Follower(path), stats.adder(path)) for path, follow in files if follow]
+    try:
+        while True:
+            time.sleep(args.interval)
+            for follower, add in followers:
+                for line in follower.lines():
+                    add(line)
+            print('\n' + time.strftime('%Y-%m-%d %H:%M:%S'))
+            print('\n'.join(stats.report(args.top)))
+    except KeyboardInterrupt:
+        return 0
@@ -0,0 +1,315 @@
+"""Serve the stack's numbers in the Prometheus text format.
+
+CPU says little about an XSLT-bound box until it's too late. This exporter
+merges, at each scrape:
+
+* nginx's stub_status: connections and requests (the front end serves it
+  at /_nginx_status to localhost only);
+* from the logs bin/tttdiazo-logstats reads, tailed since the exporter
+  started: per route request counts and histograms of the request time,
+  the origin's time and the theming time, microcache requests and hits,
+  and XSLT errors;
+* the resident memory of the nginx master and each worker, from the pid
+  file and `ps`.
+
+Run it next to nginx and point a Prometheus-compatible collector at it::
+
+  bin/tttdiazo-metrics -l 127.0.0.1:9145 -s http://127.0.0.1:5000/_nginx_status \\
+      -d var/log -p var/nginx.pid
+  curl http://127.0.0.1:9145/metrics
+
+Under paster, ``use = egg:tttdiazo#metrics`` (mounted at /_metrics in
+local.ini) serves the theme filter's compile and output cache counters
+and the process's memory instead.
+"""
+import argparse
+import logging
+import os
+import re
+import subprocess
+import threading
+import weakref
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+import requests
+from webob import Response
+
+from tttdiazo.logstats import (ACCESS_LOG, CACHE_LOG, HIT_STATUSES, OTHER, XSLT_LOG,
+                               Follower, LogStats)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+# Histogram buckets in seconds; the log histograms are accurate to 10%.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_LISTEN = '127.0.0.1:9145'
+DEFAULT_STATUS_URL = 'http://127.0.0.1:5000/_nginx_status'
+DEFAULT_MAX_ROUTES = 100
+
+STUB_STATUS_RE = re.compile(r'Active connections:\s*(?P<active>\d+)\s+'
+                            r'server accepts handled requests\s+'
+                            r'(?P<accepts>\d+)\s+(?P<handled>\d+)\s+(?P<requests>\d+)\s+'
+                            r'Reading:\s*(?P<reading>\d+)\s+Writing:\s*(?P<writing>\d+)\s+'
+                            r'Waiting:\s*(?P<waiting>\d+)')
+
+log = logging.getLogger(__name__)
+
+# Objects in this process, like the paster theme filter, whose collect()
+# returns [`Metric`]; see `register`. Held weakly so they can still go away.
+REGISTRY = weakref.WeakSet()
+
+
+class Metric(object):
+    """A metric family: name, type, help, and its samples."""
+
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.samples = []
+
+    def add(self, value, suffix='', **labels):
+        self.samples.append((suffix, labels, value))
+        return self
+
+    def add_histogram(self, hist, **labels):
+        """Add a `tttdiazo.logstats.Histogram` as buckets, sum and count."""
+        for bound, count in zip(BUCKETS, hist.cumulative(BUCKETS)):
+            self.add(count, '_bucket', le=repr(bound), **labels)
+        self.add(hist.count, '_bucket', le='+Inf', **labels)
+        self.add(hist.total, '_sum', **labels)
+        self.add(hist.count, '_count', **labels)
+        return self
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def render(metrics):
+    """Return metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for suffix, labels, value in metric.samples:
+            label_text = ','.join('{}="{}"'.format(k, escape(v)) for k, v in sorted(labels.items()))
+            lines.append('{}{}{} {}'.format(metric.name, suffix,
+                                            '{' + label_text + '}' if label_text else '',
+                                            repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def register(obj):
+    """Export what obj.collect() returns from this process's metrics app."""
+    REGISTRY.add(obj)
+
+
+def collect_registry():
+    metrics = []
+    for obj in list(REGISTRY):
+        metrics.extend(obj.collect())
+    return metrics
+
+
+def parse_stub_status(text):
+    """Return stub_status's counters as a dict of ints, or None."""
+    match = STUB_STATUS_RE.search(text)
+    if not match:
+        return None
+    return dict((k, int(v)) for k, v in match.groupdict().items())
+
+
+class StubStatus(object):
+    """Collect nginx's stub_status page."""
+
+    def __init__(self, url, timeout=2):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self):
+        try:
+            status = parse_stub_status(requests.get(self.url, timeout=self.timeout).text)
+        except requests.RequestException as err:
+            log.warning('Cannot read %s: %s', self.url, err)
+            status = None
+        up = Metric('nginx_up', 'gauge', 'Whether stub_status could be read.')
+        if status is None:
+            return [up.add(0)]
+        metrics = [up.add(1),
+                   Metric('nginx_connections_active', 'gauge',
+                          'Open client connections, including idle ones.').add(status['active'])]
+        for state in ('reading', 'writing', 'waiting'):
+            metrics.append(Metric('nginx_connections_' + state, 'gauge',
+                                  'Connections {} now.'.format(state)).add(status[state]))
+        metrics.extend([
+            Metric('nginx_connections_accepted_total', 'counter',
+                   'Client connections accepted.').add(status['accepts']),
+            Metric('nginx_connections_handled_total', 'counter',
+                   'Client connections handled.').add(status['handled']),
+            Metric('nginx_http_requests_total', 'counter',
+                   'Client requests.').add(status['requests']),
+        ])
+        return metrics
+
+
+class LogMetrics(object):
+    """Tail the nginx logs in a directory into a `LogStats`, and export it.
+
+    Only lines written after the exporter started count, so the counters
+    start from zero like any other restarted process's.
+    """
+
+    def __init__(self, directory, max_routes=DEFAULT_MAX_ROUTES):
+        self.directory = directory
+        self.stats = LogStats(max_routes)
+        self.followers = {}
+
+    def read(self):
+        for name in (ACCESS_LOG, CACHE_LOG, XSLT_LOG):
+            path = os.path.join(self.directory, name)
+            if name not in self.followers:
+                if not os.path.exists(path):
+                    continue
+                self.followers[name] = Follower(path)
+            add = self.stats.adder(path)
+            for line in self.followers[name].lines():
+                add(line)
+
+    def __call__(self):
+        self.read()
+        requests_total = Metric('tttdiazo_requests_total', 'counter',
+                                'Requests the tttdiazo server answered, by route.')
+        request = Metric('tttdiazo_request_duration_seconds', 'histogram',
+                         'tttdiazo server request time, by route.')
+        origin = Metric('tttdiazo_origin_duration_seconds', 'histogram',
+                        'Origin response time for themed requests, by route.')
+        theming = Metric('tttdiazo_theming_duration_seconds', 'histogram',
+                         'Request time less origin time for themed requests, by route.')
+        cache_requests = Metric('tttdiazo_microcache_requests_total', 'counter',
+                                'Requests through the microcache front end, by route.')
+        cache_hits = Metric('tttdiazo_microcache_hits_total', 'counter',
+                            'Requests answered from the microcache ({}), by route.'.format(
+                                ', '.join(HIT_STATUSES)))
+        errors = Metric('tttdiazo_xslt_errors_total', 'counter',
+                        'XSLT errors logged, by route.')
+        for route, stats in sorted(self.stats.routes.items()):
+            requests_total.add(stats.requests, route=route)
+            request.add_histogram(stats.request, route=route)
+            origin.add_histogram(stats.origin, route=route)
+            theming.add_histogram(stats.theming, route=route)
+            cache_requests.add(stats.cache_requests, route=route)
+            cache_hits.add(stats.hits, route=route)
+            errors.add(stats.errors, route=route)
+        hits = sum(s.hits for s in self.stats.routes.values())
+        lookups = sum(s.cache_requests for s in self.stats.routes.values())
+        ratio = Metric('tttdiazo_microcache_hit_ratio', 'gauge',
+                       'Microcache hits over requests since the exporter started.')
+        ratio.add(float(hits) / lookups if lookups else 0)
+        unparsed = Metric('tttdiazo_log_lines_unparsed_total', 'counter',
+                          'Log lines the exporter could not parse.').add(self.stats.unparsed)
+        return [requests_total, request, origin, theming, cache_requests, cache_hits,
+                ratio, errors, unparsed]
+
+
+def process_rss():
+    """Return {pid: (ppid, rss bytes)} for every process, from `ps`."""
+    out = subprocess.check_output(['ps', '-A', '-o', 'pid=,ppid=,rss='])
+    table = {}
+    for line in out.decode().splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            table[int(fields[0])] = (int(fields[1]), int(fields[2]) * 1024)
+    return table
+
+
+class NginxRSS(object):
+    """Collect the resident memory of the nginx master in pid_file and its workers."""
+
+    def __init__(self, pid_file):
+        self.pid_file = pid_file
+
+    def __call__(self):
+        metric = Metric('nginx_rss_bytes', 'gauge',
+                        'Resident memory of the nginx master and each worker.')
+        try:
+            with open(self.pid_file) as f:
+                master = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return [metric]
+        table = process_rss()
+        if master in table:
+            metric.add(table[master][1], process='master', pid=master)
+        for pid, (ppid, rss) in sorted(table.items()):
+            if ppid == master:
+                metric.add(rss, process='worker', pid=pid)
+        return [metric]
+
+
+def own_rss():
+    """Return [`Metric`] with this process's resident memory."""
+    rss = process_rss().get(os.getpid(), (None, 0))[1]
+    return [Metric('process_resident_memory_bytes', 'gauge',
+                   'Resident memory of this process.').add(rss)]
+
+
+class MetricsApp(object):
+    """WSGI app answering any GET with the collectors' metrics.
+
+    Scrapes are serialized: the log collector keeps state between them.
+    """
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            metrics = []
+            for collector in self.collectors:
+                metrics.extend(collector())
+        response = Response(render(metrics).encode('utf-8'), content_type=CONTENT_TYPE)
+        return response(environ, start_response)
+
+
+def app_factory(global_conf, **local_conf):
+    """Paste app_factory for ``use = egg:tttdiazo#metrics``."""
+    return MetricsApp([own_rss, collect_registry])
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Serve nginx stub_status, log latency histograms, microcache hit '
+                    'ratio and nginx RSS as Prometheus metrics.')
+    parser.add_argument('-l', '--listen', default=DEFAULT_LISTEN,
+                        help='host:port to serve on. Default: {}.'.format(DEFAULT_LISTEN))
+    parser.add_argument('-s', '--status-url', default=DEFAULT_STATUS_URL,
+                        help='nginx stub_status URL. Default: {}.'.format(DEFAULT_STATUS_URL))
+    parser.add_argument('-d', '--log-dir', default='var/log',
+                        help='nginx log directory. Default: var/log.')
+    parser.add_argument('-p', '--pid-file', default='var/nginx.pid',
+                        help='nginx master pid file. Default: var/nginx.pid.')
+    parser.add_argument('-m', '--max-routes', type=int, default=DEFAULT_MAX_ROUTES,
+                        help='Routes labelled individually before lumping the rest '
+                             'into "{}". Default: {}.'.format(OTHER, DEFAULT_MAX_ROUTES))
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-metrics console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    args = init_parser().parse_args()
+    host, _, port = args.listen.rpartition(':')
+    app = MetricsApp([StubStatus(args.status_url), LogMetrics(args.log_dir, args.max_routes),
+                      NginxRSS(args.pid_file)])
+    server = make_server(host or '127.0.0.1', int(port), app, handler_class=QuietHandler)
+    log.info('Serving metrics on http://%s/metrics', args.listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        return 0
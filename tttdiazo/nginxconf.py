@@ -0,0 +1,276 @@
+"""Generate the tttdiazo server's nginx location blocks and notheme map.
+
+Hand-listing locations in templates/nginx.conf.in meant every special case,
+like not theming /sitemap.xml, was edited in by hand and every request went
+through the one XSLT `location /`. Instead we derive the blocks:
+
+* an exact-match location for each pre-rendered route in static_routes.txt,
+  served from var/static-ized and themed on the fly only on a miss;
+* the proxied-and-themed `location /` for everything else.
+
+Every ``<notheme if-path>`` in rules.xml becomes an entry in a
+``map $uri $diazo_notheme`` table, so nginx skips theming where paster does.
+The themed locations hand those paths to ``@unthemed``, which has no xslt_*
+directives: the XSLT filter never buffers or parses their bodies.
+
+Both are spliced into the nginx template at its NOTHEME_MAP and LOCATIONS
+marker lines, still carrying buildout ``${:option}`` references, so each
+nginx-*-conf part fills in its own origins and ports as before. The
+WORKERS line becomes worker directives sized to the machine, and each
+listen gets ``reuseport`` if there's more than one worker; see
+`tttdiazo.nginxworkers`::
+
+  bin/tttdiazo-nginx-template -i templates/nginx.conf.in \\
+      -o parts/nginx.conf.in -r rules.xml -u static_routes.txt \\
+      --aws-ini=prod.ini
+
+The nginx-*-conf parts use `TemplateRecipe` (``recipe = tttdiazo:template``)
+rather than collective.recipe.template, which reads its input when buildout
+creates the recipes, before any part is installed: before this script has
+written parts/nginx.conf.in on a clean build, and from the last run's
+output otherwise.
+"""
+import argparse
+import logging
+import os
+import re
+
+from lxml import etree
+
+from tttdiazo.nginxworkers import (AUTO, WORKERS, add_reuseport, aws_instance_type, machine,
+                                   render_workers, size)
+from tttdiazo.prerender import read_routes, route_file
+from tttdiazo.themefiles import NAMESPACES
+
+LOCATIONS = '#@LOCATIONS@'
+NOTHEME_MAP = '#@NOTHEME_MAP@'
+# A buildout substitution, ${section:option}; no section means the part's own.
+SUBSTITUTION_RE = re.compile(r'\$\{([-a-zA-Z0-9 ._]*):([-a-zA-Z0-9 ._]+)\}')
+
+log = logging.getLogger(__name__)
+
+PROXY = """\
+            proxy_pass http://tttdiazo_origin;
+            # The upstream name isn't the origin's, so rewrite its own
+            # absolute redirects ourselves.
+            proxy_redirect http://${:backend_host}/ /;
+            proxy_read_timeout ${:timeout};
+            # in dev conn to localhost:8888, sends backend name to backend
+            # proxy_set_header Host $host;
+            proxy_set_header Host ${:backend_host};
+            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+            # Reuse the origin connections kept in the upstream pool.
+            proxy_set_header Connection "";
+"""
+
+THEMED = """\
+            error_log  ${buildout:directory}/var/log/nginx-xslt.log warn;
+
+            # Enable XSLT to fix broken HTML and xform HTML in addition to text/xml.
+            xslt_html_parser on;
+            xslt_types text/html;
+
+            # Tell the XSLT module which XSL file to use, and enable Diazo
+            # rules.xml 'if-path' matching by setting set the 'path' variable
+            # equal to this $uri.
+            xslt_stylesheet ${:themexsl} path='$uri';
+
+            # Proxy each request back to origin before applying XSLT to it.
+""" + PROXY + """
+            # We must not globally hide/ignore Set-Cookie; this doesn't seem
+            # required but explicit is better than implicit.
+            proxy_pass_header Set-Cookie;
+"""
+
+STATIC = """\
+        location = {route} {{
+            root $staticized_root;
+            try_files {file} @themed;
+        }}
+"""
+
+# Sent from the themed locations when $diazo_notheme is set; an `if` holding
+# only a `return` is safe, and the unthemed location has no xslt_* at all.
+NOTHEME = """\
+            error_page 418 = @unthemed;
+            if ($diazo_notheme) {
+                return 418;
+            }
+
+"""
+
+
+def notheme_paths(rules):
+    """Return the if-path tokens of every <notheme> in rules, xi:includes too.
+
+    Conditions nginx can't evaluate (on content, or if-not-path) are logged
+    and skipped: those pages are still left unthemed by paster only.
+    """
+    tree = etree.parse(rules)
+    tree.xinclude()
+    tokens = []
+    for notheme in tree.xpath('//dz:notheme', namespaces=NAMESPACES):
+        others = set(notheme.attrib) - set(['if-path'])
+        if others or 'if-path' not in notheme.attrib:
+            log.warning('Skipping <notheme %s>: nginx can only match if-path',
+                        ' '.join(sorted(notheme.attrib)))
+            continue
+        tokens.extend(notheme.get('if-path').split())
+    return tokens
+
+
+def path_regex(token):
+    """Return a PCRE matching $uri exactly where diazo's if-path token would.
+
+    Diazo compares against the path with a trailing slash added: '/a/' is
+    exact, '/a' a prefix, 'a/' a suffix and 'a' a path segment anywhere.
+    """
+    path = re.escape(token.strip('/'))
+    if token.startswith('/') and token.endswith('/'):
+        return '^/{}/?$'.format(path)
+    if token.endswith('/'):
+        return '/{}/?$'.format(path)
+    if token.startswith('/'):
+        return '^/{}(/|$)'.format(path)
+    return '/{}(/|$)'.format(path)
+
+
+def render_map(tokens):
+    """Return the `map $uri $diazo_notheme` table for the notheme tokens.
+
+    Exact tokens become plain entries, found by hash lookup; the rest are
+    regexes, tried in rules.xml order only when no exact entry matched.
+    """
+    lines = ['    # <notheme if-path> rules from rules.xml: nonzero leaves $uri unthemed.\n',
+             '    map $uri $diazo_notheme {\n',
+             '        default  0;\n']
+    for token in tokens:
+        if token.startswith('/') and token.endswith('/') and len(token) > 1:
+            lines.append('        {}  1;\n'.format(token.rstrip('/')))
+            lines.append('        {}  1;\n'.format(token))
+            continue
+        regex = '~' + path_regex(token)
+        if ' ' in regex or '{' in regex or ';' in regex:
+            regex = '"{}"'.format(regex)
+        lines.append('        {}  1;  # {}\n'.format(regex, token))
+    lines.append('    }\n')
+    return ''.join(lines)
+
+
+def render_locations(routes):
+    """Return the nginx location blocks for the static routes and the rest."""
+    blocks = ['\n        # Pre-rendered (static-ized) routes from static_routes.txt,\n'
+              '        # served from disk; themed on the fly if not rendered yet.\n']
+    for route in routes:
+        blocks.append(STATIC.format(route=route, file=route_file('/', route)))
+    blocks.append('\n        # Theme all the other pages.\n'
+                  '        location / {\n' + NOTHEME + THEMED + '        }\n'
+                  '\n        # Theme pre-rendered routes missing from disk.\n'
+                  '        location @themed {\n' + NOTHEME + THEMED + '        }\n'
+                  '\n        # Pass <notheme> paths through without the XSLT filter.\n'
+                  '        location @unthemed {\n' + PROXY + '        }\n')
+    return ''.join(blocks)
+
+
+def render_template(template, sections):
+    """Return template with each marker line replaced by its section.
+
+    :param dict sections: {marker: text}, e.g. {LOCATIONS: ..., NOTHEME_MAP: ...}
+    """
+    lines = template.splitlines(True)
+    missing = set(sections)
+    for i, line in enumerate(lines):
+        if line.strip() in sections:
+            missing.discard(line.strip())
+            lines[i] = sections[line.strip()]
+    if missing:
+        raise ValueError('No {} line in the nginx template'.format(', '.join(sorted(missing))))
+    return ''.join(lines)
+
+
+def substitute(text, buildout, name):
+    """Return text with buildout's ${section:option}s filled in, $$ as $."""
+    def option(match):
+        return buildout[match.group(1) or name][match.group(2)]
+    return '$'.join(SUBSTITUTION_RE.sub(option, part) for part in text.split('$$'))
+
+
+class TemplateRecipe(object):
+    """Buildout recipe writing `input` to `output` with options substituted.
+
+    Like collective.recipe.template, but the input is read when the part is
+    installed or updated, so it may be another part's output.
+    """
+
+    def __init__(self, buildout, name, options):
+        self.buildout = buildout
+        self.name = name
+        self.options = options
+
+    def install(self):
+        with open(self.options['input']) as f:
+            text = substitute(f.read(), self.buildout, self.name)
+        directory = os.path.dirname(self.options['output'])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.options['output'], 'w') as f:
+            f.write(text)
+        return [self.options['output']]
+
+    update = install
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Write an nginx template with location blocks derived '
+                    'from rules.xml and the static-ized routes.')
+    parser.add_argument('-i', '--input', required=True,
+                        help='nginx template with {} and {} lines.'.format(
+                            NOTHEME_MAP, LOCATIONS))
+    parser.add_argument('-o', '--output', required=True,
+                        help='Template to write, for collective.recipe.template.')
+    parser.add_argument('-r', '--rules', required=True,
+                        help='Diazo rules file, e.g. rules.xml.')
+    parser.add_argument('-u', '--routes',
+                        help='Pre-rendered routes file, e.g. static_routes.txt.')
+    parser.add_argument('--instance-type',
+                        help='Size workers for this EC2 instance type, e.g. c4.xlarge. '
+                             'Default: this machine.')
+    parser.add_argument('--aws-ini',
+                        help='Take the instance type from launchconfig.instance_type '
+                             'in this .ini, e.g. prod.ini.')
+    for option, help in (('workers', 'worker_processes. Default: one per core.'),
+                         ('connections', 'worker_connections. Default: by memory.'),
+                         ('affinity', 'on or off: pin each worker to a core. '
+                                      'Default: on with more than one worker.'),
+                         ('reuseport', 'on or off: reuseport on each listen. '
+                                       'Default: on with more than one worker.')):
+        parser.add_argument('--' + option, default=AUTO, help=help)
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-nginx-template console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    args = init_parser().parse_args()
+    routes = read_routes(args.routes) if args.routes else []
+    with open(args.input) as f:
+        template = f.read()
+    instance_type = args.instance_type
+    if not instance_type and args.aws_ini:
+        instance_type = aws_instance_type(args.aws_ini)
+    cores, memory_gb = machine(instance_type)
+    sizing = size(cores, memory_gb, args.workers, args.connections, args.affinity,
+                  args.reuseport)
+    log.info('nginx: %d workers, %d connections each, for %d cores%s', sizing['workers'],
+             sizing['connections'], cores, ' of ' + instance_type if instance_type else '')
+    sections = {NOTHEME_MAP: render_map(notheme_paths(args.rules)),
+                LOCATIONS: render_locations(routes),
+                WORKERS: render_workers(sizing)}
+    output = render_template(template, sections)
+    if sizing['reuseport']:
+        output = add_reuseport(output)
+    with open(args.output, 'w') as f:
+        f.write(output)
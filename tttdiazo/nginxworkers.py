@@ -0,0 +1,166 @@
+"""Size nginx's workers to the box: one XSLT worker per core.
+
+The XSLT module transforms in the worker that took the request, so with one
+worker nginx themes on one core however many the instance has. The
+template's WORKERS marker line becomes::
+
+  worker_processes     4;
+  worker_cpu_affinity  0001 0010 0100 1000;
+  worker_rlimit_nofile 8256;
+  events {
+      worker_connections  4096;
+  }
+
+and with more than one worker each ``listen`` gets ``reuseport``, so the
+kernel spreads new connections over the workers instead of waking them all.
+
+* workers: one per core. The cores come from ``--instance-type``, or
+  ``launchconfig.instance_type`` in the ``[config:aws]`` of ``--aws-ini``
+  (prod.ini) when we build for it, else from the box we build on.
+* connections: 1024 per GiB of memory shared among the workers, at least
+  1024 each and at most 16384. Each proxied request holds a client and an
+  origin connection, and both count.
+* worker_cpu_affinity pins worker n to core n, written as bitmasks:
+  nginx 1.9.9 predates ``auto``.
+
+Each is ``auto`` unless overridden, e.g. ``workers = 2`` in buildout's
+``[nginx-template]`` part.
+"""
+import logging
+import multiprocessing
+import os
+import re
+
+try:
+    from configparser import RawConfigParser
+except ImportError:     # Python 2
+    from ConfigParser import RawConfigParser
+
+WORKERS = '#@WORKERS@'
+AUTO = 'auto'
+CONNECTIONS_PER_GB = 1024
+MIN_CONNECTIONS = 1024
+MAX_CONNECTIONS = 16384
+
+# EC2 instance types we might run on: (vCPUs, memory GiB).
+INSTANCE_TYPES = {
+    't2.nano': (1, 0.5),
+    't2.micro': (1, 1),
+    't2.small': (1, 2),
+    't2.medium': (2, 4),
+    't2.large': (2, 8),
+    't2.xlarge': (4, 16),
+    't2.2xlarge': (8, 32),
+    'm4.large': (2, 8),
+    'm4.xlarge': (4, 16),
+    'm4.2xlarge': (8, 32),
+    'm4.4xlarge': (16, 64),
+    'c4.large': (2, 3.75),
+    'c4.xlarge': (4, 7.5),
+    'c4.2xlarge': (8, 15),
+    'c4.4xlarge': (16, 30),
+    'c5.large': (2, 4),
+    'c5.xlarge': (4, 8),
+    'c5.2xlarge': (8, 16),
+    'c5.4xlarge': (16, 32),
+}
+
+# Live TCP listens; reuseport is for TCP, not unix sockets.
+LISTEN_RE = re.compile(r'^(\s*listen\s+(?!\s|unix:)[^;#]*?)\s*;', re.M)
+HTTP_RE = re.compile(r'^http\s*\{', re.M)
+
+log = logging.getLogger(__name__)
+
+
+def detect_memory_gb():
+    """Return this box's memory in GiB, or None if we can't tell."""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / float(1024 ** 3)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def aws_instance_type(ini):
+    """Return ``launchconfig.instance_type`` from an .ini's [config:aws], or None."""
+    config = RawConfigParser()
+    config.read(ini)
+    if config.has_option('config:aws', 'launchconfig.instance_type'):
+        return config.get('config:aws', 'launchconfig.instance_type')
+    return None
+
+
+def machine(instance_type=None):
+    """Return (cores, memory GiB) of instance_type if we know it, else of this box."""
+    if instance_type:
+        if instance_type in INSTANCE_TYPES:
+            return INSTANCE_TYPES[instance_type]
+        log.warning('Unknown instance type %s; sizing for this box', instance_type)
+    return multiprocessing.cpu_count(), detect_memory_gb()
+
+
+def affinity_masks(workers, cores):
+    """Return worker_cpu_affinity bitmasks pinning worker n to core n."""
+    return ['{:0{}b}'.format(1 << (n % cores), cores) for n in range(workers)]
+
+
+def size(cores, memory_gb=None, workers=AUTO, connections=AUTO, affinity=AUTO,
+         reuseport=AUTO):
+    """Return a dict of worker settings for a machine, with overrides.
+
+    Overrides are ints or 'on'/'off' strings as in buildout; AUTO derives them.
+    """
+    workers = cores if workers == AUTO else int(workers)
+    if connections == AUTO:
+        budget = CONNECTIONS_PER_GB * (memory_gb or 1)
+        connections = int(min(MAX_CONNECTIONS, max(MIN_CONNECTIONS, budget / workers)))
+    else:
+        connections = int(connections)
+    if affinity == AUTO:
+        affinity = 1 < workers <= cores
+    else:
+        affinity = affinity in ('on', 'true', True)
+    if reuseport == AUTO:
+        reuseport = workers > 1
+    else:
+        reuseport = reuseport in ('on', 'true', True)
+    return {
+        'workers': workers,
+        'connections': connections,
+        'affinity': affinity_masks(workers, cores) if affinity else None,
+        # Each connection may be a client's plus an origin's descriptor.
+        'nofile': 2 * connections + 64,
+        'reuseport': reuseport,
+    }
+
+
+def render_workers(sizing):
+    """Return the top-level worker directives and events block for sizing."""
+    lines = ['worker_processes     {};\n'.format(sizing['workers'])]
+    if sizing['affinity']:
+        lines.append('worker_cpu_affinity  {};\n'.format(' '.join(sizing['affinity'])))
+    lines.append('worker_rlimit_nofile {};\n'.format(sizing['nofile']))
+    lines.append('\nevents {{\n    worker_connections  {};\n}}\n'.format(sizing['connections']))
+    return ''.join(lines)
+
+
+def add_reuseport(text):
+    """Return nginx config text with ``reuseport`` on every live TCP listen."""
+    def listen(match):
+        if 'reuseport' in match.group(1).split():
+            return match.group(0)
+        return match.group(1) + ' reuseport;'
+    return LISTEN_RE.sub(listen, text)
+
+
+def resize(conf, sizing):
+    """Return a rendered nginx.conf with its worker directives replaced by sizing.
+
+    tests/benchmark.py runs the same config with different worker counts.
+    """
+    match = HTTP_RE.search(conf)
+    if match is None:
+        raise ValueError('No http block in the nginx config')
+    rest = conf[match.start():]
+    if sizing['reuseport']:
+        rest = add_reuseport(rest)
+    return render_workers(sizing) + '\n' + rest
@@ -0,0 +1,151 @@
+"""Rewrite the XPath diazo compiles into cheaper equivalents.
+
+Diazo turns CSS selectors into descendant-axis XPath: ``#logo`` becomes
+``//*[@id = 'logo']``, which walks every node of the content each time it's
+selected. After compiling we rewrite the stylesheet:
+
+* id lookups in ``select`` and ``test`` expressions use an ``xsl:key``
+  index, built in one pass per page, instead of a scan each;
+* ``//html``, ``//head`` and ``//body`` are anchored at the root, where
+  lxml's and nginx's HTML parsers always put them;
+* a template with the same match, mode and priority as a later one is
+  dropped: XSLT only ever applies the last, so it's dead weight on every
+  match attempt. Named templates stay, since xsl:call-template may use them.
+
+`check` runs the original and optimized stylesheets over a page corpus and
+returns the pages whose output differs, so an optimization that changes
+output is caught before it ships::
+
+  bin/tttdiazo-compile -O -n -r rules.xml -o etc/theme.xsl -s xsl-store
+  bin/tttdiazo-optimize -r rules.xml -c fixtures/origin
+"""
+import argparse
+import copy
+import difflib
+import logging
+import re
+
+from diazo.compiler import compile_theme
+from lxml import etree
+
+from tttdiazo.corpus import load_corpus, parse, transform_params
+
+# Part of the XSL store key, so a change to the rewrites here recompiles.
+VERSION = 2
+KEY_NAME = 'tttdiazo-id'
+XSL_NS = 'http://www.w3.org/1999/XSL/Transform'
+
+# //*[@id = 'x'] at the start of an expression or after |, ( or an operator;
+# not after a step, where it's relative to that step.
+ID_RE = re.compile(r'''(?<![\w\)\]\*\.@/-])//\*\[@id\s*=\s*(['"])([^'"]*)\1\]''')
+ANCHOR_RE = re.compile(r'''(?<![\w\)\]\*\.@/-])//(html|head|body)(?![\w.-])''')
+
+log = logging.getLogger(__name__)
+
+
+def rewrite(expression):
+    """Return expression with id lookups keyed and html/head/body anchored."""
+    expression = ID_RE.sub(lambda m: "key('{}', '{}')".format(KEY_NAME, m.group(2)),
+                           expression)
+
+    def anchor(match):
+        name = match.group(1)
+        return '/html' if name == 'html' else '/html/' + name
+    return ANCHOR_RE.sub(anchor, expression)
+
+
+def optimize(tree):
+    """Return (optimized copy of the compiled theme tree, list of changes)."""
+    tree = copy.deepcopy(tree)
+    root = tree.getroot()
+    changes = []
+    keyed = False
+    for element in root.iter('{%s}*' % XSL_NS):
+        for attr in ('select', 'test'):
+            value = element.get(attr)
+            if value is None:
+                continue
+            new = rewrite(value)
+            if new != value:
+                element.set(attr, new)
+                keyed = keyed or KEY_NAME in new
+                changes.append('{}: {} -> {}'.format(attr, value, new))
+
+    if keyed:
+        key = etree.Element('{%s}key' % XSL_NS, name=KEY_NAME, match='*[@id]', use='@id')
+        key.tail = '\n'
+        root.insert(0, key)
+
+    templates = root.findall('{%s}template' % XSL_NS)
+    seen = set()
+    for template in reversed(templates):
+        match = template.get('match')
+        if match is None or template.get('name') is not None:
+            continue
+        signature = (match, template.get('mode'), template.get('priority'))
+        if signature in seen:
+            root.remove(template)
+            changes.append('dropped shadowed template match="{}" mode="{}"'.format(
+                match, template.get('mode') or ''))
+        seen.add(signature)
+    return tree, changes
+
+
+def _serialize(transform, doc, params):
+    return bytes(transform(doc, **params))
+
+
+def check(original, optimized, pages):
+    """Return [(route, unified diff)] for pages whose output differs.
+
+    :param original: the compiled theme tree as diazo emitted it
+    :param optimized: the same after `optimize`
+    :param pages: [(route, body)] from `tttdiazo.corpus.load_corpus`
+    """
+    before = etree.XSLT(original)
+    after = etree.XSLT(optimized)
+    diffs = []
+    for route, body in pages:
+        doc = parse(body)
+        params = transform_params(route)
+        expected = _serialize(before, doc, params)
+        actual = _serialize(after, doc, params)
+        if expected != actual:
+            diff = difflib.unified_diff(
+                expected.decode('utf-8', 'replace').splitlines(),
+                actual.decode('utf-8', 'replace').splitlines(),
+                'original', 'optimized', lineterm='', n=1)
+            diffs.append((route, '\n'.join(diff)))
+    return diffs
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Check the optimized theme gives the same output as diazo\'s '
+                    'over a page corpus.')
+    parser.add_argument('-r', '--rules', default='rules.xml',
+                        help='Diazo rules file. Default: rules.xml.')
+    parser.add_argument('-c', '--corpus', required=True,
+                        help='Recorded fixtures or a directory of .html pages.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='List each rewrite.')
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-optimize console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    args = init_parser().parse_args()
+    original = compile_theme(args.rules, read_network=False)
+    optimized, changes = optimize(original)
+    if args.verbose:
+        for change in changes:
+            log.info(change)
+    pages = load_corpus(args.corpus)
+    diffs = check(original, optimized, pages)
+    for route, diff in diffs:
+        log.error('%s differs:\n%s', route, diff)
+    log.info('%d rewrites; %d of %d pages differ', len(changes), len(diffs), len(pages))
+    return 1 if diffs else 0
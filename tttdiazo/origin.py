@@ -0,0 +1,232 @@
+"""Stand-in for the ASP origin so we can benchmark theming offline.
+
+Every config points at http://www.v-studios.com, so any benchmark measures
+the network and the origin as much as our theming. This WSGI app serves
+canned pages shaped like the ASP site's instead: a head with title, meta
+and stylesheet links, a body with the #logo the rules replace, navigation
+and a content area, plus an XML /sitemap.xml and tiny /images/ and /photos/.
+
+It can also replay real pages. Record the paths in
+tests/integration_tests_urls.txt from the live site once::
+
+  bin/tttdiazo-origin-record -o fixtures/origin
+
+and set ``fixtures`` in origin.ini; recorded paths are then served as
+captured, anything else falls back to a canned page. ``latency`` adds a
+delay to every response to mimic the ASP server, and ``body_size`` pads
+HTML pages to at least that many bytes.
+
+Serve it with paster (see origin.ini), then point a config at it, like
+bench.ini or the buildout [nginx-bench-conf] part::
+
+  bin/paster serve origin.ini
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+
+import requests
+from webob import Response
+
+PAGE = """<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN">
+<html>
+<head>
+<title>{title} | Trade to Travel</title>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+<meta name="description" content="Luxury vacation home exchange">
+<link rel="stylesheet" type="text/css" href="/styles/main.css">
+<script type="text/javascript" src="/scripts/menu.js"></script>
+</head>
+<body>
+<div id="header">
+  <div id="logo"><a href="/"><img src="/images/logo.gif" alt="Trade to Travel"></a></div>
+  <ul id="nav">{nav}</ul>
+</div>
+<div id="page-title">{heading}</div>
+<div id="content">
+{paragraphs}
+</div>
+<div id="footer"><a href="/site-map.asp">Sitemap</a> |
+  <a href="/money-back-guarantee.asp">Money-Back Guarantee</a></div>
+</body>
+</html>
+"""
+
+NAV = ['/luxury-home-exchange.asp', '/luxury-property-exchange.asp',
+       '/vacation-property-search.asp', '/hotel-exchange.asp',
+       '/member-login.asp']
+
+PARAGRAPH = ('<p>Trade to Travel members exchange stays at villas, chalets '
+             'and city apartments around the world. <a href="{}">Read more'
+             '</a>.</p>')
+
+SITEMAP = """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+{}
+</urlset>
+"""
+
+# A 1x1 transparent GIF for /images/ and /photos/.
+GIF = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04'
+       b'\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D'
+       b'\x01\x00;')
+
+DEFAULT_PARAGRAPHS = 40
+DEFAULT_BACKEND = 'http://www.v-studios.com'
+DEFAULT_URL_FILE = os.path.join('tests', 'integration_tests_urls.txt')
+INDEX = 'index.json'
+# Recorded headers worth replaying; cookies and dates would only mislead.
+REPLAY_HEADERS = ('content-type', 'location', 'cache-control', 'expires')
+
+log = logging.getLogger(__name__)
+
+
+def canned_page(path, paragraphs=DEFAULT_PARAGRAPHS):
+    """Return an ASP-like HTML page for path."""
+    name = path.strip('/').rsplit('.', 1)[0].replace('-', ' ') or 'home'
+    nav = ''.join('<li><a href="{0}">{0}</a></li>'.format(href) for href in NAV)
+    body = '\n'.join(PARAGRAPH.format(NAV[i % len(NAV)])
+                     for i in range(paragraphs))
+    return PAGE.format(title=name.title(), heading=name.upper(), nav=nav,
+                       paragraphs=body)
+
+
+def pad(body, size):
+    """Return HTML body padded with paragraphs to at least size bytes.
+
+    The filler goes just before </body> so it's content the theme has to
+    copy, not something the transform can skip.
+    """
+    if len(body) >= size:
+        return body
+    para = PARAGRAPH.format(NAV[0]).encode('utf-8') + b'\n'
+    count = (size - len(body)) // len(para) + 1
+    filler = b'<div class="filler">\n' + para * count + b'</div>\n'
+    at = body.lower().rfind(b'</body>')
+    if at < 0:
+        return body + filler
+    return body[:at] + filler + body[at:]
+
+
+def load_fixtures(directory):
+    """Return {path: (status, headers, body)} recorded in directory."""
+    with open(os.path.join(directory, INDEX)) as f:
+        index = json.load(f)
+    fixtures = {}
+    for path, entry in index.items():
+        with open(os.path.join(directory, entry['body']), 'rb') as f:
+            fixtures[path] = (entry['status'], entry['headers'], f.read())
+    return fixtures
+
+
+def save_fixture(directory, index, path, status, headers, body):
+    """Write one response body into directory and record it in index.
+
+    Only the headers in REPLAY_HEADERS are kept.
+    """
+    name = hashlib.sha1(path.encode('utf-8')).hexdigest() + '.body'
+    with open(os.path.join(directory, name), 'wb') as f:
+        f.write(body)
+    kept = dict((k, v) for k, v in headers.items() if k.lower() in REPLAY_HEADERS)
+    index[path] = {'status': status, 'headers': kept, 'body': name}
+
+
+class OriginApp(object):
+    """WSGI app serving recorded pages, or canned ones for any .asp or root.
+
+    :param paragraphs: paragraphs in each canned page's #content
+    :param fixtures: directory written by `record`, or None
+    :param latency: seconds to wait before every response
+    :param body_size: pad HTML bodies to at least this many bytes
+    """
+
+    def __init__(self, paragraphs=DEFAULT_PARAGRAPHS, fixtures=None,
+                 latency=0, body_size=0):
+        self.paragraphs = int(paragraphs)
+        self.fixtures = load_fixtures(fixtures) if fixtures else {}
+        self.latency = float(latency)
+        self.body_size = int(body_size)
+
+    def __call__(self, environ, start_response):
+        if self.latency:
+            time.sleep(self.latency)
+        path = environ.get('PATH_INFO', '/') or '/'
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        res = self.response(path)
+        if self.body_size and res.content_type == 'text/html':
+            res.body = pad(res.body, self.body_size)
+        return res(environ, start_response)
+
+    def response(self, path):
+        """Return the webob Response for path."""
+        if path in self.fixtures:
+            status, headers, body = self.fixtures[path]
+            res = Response(body=body, status=status)
+            res.headers.update(headers)
+            return res
+        path = path.split('?', 1)[0]
+        if path == '/sitemap.xml':
+            urls = '\n'.join('<url><loc>{}</loc></url>'.format(href) for href in NAV)
+            return Response(body=SITEMAP.format(urls).encode('utf-8'),
+                            content_type='text/xml', charset=None)
+        if path.startswith(('/images/', '/photos/')):
+            return Response(body=GIF, content_type='image/gif')
+        if path == '/' or path.lower().endswith('.asp'):
+            return Response(canned_page(path, self.paragraphs),
+                            content_type='text/html', charset='utf-8')
+        return Response('Not Found', status=404, content_type='text/plain',
+                        charset='utf-8')
+
+
+def record(backend, paths, directory, host=None):
+    """Fetch each path from backend and save the responses as fixtures.
+
+    :param str host: Host header to send, if backend is an IP address
+    :returns: `dict` index of what was recorded
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    session = requests.Session()
+    headers = {'Host': host} if host else {}
+    index = {}
+    for path in paths:
+        res = session.get(backend + path, headers=headers, allow_redirects=False)
+        save_fixture(directory, index, path, res.status_code, res.headers, res.content)
+        log.info('%s %s %d bytes', res.status_code, path, len(res.content))
+    with open(os.path.join(directory, INDEX), 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    return index
+
+
+def init_record_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Record origin responses for the stand-in origin to replay.')
+    parser.add_argument('-b', '--backend', default=DEFAULT_BACKEND,
+                        help='Origin to record. Default: {}.'.format(DEFAULT_BACKEND))
+    parser.add_argument('-H', '--host',
+                        help='Host header to send, if --backend is an IP.')
+    parser.add_argument('-u', '--urls', default=DEFAULT_URL_FILE,
+                        help='File of paths to record. Default: {}.'.format(DEFAULT_URL_FILE))
+    parser.add_argument('-o', '--output', required=True,
+                        help='Fixture directory to write, e.g. fixtures/origin.')
+    return parser
+
+
+def record_main():
+    """Entrypoint for the tttdiazo-origin-record console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    args = init_record_parser().parse_args()
+    with open(args.urls) as f:
+        paths = [line.strip() for line in f if line.strip()]
+    record(args.backend.rstrip('/'), paths, args.output, args.host)
+
+
+def app_factory(global_conf, **local_conf):
+    """Paste app_factory for ``use = egg:tttdiazo#origin``."""
+    return OriginApp(**local_conf)
@@ -0,0 +1,153 @@
+"""Cache themed output keyed on the upstream response.
+
+Most ASP pages, like /trade-to-travel-story.asp, come back byte-for-byte the
+same on every request, yet the theme pipeline parses and transforms them
+each time. `OutputCacheMiddleware` wraps diazo's XSLT middleware: it fetches
+the upstream response itself, and if a page with the same body, request path
+and transform parameters (`path` and friends) was themed recently it returns
+that output without touching lxml. Only the themed body is kept: the headers
+always come from the current upstream response.
+
+Responses that set a cookie are never cached, nor are non-GET requests or
+anything but a 200 from upstream. Entries expire after a TTL and the least
+recently used are dropped to stay under a memory cap.
+
+Turn it on in the `egg:tttdiazo#theme` filter::
+
+  output_cache = true
+  output_cache_size = 64
+  output_cache_ttl = 300
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from webob import Request
+
+# The transform's upstream app replays the response we already fetched when
+# it finds one under this environ key.
+UPSTREAM_KEY = 'tttdiazo.upstream_response'
+# Whether we answered from the cache: HIT, MISS or BYPASS; sent on in the
+# Server-Timing header (see tttdiazo.servertiming).
+STATUS_KEY = 'tttdiazo.output_cache'
+
+DEFAULT_SIZE_MB = 64
+DEFAULT_TTL = 300
+
+
+class LRUCache(object):
+    """Thread-safe LRU of byte strings with a total size cap and a TTL."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.bytes -= entry[2]
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # now the most recently used
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, size):
+        """Store value, accounted as size bytes, evicting as needed."""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (time.time() + self.ttl, value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+class OutputCacheMiddleware(object):
+    """Wrap a diazo XSLTMiddleware with a cache of its output.
+
+    :param transform: the `diazo.wsgi.XSLTMiddleware` to wrap; its app is
+                      replaced so it can replay the upstream response we fetch
+    :param cache: an `LRUCache`; clear it when the theme changes
+    """
+
+    def __init__(self, transform, cache):
+        self.transform = transform
+        self.upstream = transform.app
+        self.cache = cache
+        transform.app = self.replay
+
+    def replay(self, environ, start_response):
+        response = environ.pop(UPSTREAM_KEY, None)
+        if response is None:
+            return self.upstream(environ, start_response)
+        return response(environ, start_response)
+
+    def key(self, environ, body):
+        """Return the cache key: the body plus what the transform sees."""
+        sha = hashlib.sha1()
+        sha.update(environ.get('PATH_INFO', '').encode('utf-8'))
+        sha.update(environ.get('QUERY_STRING', '').encode('utf-8'))
+        for name in sorted(self.transform.environ_param_map):
+            sha.update(('\0{}={}'.format(name, environ.get(name, ''))).encode('utf-8'))
+        sha.update(b'\0')
+        sha.update(body)
+        return sha.hexdigest()
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        environ[STATUS_KEY] = 'BYPASS'
+        if request.method != 'GET' or self.transform.should_ignore(request):
+            return self.transform(environ, start_response)
+        # Ask upstream exactly what the transform would have asked.
+        request.remove_conditional_headers(remove_encoding=True, remove_range=False,
+                                           remove_match=False, remove_modified=True)
+        upstream = request.get_response(self.upstream)
+        environ[UPSTREAM_KEY] = upstream
+        if upstream.status_int != 200 or 'Set-Cookie' in upstream.headers:
+            return self.transform(environ, start_response)
+        if not self.transform.should_transform(upstream):
+            return self.transform(environ, start_response)
+
+        key = self.key(environ, upstream.body)
+        hit = self.cache.get(key)
+        if hit is not None:
+            # Only the themed output is cached; caching headers like Date and
+            # Expires come from this upstream response, as on a miss.
+            environ.pop(UPSTREAM_KEY, None)
+            environ[STATUS_KEY] = 'HIT'
+            status, content_type, body = hit
+            self.transform.reset_headers(upstream)
+            upstream.status = status
+            upstream.headers['Content-Type'] = content_type
+            upstream.body = body
+            return upstream(environ, start_response)
+
+        environ[STATUS_KEY] = 'MISS'
+        themed = Request(environ).get_response(self.transform)
+        body = themed.body
+        if themed.status_int == 200:
+            self.cache.put(key, (themed.status, themed.headers['Content-Type'], body),
+                           len(body))
+        return themed(environ, start_response)
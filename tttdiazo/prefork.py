@@ -0,0 +1,267 @@
+"""Pre-fork the paster pipeline: a process per core, one compiled theme.
+
+``egg:Paste#http`` serves every request from threads of one process, so
+the GIL lets one transform's Python -- parsing glue, serializing, the
+filter itself -- run at a time however many cores the box has. Serve the
+same pipeline with::
+
+  [server:prefork]
+  use = egg:tttdiazo#prefork
+  host = 0.0.0.0
+  port = 5000
+  workers = 4
+
+  bin/paster serve local.ini --server-name=prefork
+
+The master loads the app and compiles the theme of every
+``egg:tttdiazo#theme`` filter in it before forking ``workers`` processes
+(default: one per CPU), which share the compiled XSLT copy-on-write and
+stop checking the theme sources themselves. Each worker listens on its own
+socket with SO_REUSEPORT, so the kernel spreads connections over them like
+nginx's ``reuseport``; with ``reuse_port = false``, or where there is no
+SO_REUSEPORT, they accept from one socket the master opened.
+
+The master watches the theme instead, every ``reload_interval`` seconds.
+When rules.xml, the theme or a file they include changes, or on SIGHUP, it
+recompiles, forks a new set of workers and then tells the old ones to
+finish their requests and exit, giving them ``graceful_timeout`` seconds.
+SIGTERM or Ctrl-C stops all workers the same way. A worker that dies is
+replaced.
+"""
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from multiprocessing import cpu_count
+from wsgiref.simple_server import WSGIServer
+
+from diazo.wsgi import asbool
+
+from tttdiazo.metrics import QuietHandler
+from tttdiazo.themecache import compile_all, freeze_all
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:     # Python 2
+    from SocketServer import ThreadingMixIn
+
+DEFAULT_RELOAD_INTERVAL = 1.0
+DEFAULT_GRACEFUL_TIMEOUT = 30
+# How often a worker checks whether it was told to stop, in seconds.
+POLL = 0.2
+
+log = logging.getLogger(__name__)
+
+
+def listen(host, port, reuse_port=False, backlog=128):
+    """Return a listening socket on host:port, with SO_REUSEPORT if asked."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class WorkerServer(ThreadingMixIn, WSGIServer):
+    """WSGI server on an already listening socket, a thread per request.
+
+    `drain` serves the connections already queued on the socket and `join`
+    waits for the requests in progress: ThreadingMixIn only does that
+    itself from Python 3.7.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, sock, app):
+        WSGIServer.__init__(self, sock.getsockname(), QuietHandler, bind_and_activate=False)
+        self.socket = sock
+        host, port = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+        self.timeout = POLL
+        self.idle = False
+        self.threads = set()
+        self.threads_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self.threads_lock:
+            self.threads.add(thread)
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.threads_lock:
+                self.threads.discard(threading.current_thread())
+
+    def join(self, timeout):
+        """Wait up to timeout seconds for the requests in progress."""
+        deadline = time.time() + timeout
+        with self.threads_lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+    def handle_timeout(self):
+        self.idle = True
+
+    def drain(self):
+        self.timeout = 0
+        self.idle = False
+        while not self.idle:
+            self.handle_request()
+
+
+def run_worker(app, sock, graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT):
+    """Serve app on sock until SIGTERM, then finish the requests it has.
+
+    Up to `POLL` seconds pass between SIGTERM and taking no more requests,
+    and we wait up to graceful_timeout seconds for those in progress.
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    # Ctrl-C reaches the whole process group; the master stops us in order.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    server = WorkerServer(sock, app)
+    while not stopping:
+        server.handle_request()
+    server.drain()
+    server.join(graceful_timeout)
+    server.server_close()
+
+
+class Master(object):
+    """Fork, watch and replace the workers serving app."""
+
+    def __init__(self, app, host, port, workers, reuse_port=True,
+                 reload_interval=DEFAULT_RELOAD_INTERVAL,
+                 graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.size = workers
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.reload_interval = reload_interval
+        self.graceful_timeout = graceful_timeout
+        self.sock = None
+        self.workers = set()
+        self.retiring = {}      # pid: time to kill it by
+        self.stopping = False
+        self.reload_requested = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return pid
+        code = 0
+        try:
+            freeze_all()
+            sock = self.sock or listen(self.host, self.port, reuse_port=True)
+            run_worker(self.app, sock, self.graceful_timeout)
+        except BaseException:
+            log.exception('Worker %d failed', os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def retire(self, pids):
+        """Tell workers to finish their requests and exit."""
+        deadline = time.time() + self.graceful_timeout
+        for pid in pids:
+            self.workers.discard(pid)
+            self.retiring[pid] = deadline
+            self.signal(pid, signal.SIGTERM)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def reap(self):
+        """Collect exited workers, replacing any that weren't told to go."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:     # no children left
+                return
+            if not pid:
+                break
+            if pid in self.retiring:
+                del self.retiring[pid]
+            elif pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping:
+                    log.warning('Worker %d exited with status %d; replacing it', pid, status)
+                    self.spawn()
+        now = time.time()
+        for pid, deadline in list(self.retiring.items()):
+            if now > deadline:
+                log.warning('Worker %d still busy after %ss; killing it',
+                            pid, self.graceful_timeout)
+                self.signal(pid, signal.SIGKILL)
+
+    def reload(self):
+        """Start workers with the current theme, then retire the old ones."""
+        old = list(self.workers)
+        for _ in range(self.size):
+            self.spawn()
+        self.retire(old)
+        log.info('Reloaded: workers %s replace %s', sorted(self.workers), sorted(old))
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def run(self):
+        compile_all()
+        if self.reuse_port:
+            # Fail here, not in every worker, if the port is taken.
+            listen(self.host, self.port, reuse_port=True).close()
+        else:
+            self.sock = listen(self.host, self.port)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        for _ in range(self.size):
+            self.spawn()
+        log.info('Serving on http://%s:%d/ with %d workers%s', self.host, self.port, self.size,
+                 ' (SO_REUSEPORT)' if self.reuse_port else '')
+        while not self.stopping:
+            time.sleep(self.reload_interval)
+            self.reap()
+            if self.stopping:
+                break
+            if compile_all() or self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+        self.retire(list(self.workers))
+        while self.retiring:
+            time.sleep(POLL / 4)
+            self.reap()
+        if self.sock is not None:
+            self.sock.close()
+
+
+def server_runner(wsgi_app, global_conf, host='0.0.0.0', port=5000, workers=None,
+                  reuse_port=True, reload_interval=DEFAULT_RELOAD_INTERVAL,
+                  graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT):
+    """Paste server_runner for ``use = egg:tttdiazo#prefork``."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    Master(wsgi_app, host, int(port), int(workers) if workers else cpu_count(),
+           asbool(reuse_port), float(reload_interval), float(graceful_timeout)).run()
@@ -0,0 +1,203 @@
+"""Pre-render ("static-ize") themed pages so nginx can serve them from disk.
+
+For each route in the routes file we fetch the page from the origin, apply
+the compiled etc/theme.xsl in a pool of worker processes, and write the
+themed HTML under the static-ized directory, where the tttdiazo server's
+exact-match location for the route (see tttdiazo.nginxconf) finds it before
+falling back to proxying and theming. nginx
+serves those files with an ETag and a Last-Modified taken from the file's
+mtime: the origin's Last-Modified, or the render time when the page has no
+Last-Modified or is re-themed because the theme changed, so browsers
+holding the old theme don't get a 304.
+
+Runs are incremental: a manifest records each page's origin ETag,
+Last-Modified and body hash plus the theme's hash, so a refresh only
+re-themes pages whose origin content (or the theme) changed, and removes
+files for routes that were dropped or stopped returning HTML::
+
+  bin/tttdiazo-prerender -x etc/theme.xsl -o var/static-ized
+
+Only list anonymous, non-personalized pages in the routes file.
+"""
+import argparse
+import calendar
+import hashlib
+import json
+import logging
+import os
+import time
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+import requests
+
+from tttdiazo.corpus import transform, transform_pool
+
+DEFAULT_BACKEND = 'http://www.v-studios.com'
+DEFAULT_ROUTES = 'static_routes.txt'
+MANIFEST = 'manifest.json'
+SUFFIX = '.html'
+
+log = logging.getLogger(__name__)
+
+
+def route_file(directory, route):
+    """Return the file nginx's try_files looks for when serving route.
+
+    "/" is "/index.html" and "/foo.asp" is "/foo.asp.html"; with directory
+    "/" this is the name tttdiazo.nginxconf puts in the route's location.
+    """
+    if route.endswith('/'):
+        name = route + 'index.html'
+    else:
+        name = route + SUFFIX
+    return os.path.join(directory, name.lstrip('/'))
+
+
+def _render(job):
+    """Theme one page in a worker; return (route, html bytes)."""
+    route, body = job
+    return route, transform(body, route)
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _write(path, data, mtime):
+    """Atomically write data to path with the given modification time."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    os.utime(tmp, (mtime, mtime))
+    os.rename(tmp, path)
+
+
+def _remove(path):
+    """Remove path if it exists; return whether it did."""
+    if os.path.exists(path):
+        os.remove(path)
+        return True
+    return False
+
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {'theme': None, 'routes': {}}
+
+
+def prerender(backend, routes, xsl_path, directory, host=None, processes=None):
+    """Fetch, theme and write each route; return counts of what we did.
+
+    :param str backend: origin URL root, e.g. http://www.v-studios.com
+    :param list routes: paths to pre-render
+    :param str xsl_path: compiled theme, e.g. etc/theme.xsl
+    :param str directory: where nginx looks for static-ized pages
+    :param str host: Host header for the origin, if backend is an address
+    :param int processes: transform workers; defaults to the CPU count
+    :returns: `dict` with 'rendered', 'unchanged' and 'removed' counts
+    """
+    with open(xsl_path, 'rb') as f:
+        theme = _sha1(f.read())
+    manifest = load_manifest(directory)
+    retheme = manifest['theme'] not in (None, theme)
+    old = {} if retheme else manifest['routes']
+    entries = {}
+    jobs = []
+    removed = 0
+    session = requests.Session()
+    for route in routes:
+        headers = {'Host': host} if host else {}
+        previous = old.get(route)
+        if previous and os.path.exists(route_file(directory, route)):
+            if previous.get('etag'):
+                headers['If-None-Match'] = previous['etag']
+            if previous.get('last_modified'):
+                headers['If-Modified-Since'] = previous['last_modified']
+        res = session.get(backend + route, headers=headers, allow_redirects=False)
+        if res.status_code == 304:
+            entries[route] = previous
+            continue
+        content_type = res.headers.get('Content-Type', '')
+        if res.status_code != 200 or not content_type.startswith('text/html'):
+            log.warning('Not static-izing %s: %s %s', route, res.status_code, content_type)
+            removed += _remove(route_file(directory, route))
+            continue
+        entry = {'origin': _sha1(res.content),
+                 'etag': res.headers.get('ETag'),
+                 'last_modified': res.headers.get('Last-Modified')}
+        entries[route] = entry
+        if previous and previous['origin'] == entry['origin'] and \
+                os.path.exists(route_file(directory, route)):
+            continue
+        jobs.append((route, res.content))
+
+    for route in set(manifest['routes']) - set(routes):
+        removed += _remove(route_file(directory, route))
+
+    if jobs:
+        pool = transform_pool(xsl_path, processes)
+        try:
+            for route, html in pool.imap_unordered(_render, jobs):
+                modified = entries[route]['last_modified']
+                if modified and not retheme:
+                    mtime = mktime_tz(parsedate_tz(modified))
+                else:
+                    mtime = time.time()
+                _write(route_file(directory, route), html, mtime)
+                entries[route]['themed'] = _sha1(html)
+                entries[route]['rendered'] = formatdate(usegmt=True)
+                log.info('Rendered %s', route)
+        finally:
+            pool.close()
+            pool.join()
+
+    manifest = {'theme': theme, 'routes': entries,
+                'updated': calendar.timegm(time.gmtime())}
+    _write(os.path.join(directory, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'),
+           time.time())
+    return {'rendered': len(jobs), 'unchanged': len(entries) - len(jobs),
+            'removed': removed}
+
+
+def read_routes(path):
+    """Return the routes listed in path, skipping blanks, comments and queries."""
+    with open(path) as f:
+        routes = [line.strip() for line in f]
+    return [r for r in routes if r and not r.startswith('#') and '?' not in r]
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Pre-render themed pages for nginx to serve from disk.')
+    parser.add_argument('-b', '--backend', default=DEFAULT_BACKEND,
+                        help='Origin to fetch from. Default: {}.'.format(DEFAULT_BACKEND))
+    parser.add_argument('-H', '--host',
+                        help='Host header to send, if --backend is an address.')
+    parser.add_argument('-u', '--routes', default=DEFAULT_ROUTES,
+                        help='File of routes to pre-render. Default: {}.'.format(DEFAULT_ROUTES))
+    parser.add_argument('-x', '--xsl', required=True,
+                        help='Compiled theme, e.g. etc/theme.xsl.')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Static-ized directory, e.g. var/static-ized.')
+    parser.add_argument('-j', '--processes', type=int,
+                        help='Transform worker processes. Default: one per CPU.')
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-prerender console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    args = init_parser().parse_args()
+    counts = prerender(args.backend.rstrip('/'), read_routes(args.routes),
+                       args.xsl, args.output, args.host, args.processes)
+    log.info('%(rendered)d rendered, %(unchanged)d unchanged, %(removed)d removed', counts)
@@ -0,0 +1,194 @@
+"""Attribute theme transform time to the rules in rules.xml.
+
+Runs the compiled theme over a corpus of captured pages (see
+tttdiazo.corpus) with libxslt's profiler on, then charges each compiled
+template's time to the rule it came from:
+
+* templates whose match is a rule's content XPath (``replace``, ``drop``,
+  ``before``/``after`` on content) go to that rule;
+* the theme template (mode ``r1`` and so on) goes to ``<theme>`` together
+  with the ``copy`` rules inlined into it;
+* diazo's identity templates, which copy every content node not matched by
+  a rule, are reported on their own.
+
+Because libxslt charges pattern matching to the template that is applying
+templates, not to the pattern's owner, every rule's content XPath is also
+timed on its own against each page. A selector like ``#logo`` compiles to
+``//*[@id = 'logo']``, a scan of the whole tree; those are flagged::
+
+  bin/tttdiazo-profile -r rules.xml -c fixtures/origin
+"""
+import argparse
+import logging
+import re
+import timeit
+from collections import defaultdict
+
+from diazo.compiler import compile_theme
+from diazo.rules import process_rules
+from lxml import etree
+
+from tttdiazo.corpus import load_corpus, parse, transform_params
+from tttdiazo.themefiles import DIAZO_NS
+
+CSS_NS = 'http://namespaces.plone.org/diazo/css'
+# libxslt's profile counts time in ticks of XSLT_TIMESTAMP_TICS_PER_SEC.
+TICKS_PER_SEC = 100000.0
+# Rule attributes holding XPath evaluated against the content at runtime.
+CONTENT_ATTRS = ('content', 'content-children', 'if-content')
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+BUILTIN = '(diazo identity copy of unmatched content)'
+
+log = logging.getLogger(__name__)
+
+
+class Rule(object):
+    """A rules.xml rule, with the content XPaths diazo compiled it into."""
+
+    def __init__(self, xmlid, label, line, xpaths):
+        self.xmlid = xmlid
+        self.label = label
+        self.line = line
+        self.xpaths = xpaths
+        self.calls = 0
+        self.ticks = 0
+        self.xpath_seconds = defaultdict(float)
+
+    @property
+    def seconds(self):
+        return self.ticks / TICKS_PER_SEC + sum(self.xpath_seconds.values())
+
+
+def is_scan(xpath):
+    """Whether xpath walks the whole tree: a descendant axis from the root."""
+    return xpath.lstrip('(').startswith('//') or '|//' in xpath.replace(' ', '')
+
+
+def _label(rule):
+    """Return rule as written in rules.xml: its tag and attributes."""
+    attrs = ' '.join('{}="{}"'.format(k.replace('{%s}' % CSS_NS, 'css:'), v)
+                     for k, v in sorted(rule.attrib.items()) if k != XML_ID)
+    return '<{} {}>'.format(etree.QName(rule).localname, attrs).replace(' >', '>')
+
+
+def load_rules(rules):
+    """Return {xml:id: Rule} for the rules in the rules file."""
+    # Diazo numbers the rules right after xi:include, before compiling
+    # anything, so at that stage they still carry their source lines.
+    written = process_rules(rules, read_network=False, stop='add_identifiers')
+    processed = process_rules(rules, read_network=False)
+    xpaths = {}
+    for element in processed.iter('{%s}*' % DIAZO_NS):
+        if element.get(XML_ID):
+            xpaths[element.get(XML_ID)] = [element.get(a) for a in CONTENT_ATTRS
+                                           if element.get(a)]
+    found = {}
+    for element in written.iter('{%s}*' % DIAZO_NS):
+        xmlid = element.get(XML_ID)
+        if xmlid is None or element.tag == '{%s}rules' % DIAZO_NS:
+            continue
+        found[xmlid] = Rule(xmlid, _label(element), element.sourceline,
+                            xpaths.get(xmlid, []))
+    return found
+
+
+def owner(template, rules):
+    """Return the Rule a profiled template was compiled from, or None.
+
+    Outside a rule's own mode, a template belongs to the rule whose content
+    XPath is exactly its match: `//div` doesn't own `//div[@id="x"]`.
+    """
+    mode = template.get('mode')
+    if re.match(r'^r\d+$', mode or ''):
+        return rules.get(mode)
+    match = template.get('match')
+    for rule in rules.values():
+        if match in rule.xpaths and match not in ('/', '/html'):
+            return rule
+    return None
+
+
+def profile(rules_file, pages, repeat=1):
+    """Profile the theme over pages; return (rules, builtins, seconds).
+
+    :param rules_file: the rules.xml to compile and attribute time to
+    :param pages: [(route, body)] from `tttdiazo.corpus.load_corpus`
+    :returns: {xml:id: Rule} with times filled in, {template match: ticks}
+              for templates we couldn't attribute, and total transform
+              seconds measured without the profiler
+    """
+    rules = load_rules(rules_file)
+    transform = etree.XSLT(compile_theme(rules_file, read_network=False))
+    compiled = dict((r.xmlid, [(x, etree.XPath(x)) for x in r.xpaths if '$' not in x])
+                    for r in rules.values())
+    builtins = defaultdict(int)
+    seconds = 0.0
+    for route, body in pages:
+        doc = parse(body)
+        params = transform_params(route)
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            transform(doc, **params)
+            seconds += timeit.default_timer() - start
+            result = transform(doc, profile_run=True, **params)
+            for template in result.xslt_profile.getroot():
+                ticks = int(template.get('time'))
+                rule = owner(template, rules)
+                if rule is None:
+                    builtins[template.get('match')] += ticks
+                    continue
+                rule.calls += int(template.get('calls'))
+                rule.ticks += ticks
+            for xmlid, xpaths in compiled.items():
+                for text, xpath in xpaths:
+                    start = timeit.default_timer()
+                    xpath(doc)
+                    rules[xmlid].xpath_seconds[text] += timeit.default_timer() - start
+    return rules, builtins, seconds
+
+
+def report(rules, builtins, seconds, pages):
+    """Return report lines, rules ranked by time."""
+    lines = ['{} pages, {:.1f} ms transform time per page without profiling'.format(
+        pages, seconds * 1000 / max(pages, 1)), '',
+        '{:>9} {:>9} {:>6}  {}'.format('ms/page', 'xpath ms', 'line', 'rule')]
+    ranked = sorted((r for r in rules.values() if r.ticks or r.xpath_seconds),
+                    key=lambda r: r.seconds, reverse=True)
+    for rule in ranked:
+        lines.append('{:>9.3f} {:>9.3f} {:>6}  {}'.format(
+            rule.seconds * 1000 / max(pages, 1),
+            sum(rule.xpath_seconds.values()) * 1000 / max(pages, 1),
+            rule.line or '-', rule.label))
+        for xpath in rule.xpaths:
+            if is_scan(xpath):
+                lines.append('{:>28}  scans the whole tree: {}'.format('', xpath))
+    for match, ticks in sorted(builtins.items(), key=lambda i: i[1], reverse=True):
+        lines.append('{:>9.3f} {:>9} {:>6}  {} {}'.format(
+            ticks / TICKS_PER_SEC * 1000 / max(pages, 1), '-', '-', BUILTIN, match))
+    return lines
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Profile the compiled theme over a page corpus, per rules.xml rule.')
+    parser.add_argument('-r', '--rules', default='rules.xml',
+                        help='Diazo rules file. Default: rules.xml.')
+    parser.add_argument('-c', '--corpus', required=True,
+                        help='Recorded fixtures or a directory of .html pages.')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Transforms per page. Default: 3.')
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-profile console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    args = init_parser().parse_args()
+    pages = load_corpus(args.corpus)
+    if not pages:
+        log.error('No HTML pages in %s', args.corpus)
+        return 1
+    rules, builtins, seconds = profile(args.rules, pages, args.repeat)
+    print('\n'.join(report(rules, builtins, seconds, len(pages) * args.repeat)))
+    return 0
@@ -0,0 +1,156 @@
+"""Check theme output over a page corpus against golden files.
+
+Applies the compiled etc/theme.xsl to every page in a corpus (see
+tttdiazo.corpus) in a pool of worker processes and compares the
+normalized output with the golden file saved for that route. Only the
+differences come back from the workers and get printed, so a theme change
+can be checked across thousands of pages in seconds::
+
+  bin/tttdiazo-regress -x etc/theme.xsl -c fixtures/origin -g tests/golden
+
+Output is normalized before comparing: trailing whitespace and runs of
+blank lines don't count, nor does anything matching an ``--ignore``
+regex (timestamps, session ids). After an intended change, review the
+diffs and then rewrite the golden files with ``--update``.
+"""
+import argparse
+import difflib
+import logging
+import os
+import re
+import sys
+
+from tttdiazo.corpus import load_corpus, transform, transform_pool
+
+try:
+    from urllib.parse import quote
+except ImportError:     # Python 2
+    from urllib import quote
+
+SUFFIX = '.html'
+IGNORED = '<ignored>'
+
+log = logging.getLogger(__name__)
+
+# The --ignore regexes, compiled in each transform_pool worker.
+_ignore = ()
+
+
+def _init_ignore(ignore):
+    global _ignore
+    _ignore = [re.compile(pattern) for pattern in ignore]
+
+
+def golden_file(directory, route):
+    """Return the golden file for route: the quoted route plus .html."""
+    return os.path.join(directory, quote(route, safe='') + SUFFIX)
+
+
+def normalize(html, ignore=()):
+    """Return themed HTML as text with insignificant differences removed."""
+    text = html.decode('utf-8', 'replace')
+    for regex in ignore:
+        text = regex.sub(IGNORED, text)
+    lines = [line.rstrip() for line in text.splitlines()]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip() + '\n'
+
+
+def _check(job):
+    """Theme one page in a worker; return (route, state, detail).
+
+    state is 'same', 'missing' (detail: the output) or 'differs' (detail:
+    the unified diff, and the output after it).
+    """
+    route, body, golden = job
+    output = normalize(transform(body, route), _ignore)
+    if not os.path.exists(golden):
+        return route, 'missing', output
+    with open(golden, 'rb') as f:
+        expected = f.read().decode('utf-8')
+    if expected == output:
+        return route, 'same', None
+    diff = '\n'.join(difflib.unified_diff(expected.splitlines(), output.splitlines(),
+                                          golden, route, lineterm='', n=2))
+    return route, 'differs', (diff, output)
+
+
+def _save(path, text):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f:
+        f.write(text.encode('utf-8'))
+
+
+def regress(xsl_path, pages, golden_dir, update=False, processes=None, ignore=()):
+    """Compare themed pages to golden files; return (counts, diffs).
+
+    :param str xsl_path: compiled theme, e.g. etc/theme.xsl
+    :param pages: [(route, body)] from `tttdiazo.corpus.load_corpus`
+    :param str golden_dir: where golden files live, e.g. tests/golden
+    :param bool update: write missing and differing golden files
+    :param int processes: transform workers; defaults to the CPU count
+    :param ignore: regexes whose matches don't count as differences
+    :returns: `dict` of 'same', 'missing', 'differs' and 'stale' counts,
+              and a list of (route, diff) for the pages that differ
+    """
+    counts = {'same': 0, 'missing': 0, 'differs': 0, 'stale': 0}
+    diffs = []
+    jobs = [(route, body, golden_file(golden_dir, route)) for route, body in pages]
+    pool = transform_pool(xsl_path, processes, _init_ignore, (list(ignore),))
+    try:
+        for route, state, detail in pool.imap_unordered(_check, jobs, chunksize=8):
+            counts[state] += 1
+            if state == 'differs':
+                diff, detail = detail
+                diffs.append((route, diff))
+            if update and state != 'same':
+                _save(golden_file(golden_dir, route), detail)
+    finally:
+        pool.close()
+        pool.join()
+    expected = set(os.path.basename(golden) for _, _, golden in jobs)
+    if os.path.isdir(golden_dir):
+        stale = [n for n in os.listdir(golden_dir) if n.endswith(SUFFIX) and n not in expected]
+        counts['stale'] = len(stale)
+        if update:
+            for name in stale:
+                os.remove(os.path.join(golden_dir, name))
+    return counts, sorted(diffs)
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Compare themed output over a page corpus with golden files.')
+    parser.add_argument('-x', '--xsl', required=True,
+                        help='Compiled theme, e.g. etc/theme.xsl.')
+    parser.add_argument('-c', '--corpus', required=True,
+                        help='Recorded fixtures or a directory of .html pages.')
+    parser.add_argument('-g', '--golden', required=True,
+                        help='Golden file directory, e.g. tests/golden.')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='Write missing and changed golden files, remove stale ones.')
+    parser.add_argument('-i', '--ignore', action='append', default=[],
+                        help='Regex of output to ignore; may be repeated.')
+    parser.add_argument('-j', '--processes', type=int,
+                        help='Transform worker processes. Default: one per CPU.')
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-regress console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    args = init_parser().parse_args()
+    pages = load_corpus(args.corpus)
+    counts, diffs = regress(args.xsl, pages, args.golden, args.update,
+                            args.processes, args.ignore)
+    for route, diff in diffs:
+        sys.stdout.write(diff + '\n')
+    log.info('%d pages: %d same, %d differ, %d without golden file, %d stale golden files%s',
+             len(pages), counts['same'], counts['differs'], counts['missing'],
+             counts['stale'], ' (updated)' if args.update else '')
+    if args.update:
+        return 0
+    return 1 if counts['differs'] or counts['missing'] else 0
@@ -0,0 +1,248 @@
+"""Collect what visitors' browsers measure: real user monitoring (RUM).
+
+rules.xml adds a small script to every themed page that, once the page has
+loaded, requests ``/_rum?route=...&ttfb=...&dcl=...&load=...`` with the
+browser's Navigation Timing in ms since navigationStart: time to first
+byte, DOMContentLoaded and load. Comparing those with the theming time in
+bin/tttdiazo-logstats shows whether the XSLT step shows up in real page
+loads or is lost in the network and the browser.
+
+Both stacks answer the beacon without touching the origin:
+
+* paster: `RUMCollector` is mounted at /_rum in local.ini and keeps the
+  samples in memory; ``GET /_rum/stats`` returns their percentiles as JSON;
+* nginx: the cache front end logs the beacon to var/log/rum.log (the `rum`
+  log_format) and answers 204; read it with::
+
+    bin/tttdiazo-rum var/log/rum.log
+    bin/tttdiazo-rum --follow --interval 60 /var/app/var/log/rum.log
+
+Percentiles are rolling: only the samples of the last --window seconds,
+at most --samples per route, count.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from webob import Request, Response
+
+from tttdiazo.logstats import Follower, generations, open_log
+
+try:
+    from urllib.parse import unquote
+except ImportError:     # Python 2
+    from urllib import unquote
+
+METRICS = ('ttfb', 'dcl', 'load')
+PERCENTILES = (50, 75, 95)
+DEFAULT_WINDOW = 300
+DEFAULT_SAMPLES = 1000
+DEFAULT_MAX_ROUTES = 500
+DEFAULT_TOP = 30
+OTHER = '(other)'
+# Anything longer is a tab left in the background, not a page load.
+MAX_MS = 600000
+
+# log_format rum '$msec "$arg_route" $arg_ttfb $arg_dcl $arg_load';
+RUM_RE = re.compile(r'^(?P<time>[\d.]+) "(?P<route>[^"]*)" (?P<ttfb>\S+) (?P<dcl>\S+) (?P<load>\S+)$')
+
+log = logging.getLogger(__name__)
+
+
+def parse_beacon(params):
+    """Return (route, {metric: ms}) from beacon parameters, or None if bogus.
+
+    The route loses any query string; metrics that are missing, negative
+    (the browser hadn't got there) or implausibly long are left out.
+    """
+    route = params.get('route') or ''
+    if not route.startswith('/'):
+        return None
+    metrics = {}
+    for name in METRICS:
+        try:
+            ms = float(params.get(name))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= ms <= MAX_MS:
+            metrics[name] = ms
+    if not metrics:
+        return None
+    return route.split('?', 1)[0], metrics
+
+
+class RollingWindow(object):
+    """The values added in the last `window` seconds, at most `max_samples`."""
+
+    def __init__(self, window=DEFAULT_WINDOW, max_samples=DEFAULT_SAMPLES):
+        self.window = window
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, value, now):
+        self.samples.append((now, value))
+
+    def values(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        return sorted(value for _, value in self.samples)
+
+
+def percentile(values, pct):
+    """Return the pct percentile (nearest rank) of sorted values, or None."""
+    if not values:
+        return None
+    return values[max(1, int(math.ceil(len(values) * pct / 100.0))) - 1]
+
+
+class RUMStats(object):
+    """Thread-safe rolling percentiles of each metric, per route.
+
+    :param int window: seconds of samples to keep
+    :param int max_samples: samples kept per route and metric
+    :param int max_routes: routes tracked individually before "(other)"
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, max_samples=DEFAULT_SAMPLES,
+                 max_routes=DEFAULT_MAX_ROUTES):
+        self.window = window
+        self.max_samples = max_samples
+        self.max_routes = max_routes
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, metrics, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            windows = self.routes.get(route)
+            if windows is None:
+                if len(self.routes) >= self.max_routes:
+                    route = OTHER
+                windows = self.routes.setdefault(route, dict(
+                    (name, RollingWindow(self.window, self.max_samples)) for name in METRICS))
+            for name, ms in metrics.items():
+                windows[name].add(ms, now)
+
+    def add_log(self, line):
+        """Add a beacon logged by nginx in the `rum` format; False if unparsed."""
+        match = RUM_RE.match(line)
+        if not match:
+            return False
+        beacon = parse_beacon(dict((name, unquote(match.group(name)))
+                                   for name in ('route',) + METRICS))
+        if beacon is not None:
+            self.add(beacon[0], beacon[1], float(match.group('time')))
+        return True
+
+    def snapshot(self, now=None):
+        """Return {route: {metric: {'count': n, 'p50': ms, ...}}} for the window."""
+        now = time.time() if now is None else now
+        result = {}
+        with self._lock:
+            for route, windows in self.routes.items():
+                stats = {}
+                for name, window in windows.items():
+                    values = window.values(now)
+                    stats[name] = dict([('count', len(values))] + [
+                        ('p{}'.format(pct), percentile(values, pct)) for pct in PERCENTILES])
+                if any(s['count'] for s in stats.values()):
+                    result[route] = stats
+        return result
+
+    def report(self, top=DEFAULT_TOP, now=None):
+        """Return report lines for the most-sampled routes."""
+        def ms(value):
+            return '-' if value is None else '{:.0f}'.format(value)
+
+        snapshot = self.snapshot(now)
+        lines = ['{:<40} {:>6} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7}'.format(
+            'route', 'loads', 'ttfb50', 'ttfb95', 'dcl50', 'dcl95', 'load50', 'load95')]
+        ranked = sorted(snapshot.items(), key=lambda item: item[1]['load']['count'], reverse=True)
+        for route, stats in ranked[:top]:
+            lines.append('{:<40} {:>6} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7}'.format(
+                route[:40], max(s['count'] for s in stats.values()),
+                ms(stats['ttfb']['p50']), ms(stats['ttfb']['p95']),
+                ms(stats['dcl']['p50']), ms(stats['dcl']['p95']),
+                ms(stats['load']['p50']), ms(stats['load']['p95'])))
+        return lines
+
+
+class RUMCollector(object):
+    """WSGI app for /_rum: record beacons, serve the percentiles at /stats."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        if request.path_info.rstrip('/') == '/stats':
+            body = json.dumps(self.stats.snapshot(), sort_keys=True).encode('utf-8')
+            response = Response(body, content_type='application/json')
+        else:
+            beacon = parse_beacon(request.params)
+            if beacon is not None:
+                self.stats.add(*beacon)
+            response = Response(status=204)
+        response.cache_control = 'no-store'
+        return response(environ, start_response)
+
+
+def app_factory(global_conf, window=DEFAULT_WINDOW, max_samples=DEFAULT_SAMPLES,
+                max_routes=DEFAULT_MAX_ROUTES, **local_conf):
+    """Paste app_factory for ``use = egg:tttdiazo#rum``."""
+    return RUMCollector(RUMStats(float(window), int(max_samples), int(max_routes)))
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Report rolling percentiles of real page load timings per route '
+                    'from the nginx rum.log.')
+    parser.add_argument('path', nargs='?', default='var/log/rum.log',
+                        help='The rum log. Default: var/log/rum.log.')
+    parser.add_argument('-w', '--window', type=float, default=DEFAULT_WINDOW,
+                        help='Seconds of beacons to report on. Default: {}.'.format(DEFAULT_WINDOW))
+    parser.add_argument('-s', '--samples', type=int, default=DEFAULT_SAMPLES,
+                        help='Beacons kept per route. Default: {}.'.format(DEFAULT_SAMPLES))
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='Keep tailing the log, reporting every --interval.')
+    parser.add_argument('-i', '--interval', type=float, default=60,
+                        help='Seconds between reports with --follow. Default: 60.')
+    parser.add_argument('-n', '--top', type=int, default=DEFAULT_TOP,
+                        help='Routes to report. Default: {}.'.format(DEFAULT_TOP))
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-rum console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    args = init_parser().parse_args()
+    if not os.path.exists(args.path):
+        log.error('No rum log at %s', args.path)
+        return 1
+    stats = RUMStats(args.window, args.samples)
+    unparsed = 0
+    for path in generations(args.path):
+        with open_log(path) as f:
+            for line in f:
+                unparsed += not stats.add_log(line.rstrip('\n'))
+    if unparsed:
+        log.warning('%d lines unparsed', unparsed)
+    print('\n'.join(stats.report(args.top)))
+    if not args.follow:
+        return 0
+    follower = Follower(args.path)
+    try:
+        while True:
+            time.sleep(args.interval)
+            for line in follower.lines():
+                stats.add_log(line)
+            print('\n' + time.strftime('%Y-%m-%d %H:%M:%S'))
+            print('\n'.join(stats.report(args.top)))
+    except KeyboardInterrupt:
+        return 0
@@ -0,0 +1,149 @@
+"""Tell the client where a themed response's time went: Server-Timing.
+
+With ``server_timing = true`` in the `egg:tttdiazo#theme` filter every
+response gets a header like::
+
+  Server-Timing: origin;dur=182.4, parse;dur=3.1, xslt;dur=9.7,
+                 cache;desc=MISS, total;dur=196.0
+
+* origin: fetching the page from the ASP origin, body and all;
+* parse: from having the origin's page to starting the transform, which
+  is almost all lxml parsing it as HTML;
+* xslt: applying the compiled theme;
+* cache: the output cache's HIT, MISS or BYPASS (absent if it's off);
+* total: everything in the filter until the response headers go out.
+
+Durations are in ms, so browsers' developer tools show them against the
+network timings. The nginx stack sends the same metrics as far as it can
+measure them; see templates/nginx.conf.in.
+
+The XSLT middleware doesn't pass the request to the stylesheet call, so
+the timings being collected live in a thread local for the duration of
+the request as well as in the WSGI environ.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from tttdiazo.outputcache import STATUS_KEY
+
+HEADER = 'Server-Timing'
+ENVIRON_KEY = 'tttdiazo.server_timing'
+# ms an upstream fetched before the filter ran took; see `tttdiazo.asyncproxy`.
+FETCH_KEY = 'tttdiazo.fetch_ms'
+
+_local = threading.local()
+
+
+class ServerTiming(object):
+    """The metrics of one request, in the order they were added."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.fetched = None
+        self.metrics = OrderedDict()
+
+    def add(self, name, ms=None, desc=None):
+        self.metrics[name] = (ms, desc)
+
+    def header(self):
+        """Return the Server-Timing header value."""
+        parts = []
+        for name, (ms, desc) in self.metrics.items():
+            part = name
+            if ms is not None:
+                part += ';dur={:.1f}'.format(ms)
+            if desc is not None:
+                part += ';desc={}'.format(desc)
+            parts.append(part)
+        return ', '.join(parts)
+
+
+def current():
+    """Return the `ServerTiming` of the request this thread serves, or None."""
+    return getattr(_local, 'timing', None)
+
+
+def elapsed_ms(since):
+    return (time.time() - since) * 1000
+
+
+class TimedUpstream(object):
+    """Wrap the transform's upstream app, timing the whole origin fetch.
+
+    An upstream already fetched says how long that took in environ[FETCH_KEY].
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        timing = current()
+        if timing is None:
+            return self.app(environ, start_response)
+        began = time.time()
+        app_iter = self.app(environ, start_response)
+        try:
+            body = [b''.join(app_iter)]
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        timing.add('origin', environ.get(FETCH_KEY, elapsed_ms(began)))
+        timing.fetched = time.time()
+        return body
+
+
+class TimedTransform(object):
+    """Wrap a compiled `lxml.etree.XSLT`, timing the parse and the transform."""
+
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __getattr__(self, name):
+        return getattr(self.transform, name)
+
+    def __call__(self, tree, **params):
+        timing = current()
+        if timing is None:
+            return self.transform(tree, **params)
+        began = time.time()
+        if timing.fetched is not None:
+            timing.add('parse', (began - timing.fetched) * 1000)
+        result = self.transform(tree, **params)
+        timing.add('xslt', elapsed_ms(began))
+        return result
+
+
+def instrument(transform_middleware):
+    """Time the origin fetch and transform of a diazo XSLTMiddleware in place."""
+    transform_middleware.app = TimedUpstream(transform_middleware.app)
+    transform_middleware.transform = TimedTransform(transform_middleware.transform)
+    return transform_middleware
+
+
+class ServerTimingMiddleware(object):
+    """Add the Server-Timing header to the wrapped filter's responses.
+
+    The filter's XSLT middleware must be `instrument`-ed for the origin,
+    parse and xslt metrics; without, only cache and total are sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        timing = ServerTiming()
+        environ[ENVIRON_KEY] = timing
+        _local.timing = timing
+
+        def timed_start_response(status, headers, exc_info=None):
+            cache_status = environ.get(STATUS_KEY)
+            if cache_status is not None:
+                timing.add('cache', desc=cache_status)
+            timing.add('total', elapsed_ms(timing.start))
+            return start_response(status, headers + [(HEADER, timing.header())], exc_info)
+
+        try:
+            return self.app(environ, timed_start_response)
+        finally:
+            _local.timing = None
@@ -0,0 +1,209 @@
+"""Compiled-theme cache for the paster theming pipeline.
+
+Diazo's own ``debug = true`` recompiles rules.xml and the theme into XSLT on
+every request, which costs more than the transform itself. This filter keeps
+the compiled XSLT in memory and only recompiles when rules.xml, the theme, or
+a file they include actually changes, so front-end developers still see their
+edits on the next request.
+
+Use it in place of ``egg:diazo`` in a paster .ini; it takes the same options::
+
+  [filter:theme]
+  use = egg:tttdiazo#theme
+  rules = %(here)s/rules.xml
+  prefix = /static
+  cache = true
+
+With ``cache = false`` it behaves exactly like ``egg:diazo``. Add
+``store = %(here)s/xsl-store`` to load and save compiled themes in the same
+on-disk store the nginx build uses (see `tttdiazo.xslstore`), so a restart
+doesn't recompile an unchanged theme either. ``output_cache = true`` also
+caches the themed pages themselves; see `tttdiazo.outputcache`, and
+``server_timing = true`` sends a Server-Timing header with the origin,
+parse and transform times; see `tttdiazo.servertiming`.
+
+Under the pre-fork server (`tttdiazo.prefork`) the master compiles every
+filter's theme with `compile_all` before forking, and the workers `freeze`
+theirs: the master watches the sources for them.
+"""
+import logging
+import threading
+import weakref
+
+from diazo.wsgi import DiazoMiddleware, asbool
+
+from tttdiazo.metrics import Metric, register
+from tttdiazo.outputcache import DEFAULT_SIZE_MB, DEFAULT_TTL, LRUCache, OutputCacheMiddleware
+from tttdiazo.servertiming import ServerTimingMiddleware, instrument
+from tttdiazo.themefiles import digest_files, stat_files, theme_files
+from tttdiazo.xslstore import XSLStore
+
+log = logging.getLogger(__name__)
+
+# Every ThemeCacheMiddleware in this process, for `compile_all` and `freeze_all`.
+FILTERS = weakref.WeakSet()
+
+
+class ThemeCacheMiddleware(DiazoMiddleware):
+    """Diazo middleware that recompiles only when the theme sources change.
+
+    On each request we stat the files from `theme_files`; only when one has a
+    new mtime or size do we hash their contents, and only when that hash
+    differs do we recompile. Touching a file without editing it costs a hash,
+    not a compile.
+
+    `hits` and `recompiles` count how often the cached XSLT was reused or
+    rebuilt; they're logged on each recompile. A recompile loads from the XSL
+    store if one is configured and already has this theme.
+    """
+
+    def __init__(self, app, global_conf, rules, cache=True, store=None,
+                 output_cache=False, output_cache_size=DEFAULT_SIZE_MB,
+                 output_cache_ttl=DEFAULT_TTL, server_timing=False, **kw):
+        DiazoMiddleware.__init__(self, app, global_conf, rules, **kw)
+        self.cache = asbool(cache)
+        self.store = XSLStore(store) if store else None
+        self.server_timing = asbool(server_timing)
+        self.output_cache = None
+        if asbool(output_cache):
+            self.output_cache = LRUCache(float(output_cache_size) * 1024 * 1024,
+                                         output_cache_ttl)
+        if self.cache:
+            # We decide when to recompile, not diazo's debug flag.
+            self.debug = False
+        self.hits = 0
+        self.recompiles = 0
+        self._lock = threading.Lock()
+        # Separate from _lock, so counting a hit never waits on a recompile.
+        self._hits_lock = threading.Lock()
+        self._files = ()
+        self._stats = None
+        self._digest = None
+        self.watch = True
+        register(self)
+        FILTERS.add(self)
+
+    def compile_options(self):
+        """Return the options that change the compiled XSL, for the store key."""
+        xsl_params = dict((name, None) for name in self.environ_param_map.values())
+        xsl_params.update(self.params)
+        return dict(absolute_prefix=self.absolute_prefix,
+                    includemode=self.includemode,
+                    read_network=self.read_network,
+                    xsl_params=sorted(xsl_params.items()))
+
+    def compile_theme(self):
+        """Compile the theme, or load it from the XSL store if it has it."""
+        if self.store is None:
+            return DiazoMiddleware.compile_theme(self)
+        key = self.store.key(self.rules, self.theme, **self.compile_options())
+        tree = self.store.get(key)
+        if tree is None:
+            tree = DiazoMiddleware.compile_theme(self)
+            self.store.put(key, tree)
+        return tree
+
+    def get_transform_middleware(self):
+        """Return the XSLT middleware, wrapped in the output cache if enabled.
+
+        Output themed by an older theme is thrown away.
+        """
+        transform = DiazoMiddleware.get_transform_middleware(self)
+        if self.server_timing:
+            instrument(transform)
+        if self.output_cache is None:
+            return transform
+        self.output_cache.clear()
+        return OutputCacheMiddleware(transform, self.output_cache)
+
+    def collect(self):
+        """Return [`tttdiazo.metrics.Metric`] for the compile and output caches."""
+        metrics = [
+            Metric('tttdiazo_theme_cache_hits_total', 'counter',
+                   'Requests served by the already compiled theme.').add(self.hits),
+            Metric('tttdiazo_theme_recompiles_total', 'counter',
+                   'Times the theme was compiled or loaded from the store.').add(self.recompiles),
+        ]
+        cache = self.output_cache
+        if cache is not None:
+            metrics.extend([
+                Metric('tttdiazo_output_cache_hits_total', 'counter',
+                       'Themed pages served from the output cache.').add(cache.hits),
+                Metric('tttdiazo_output_cache_misses_total', 'counter',
+                       'Output cache lookups that had to theme the page.').add(cache.misses),
+                Metric('tttdiazo_output_cache_bytes', 'gauge',
+                       'Size of the themed pages in the output cache.').add(cache.bytes),
+                Metric('tttdiazo_output_cache_entries', 'gauge',
+                       'Themed pages in the output cache.').add(len(cache)),
+            ])
+        return metrics
+
+    def _hit(self):
+        with self._hits_lock:
+            self.hits += 1
+
+    def _fresh(self, stats):
+        return self.transform_middleware is not None and stats == self._stats
+
+    def cached_transform_middleware(self):
+        """Return the XSLT middleware, recompiling if the sources changed."""
+        if self._fresh(stat_files(self._files)):
+            self._hit()
+            return self.transform_middleware
+        with self._lock:
+            # Another thread may have recompiled while we waited.
+            if self._fresh(stat_files(self._files)):
+                self._hit()
+                return self.transform_middleware
+            files = theme_files(self.rules, self.theme)
+            stats = stat_files(files)
+            digest = digest_files(files)
+            if self.transform_middleware is not None and digest == self._digest:
+                # Touched but not edited: remember the new mtimes and carry on.
+                self._files, self._stats = files, stats
+                self._hit()
+                return self.transform_middleware
+            self.transform_middleware = self.get_transform_middleware()
+            self._files, self._stats, self._digest = files, stats, digest
+            self.recompiles += 1
+            log.info('Compiled theme %s (recompiles=%d hits=%d)',
+                     digest, self.recompiles, self.hits)
+            return self.transform_middleware
+
+    def freeze(self):
+        """Keep the compiled theme, without checking its sources per request."""
+        self.watch = False
+
+    def __call__(self, environ, start_response):
+        if self.cache and self.watch:
+            self.cached_transform_middleware()
+        return DiazoMiddleware.__call__(self, environ, start_response)
+
+
+def compile_all():
+    """Bring every caching filter's compiled theme up to date now.
+
+    Return how many filters recompiled: 0 when no theme changed since the
+    last call.
+    """
+    recompiled = 0
+    for middleware in list(FILTERS):
+        if middleware.cache:
+            before = middleware.recompiles
+            middleware.cached_transform_middleware()
+            recompiled += middleware.recompiles - before
+    return recompiled
+
+
+def freeze_all():
+    """`freeze` every caching filter in this process."""
+    for middleware in list(FILTERS):
+        middleware.freeze()
+
+
+def filter_factory(app, global_conf, **local_conf):
+    """Paste filter_app_factory for ``use = egg:tttdiazo#theme``."""
+    middleware = ThemeCacheMiddleware(app, global_conf, **local_conf)
+    if middleware.server_timing:
+        return ServerTimingMiddleware(middleware)
+    return middleware
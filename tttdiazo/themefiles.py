@@ -0,0 +1,93 @@
+"""Find, snapshot and hash the files a compiled Diazo theme is built from.
+
+Shared by the in-memory theme cache and the on-disk XSL store.
+"""
+import hashlib
+import os
+
+from lxml import etree
+
+DIAZO_NS = 'http://namespaces.plone.org/diazo'
+XINCLUDE_NS = 'http://www.w3.org/2001/XInclude'
+NAMESPACES = {'dz': DIAZO_NS, 'xi': XINCLUDE_NS}
+
+
+def _local_path(href, base):
+    """Return the filesystem path for href relative to base, or None.
+
+    Network and python:// URLs can't be watched, so we ignore them.
+    """
+    if href.startswith('file://'):
+        href = href[len('file://'):]
+    elif '://' in href:
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(base), href))
+
+
+def theme_files(rules, theme=None):
+    """Return the local files the compiled theme depends on.
+
+    That's the rules file, any rules it pulls in with <xi:include>, and the
+    theme HTML named by <theme href> or by the `theme` option. Files which
+    don't parse are still returned: the compiler will report the error.
+
+    :param str rules: path to rules.xml
+    :param str theme: optional theme path or file:// URL overriding <theme>
+    :returns: `list` of absolute paths, rules.xml first
+    """
+    rules = os.path.abspath(rules)
+    files = []
+    pending = [rules]
+    while pending:
+        path = pending.pop(0)
+        if path in files:
+            continue
+        files.append(path)
+        try:
+            tree = etree.parse(path)
+        except (IOError, etree.XMLSyntaxError):
+            continue
+        for href in tree.xpath('//xi:include/@href', namespaces=NAMESPACES):
+            local = _local_path(href, path)
+            if local:
+                pending.append(local)
+        for href in tree.xpath('//dz:theme/@href', namespaces=NAMESPACES):
+            local = _local_path(href, path)
+            if local and local not in files:
+                files.append(local)
+    if theme:
+        local = _local_path(theme, rules)
+        if local and local not in files:
+            files.append(local)
+    return files
+
+
+def stat_files(paths):
+    """Return a cheap snapshot of (path, mtime, size) to spot edits."""
+    snapshot = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            snapshot.append((path, None, None))
+        else:
+            snapshot.append((path, st.st_mtime, st.st_size))
+    return tuple(snapshot)
+
+
+def digest_files(paths, root=None):
+    """Return a SHA1 hex digest over the names and contents of paths.
+
+    Names are taken relative to root if given, so that the digest doesn't
+    depend on where the checkout lives.
+    """
+    sha = hashlib.sha1()
+    for path in paths:
+        name = os.path.relpath(path, root) if root else path
+        sha.update(name.encode('utf-8'))
+        try:
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+        except (IOError, OSError):
+            sha.update(b'\0missing')
+    return sha.hexdigest()
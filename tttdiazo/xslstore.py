@@ -0,0 +1,176 @@
+"""Content-addressed store of compiled theme XSL files.
+
+Compiling rules.xml and theme/theme.html is the slow part of every build:
+`make prod_build`, CodeDeploy's 3_AfterInstall.sh and the Docker build all
+used to run ``bin/diazocompiler`` even when nothing in the theme changed.
+Here each compiled theme.xsl is saved under a key made from the contents of
+the theme files, the compile options and the compiler versions, so an
+unchanged theme is only ever compiled once.
+
+The buildout `[theme-xsl]` part runs the console script, which points
+etc/theme.xsl (what nginx's ``xslt_stylesheet`` loads) at the stored file::
+
+  bin/tttdiazo-compile -O -n -r rules.xml -o etc/theme.xsl -s xsl-store
+
+With ``-O`` the compiled XSL is rewritten by `tttdiazo.optimizer` before
+it's stored; optimized and plain compiles are stored under different keys.
+
+The paster filter in `tttdiazo.themecache` takes a ``store`` option to load
+from and save to the same store.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import tempfile
+
+import lxml
+from diazo.compiler import compile_theme
+from lxml import etree
+from pkg_resources import get_distribution
+
+from tttdiazo import optimizer
+from tttdiazo.themefiles import digest_files, theme_files
+
+DEFAULT_KEEP = 10
+
+log = logging.getLogger(__name__)
+
+
+def compiler_version():
+    """Return the versions that affect what the compiler emits."""
+    return 'diazo={} lxml={} libxslt={}'.format(
+        get_distribution('diazo').version,
+        lxml.__version__,
+        '.'.join(str(i) for i in etree.LIBXSLT_VERSION))
+
+
+class XSLStore(object):
+    """A directory of compiled theme files named by content hash."""
+
+    def __init__(self, directory, keep=DEFAULT_KEEP):
+        self.directory = os.path.abspath(directory)
+        self.keep = int(keep)
+
+    def key(self, rules, theme=None, **options):
+        """Return the store key for compiling rules with these options.
+
+        File contents are hashed relative to the rules directory so the same
+        theme in another checkout (or under /var/app) gets the same key.
+        """
+        root = os.path.dirname(os.path.abspath(rules))
+        sha = hashlib.sha1()
+        sha.update(compiler_version().encode('utf-8'))
+        sha.update(repr(sorted(options.items())).encode('utf-8'))
+        sha.update(digest_files(theme_files(rules, theme), root).encode('utf-8'))
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.xsl')
+
+    def get(self, key):
+        """Return the stored XSL tree for key, or None if we don't have it."""
+        path = self.path(key)
+        try:
+            tree = etree.parse(path)
+        except (IOError, OSError, etree.XMLSyntaxError):
+            return None
+        os.utime(path, None)    # mark as recently used for prune()
+        return tree
+
+    def put(self, key, tree):
+        """Save tree under key atomically and return its path."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        root = tree.getroot()
+        if not root.tail:
+            root.tail = '\n'
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            tree.write(f, encoding='utf-8')
+        os.chmod(tmp, 0o644)    # nginx workers don't run as the builder
+        os.rename(tmp, self.path(key))
+        self.prune()
+        return self.path(key)
+
+    def prune(self):
+        """Remove all but the `keep` most recently used entries."""
+        entries = [os.path.join(self.directory, name)
+                   for name in os.listdir(self.directory)
+                   if name.endswith('.xsl')]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[self.keep:]:
+            os.remove(path)
+
+    def compile(self, rules, theme=None, optimize=False, **options):
+        """Return (path, compiled) for the theme, compiling only on a miss.
+
+        `options` are passed to diazo's compile_theme and are part of the key,
+        as is the optimizer version if `optimize` is set.
+        """
+        if optimize:
+            key = self.key(rules, theme, optimizer=optimizer.VERSION, **options)
+        else:
+            key = self.key(rules, theme, **options)
+        if self.get(key) is not None:
+            return self.path(key), False
+        tree = compile_theme(rules, theme=theme, **options)
+        if optimize:
+            tree, changes = optimizer.optimize(tree)
+            log.info('Optimized: %d rewrites', len(changes))
+        return self.put(key, tree), True
+
+
+def link(target, output):
+    """Atomically point the output path at target with a symlink."""
+    output = os.path.abspath(output)
+    outdir = os.path.dirname(output)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tmp = output + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.rename(tmp, output)
+
+
+def init_parser():
+    """Return a configured arg parser."""
+    parser = argparse.ArgumentParser(
+        description='Compile a Diazo theme, reusing a stored compile if the '
+                    'theme is unchanged.')
+    parser.add_argument('-r', '--rules', required=True,
+                        help='Diazo rules file, e.g. rules.xml.')
+    parser.add_argument('-t', '--theme',
+                        help='Theme file, overriding the <theme> in the rules.')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Path to link to the compiled XSL, e.g. etc/theme.xsl.')
+    parser.add_argument('-s', '--store', required=True,
+                        help='Directory holding compiled XSL files.')
+    parser.add_argument('-p', '--prefix',
+                        help='Prefix for relative URLs in the theme.')
+    parser.add_argument('-n', '--network', action='store_true',
+                        help='Allow reads from the network.')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='Rewrite the compiled XPath into cheaper equivalents.')
+    parser.add_argument('-k', '--keep', type=int, default=DEFAULT_KEEP,
+                        help='Compiled files to keep. Default: {}.'.format(DEFAULT_KEEP))
+    return parser
+
+
+def main():
+    """Entrypoint for the tttdiazo-compile console script."""
+    logging.basicConfig(format='%(name)s: %(message)s')
+    log.setLevel(logging.INFO)
+    args = init_parser().parse_args()
+    store = XSLStore(args.store, keep=args.keep)
+    path, compiled = store.compile(args.rules, theme=args.theme,
+                                   optimize=args.optimize,
+                                   absolute_prefix=args.prefix,
+                                   read_network=args.network)
+    link(path, args.output)
+    log.info('%s %s -> %s', 'Compiled' if compiled else 'Reused', args.output, path)
+
+
+if __name__ == '__main__':
+    main()